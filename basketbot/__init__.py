@@ -4,11 +4,13 @@ from flask import Flask
 from flask_cors import CORS
 from .exceptions import *
 from .database import db, migrate
-from basketbot.datamodel import register_events
+from basketbot.datamodel import register_events, rule_index, site_url_index
 from .marshalling import ma
+from basketbot.util import http_client, protocol_cache, domain_extractor
 from basketbot.frontend import frontend
 from basketbot.api import api
 from basketbot.api import blp, blp_dom_elem
+from basketbot.api.catalogue import catalogue
 
 if "XDG_CONFIG_HOME" in os.environ:
     HOME = os.getenv("XDG_CONFIG_HOME")
@@ -42,7 +44,13 @@ def create_app(config="basketbot.config.Testing"):
     # Enable CORS for all api endpoints from browser extensions
     cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+    http_client.init_app(app)
+    protocol_cache.init_app(app)
+    domain_extractor.init_app(app)
     db.init_app(app)
+    rule_index.init_app(app)
+    site_url_index.init_app(app)
+    catalogue.init_app(app)
     # Register any db event listeners
     register_events(db.session) 
     migrate.init_app(app, db)
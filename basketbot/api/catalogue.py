@@ -0,0 +1,174 @@
+"""
+Cached country and region catalogue served to browser extensions and forms.
+
+Every browser extension fetches the list of countries and regions when it
+starts, and the list almost never changes. Catalogue builds all of the
+payloads from one query, keeps them (and their serialized JSON) until a
+Country or Region is added, removed or renamed, and serves them with a strong
+ETag so that clients which already hold the current version get a 304.
+"""
+
+import hashlib
+import json
+from threading import Lock
+from time import monotonic
+from flask import Response, request
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+from basketbot import db
+from basketbot.datamodel import model as dm
+from basketbot.schemas import CountryRegions, FormRegion
+
+CATALOGUE_SESSION_KEY = 'catalogue_changed'
+
+class CataloguePayload:
+    """
+    Short Summary
+    -------------
+    A catalogue payload, as data and as serialized JSON with its ETag
+    """
+    __slots__ = ('data', 'body', 'etag')
+
+    def __init__(self, data):
+        self.data = data
+        self.body = json.dumps(data, separators=(',', ':'), sort_keys=True).encode('utf-8')
+        self.etag = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+
+    def response(self):
+        """
+        Get a JSON response with a strong ETag, which is a 304 if the request
+        has a matching If-None-Match header
+        """
+        response = Response(self.body, mimetype='application/json')
+        response.set_etag(self.etag)
+        return response.make_conditional(request)
+
+class Catalogue:
+    """
+    Short Summary
+    -------------
+    Process wide cache of the country and region catalogue payloads
+
+    Extended Summary
+    ----------------
+    Payloads (see the PAYLOADS keys) are built together, with a single outer
+    join of countries and regions, the first time any of them is needed. They
+    are dropped when a Country or Region is inserted, deleted, renamed or a
+    Region moves country, and again when that transaction ends (in case it is
+    rolled back). Other Region updates, such as new basket prices, leave the
+    catalogue as it is. Changes made by other processes are picked up once
+    the payloads are older than max_age seconds.
+
+    Payloads built from a query that started before the latest invalidation
+    are returned but not kept, so a change committed while they were being
+    built is not hidden.
+
+    The module level instance (catalogue) takes max_age from the
+    CATALOGUE_MAX_AGE config value in create_app.
+
+    Parameters
+    ----------
+    max_age : float
+        Maximum age in seconds of the payloads before they are rebuilt (None
+        to keep them until invalidated)
+    """
+    PAYLOADS = ('country', 'countryregionsdict', 'region', 'country_region_dict')
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._payloads = None
+        self._built_at = None
+        self._generation = 0
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """ Configure the catalogue from a Flask app config """
+        self.invalidate()
+        self.max_age = app.config.get('CATALOGUE_MAX_AGE', self.max_age)
+
+    def get(self, name):
+        """ Get a CataloguePayload by name """
+        payloads = self._payloads
+        if payloads is None or self._expired():
+            payloads = self.load()
+        return payloads[name]
+
+    def load(self, session=None):
+        """ (Re)build all payloads """
+        session = session or db.session
+        generation = self._generation
+        rows = session.query(dm.Country, dm.Region).select_from(dm.Country).outerjoin(
+                dm.Region, dm.Region.country_id == dm.Country.id, full=True
+                ).order_by(dm.Country.id, dm.Region.id)
+        countries = {}
+        regions = []
+        for country, region in rows:
+            if country is not None:
+                countries.setdefault(country.id, (country, []))
+            if region is not None:
+                regions.append(region)
+                if country is not None:
+                    countries[country.id][1].append(region)
+        # Regions are dumped here, rather than through the nested field, to
+        # avoid lazy loading Country.regions
+        region_schema = FormRegion(many=True)
+        country_schema = CountryRegions(exclude=('regions',))
+        country_data = []
+        for country, country_regions in countries.values():
+            data = country_schema.dump(country)
+            data['regions'] = region_schema.dump(country_regions)
+            country_data.append(data)
+        payloads = {
+                'country': CataloguePayload(country_data),
+                'countryregionsdict': CataloguePayload({
+                    data['name']: {key: value for key, value in data.items() if key != 'name'}
+                    for data in country_data
+                    }),
+                'region': CataloguePayload(region_schema.dump(sorted(regions, key=lambda region: region.id))),
+                'country_region_dict': CataloguePayload({
+                    data['country_id']: {key: value for key, value in data.items() if key != 'country_id'}
+                    for data in country_data
+                    }),
+                }
+        with self._lock:
+            if self._generation == generation:
+                self._payloads = payloads
+                self._built_at = monotonic()
+        return payloads
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._payloads = None
+
+    def _expired(self):
+        return self.max_age is not None and monotonic() - self._built_at > self.max_age
+
+catalogue = Catalogue()
+
+def note_catalogue_change(target):
+    catalogue.invalidate()
+    session = object_session(target)
+    if session is not None:
+        session.info[CATALOGUE_SESSION_KEY] = True
+
+@event.listens_for(dm.Country, "after_insert")
+@event.listens_for(dm.Country, "after_delete")
+@event.listens_for(dm.Region, "after_insert")
+@event.listens_for(dm.Region, "after_delete")
+def note_catalogue_insert_or_delete(mapper, connection, target):
+    note_catalogue_change(target)
+
+@event.listens_for(dm.Country, "after_update")
+@event.listens_for(dm.Region, "after_update")
+def note_catalogue_update(mapper, connection, target):
+    """ Only changes to names or countries of regions alter the catalogue """
+    attrs = inspect(target).attrs
+    changed = ['name'] + (['country_id', 'country'] if isinstance(target, dm.Region) else [])
+    if any(attrs[attr].history.has_changes() for attr in changed):
+        note_catalogue_change(target)
+
+@event.listens_for(Session, "after_transaction_end")
+def invalidate_catalogue(session, transaction):
+    if session.info.pop(CATALOGUE_SESSION_KEY, False):
+        catalogue.invalidate()
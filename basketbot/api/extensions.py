@@ -9,8 +9,10 @@ from flask_cors import cross_origin
 from basketbot import db
 from basketbot.api import api
 from basketbot.datamodel import model as dm
-from basketbot.schemas import SiteURL, ExtensionScrapingRule, IDArgs, FormRegion, CountryRegions, CountryRegionsDict, DeconstructedURL, RetailSiteRegionIDs
+from basketbot.schemas import SiteURL, ExtensionScrapingRule, RuleBundleArgs, IDArgs, FormRegion, CountryRegions, CountryRegionsDict, DeconstructedURL, RetailSiteRegionIDs
 from basketbot.util import decompose_url
+from basketbot.api.catalogue import catalogue
+from basketbot.api.ingest import RuleIngester, read_rules, read_ndjson
 # from flask_restx import Resource, Namespace
 
 # ns_ext = Namespace(
@@ -60,20 +62,19 @@ class DeconstructURL(MethodView):
 class Country(MethodView):
     @blp.response(200, CountryRegions(many=True))
     def get(self):
-        return dm.Country.query.all()
+        return catalogue.get('country').response()
 
 @blp.route('/countryregionsdict')
 class CountryRegionsDict(MethodView):
     # @blp.response(200, CountryRegionsDict(many=True))
     def get(self):
-         countries = CountryRegions(many=True).dump(dm.Country.query.all())
-         return {country.pop('name'): country for country in countries}
+        return catalogue.get('countryregionsdict').response()
 
 @blp.route('/region')
 class Region(MethodView):
     @blp.response(200, FormRegion(many=True))
     def get(self):
-        return dm.Region.query.all()
+        return catalogue.get('region').response()
 
 # TODO: Add user validation through oauth
 @blp.route('/scrapingrule', methods=['GET', 'POST', 'OPTIONS'])
@@ -92,3 +93,43 @@ class ScrapingRule(MethodView):
         db.session.add(data)
         db.session.commit()
         return data
+
+@blp.route('/scrapingrule/bulk')
+class ScrapingRuleBulk(MethodView):
+    def post(self):
+        """
+        Create many scraping rules from a JSON array, or an NDJSON stream
+        (Content-Type: application/x-ndjson) of rules. Valid rules are
+        created in one transaction (or none are if ?atomic=true and any rule
+        is invalid), and errors are returned by position of the rule
+        """
+        atomic = request.args.get('atomic', 'false').lower() in ('1', 'true', 'yes')
+        try:
+            if request.mimetype == 'application/x-ndjson':
+                rules = read_ndjson(request.stream)
+            else:
+                rules = read_rules(request.get_data())
+        except ValueError:
+            abort(400, 'Request body must be a JSON array or NDJSON stream of scraping rules')
+        if not isinstance(rules, list):
+            abort(400, 'Request body must be a JSON array or NDJSON stream of scraping rules')
+        return RuleIngester(atomic=atomic).ingest(rules).dump()
+
+@blp.route('/scrapingrule/bundle')
+class ScrapingRuleBundle(MethodView):
+    @blp.arguments(RuleBundleArgs, location='query')
+    @blp.response(200, ExtensionScrapingRule(many=True))
+    def get(self, args):
+        """
+        Get all scraping rules of a retail site (by URL or ID), or of all
+        sites if neither is given
+        """
+        retail_site_ids = None
+        if args.get('retail_site') is not None:
+            site = dm.RetailSite.get_site_from_url(args['retail_site'])
+            if site is None:
+                abort(404, 'No retail site associated with URL found in BasketBot')
+            retail_site_ids = [site.id]
+        elif args.get('retail_site_id') is not None:
+            retail_site_ids = [args['retail_site_id']]
+        return dm.ScrapingRule.bundle_query(retail_site_ids).all()
@@ -0,0 +1,208 @@
+"""
+Bulk ingestion of scraping rules.
+
+Onboarding a retailer means submitting hundreds of exception rules. Rather
+than validating and committing them one request at a time, RuleIngester
+validates a whole array (or NDJSON stream) of rules in the format used by
+ExtensionScrapingRule against the cached DOM tag and site URL lookups, and
+inserts the valid ones in batches within one transaction, reporting errors
+per rule.
+"""
+
+import json
+from collections import namedtuple
+from marshmallow import ValidationError
+from sqlalchemy.exc import IntegrityError
+from basketbot import db, InvalidDOMElem, InvalidClassChain, InvalidRetailSiteURL, InvalidURL
+from basketbot.datamodel import model as dm
+from basketbot.schemas import ExtensionScrapingRule
+
+RULE_ERRORS = (ValidationError, InvalidDOMElem, InvalidClassChain, InvalidRetailSiteURL, InvalidURL)
+
+# Errors of the rule at position index in the submitted rules
+RuleError = namedtuple('RuleError', ['index', 'errors'])
+
+def _item_key(item):
+    """ Whether an entry of a rules items is an Item name or id """
+    return isinstance(item, str) or (isinstance(item, int) and not isinstance(item, bool))
+
+class IngestResult(namedtuple('IngestResult', ['created', 'errors'])):
+    """
+    Short Summary
+    -------------
+    Outcome of ingesting a list of rules
+
+    Extended Summary
+    ----------------
+    created - list of the ids of the created rules, by position in the
+        submitted rules (None for rules that were not created)
+    errors - list of RuleError for rules that were not created
+    """
+    __slots__ = ()
+
+    def dump(self):
+        return {
+                'created': self.created,
+                'errors': [error._asdict() for error in self.errors],
+                }
+
+def read_rules(text):
+    """
+    Short Summary
+    -------------
+    Read rules from a JSON array or NDJSON (one rule per line) text, giving
+    a list of rules. Lines of NDJSON that are not valid JSON are given as
+    RuleError objects, so they are reported alongside the other rules
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    if text.lstrip().startswith('['):
+        return json.loads(text)
+    return read_ndjson(text.splitlines())
+
+def read_ndjson(lines):
+    """ Read rules from an iterable of NDJSON lines (str or bytes) """
+    rules = []
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            rules.append(json.loads(line))
+        except json.JSONDecodeError as err:
+            rules.append(RuleError(len(rules), {'_json': [str(err)]}))
+    return rules
+
+class RuleIngester:
+    """
+    Short Summary
+    -------------
+    Validate and insert many scraping rules in one transaction
+
+    Extended Summary
+    ----------------
+    Each rule is a dict in the format accepted by ExtensionScrapingRule, with
+    items given as a list of Item names (or ids). Items are looked up with one
+    query per batch, and DOM tags and retail sites through dm.dom_tags and
+    dm.site_url_index. Default and exception rules are checked for the same
+    constraints as check_scraping_rule_for_default before they are added, so
+    one bad rule does not abort a flush. Batches are flushed inside a
+    savepoint, and if the database still rejects a batch its rules are
+    retried one at a time to find the ones at fault.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.Session
+        Session to insert rules with (default: db.session)
+    batch_size : int
+        Number of rules flushed at a time
+    atomic : bool
+        If True then nothing is inserted if any rule has errors (rules are
+        all validated before any are inserted)
+    """
+    def __init__(self, session=None, batch_size=200, atomic=False):
+        self.session = session or db.session
+        self.batch_size = batch_size
+        self.atomic = atomic
+        self.schema = ExtensionScrapingRule()
+
+    def ingest(self, rules):
+        """ Ingest a list of rules, returning an IngestResult """
+        created = [None] * len(rules)
+        errors = []
+        batches = []
+        for start in range(0, len(rules), self.batch_size):
+            batch = list(enumerate(rules[start:start + self.batch_size], start))
+            valid = []
+            items = self._items(batch)
+            # Rules are only flushed by _flush, inside a savepoint
+            with self.session.no_autoflush:
+                for index, data in batch:
+                    if isinstance(data, RuleError):
+                        errors.append(data._replace(index=index))
+                        continue
+                    try:
+                        valid.append((index, *self._load(data, items)))
+                    except RULE_ERRORS as err:
+                        errors.append(RuleError(index, getattr(err, 'messages', None) or {'_rule': [str(err)]}))
+            batches.append(valid)
+        if errors and self.atomic:
+            return IngestResult(created, sorted(errors, key=lambda error: error.index))
+        for valid in batches:
+            for index, rule in self._flush(valid, errors):
+                created[index] = rule.id
+        errors.sort(key=lambda error: error.index)
+        if errors and self.atomic:
+            self.session.rollback()
+            created = [None] * len(rules)
+        else:
+            self.session.commit()
+        return IngestResult(created, errors)
+
+    def _items(self, batch):
+        """ Look up all Items referred to in a batch of rules """
+        names, ids = set(), set()
+        for _, data in batch:
+            if isinstance(data, dict) and isinstance(data.get('items'), list):
+                for item in filter(_item_key, data['items']):
+                    (names if isinstance(item, str) else ids).add(item)
+        if not names and not ids:
+            return {}
+        query = dm.Item.query.filter(dm.Item.name.in_(names) | dm.Item.id.in_(ids))
+        items = {}
+        for item in query:
+            items[item.name] = items[item.id] = item
+        return items
+
+    def _load(self, data, items):
+        if not isinstance(data, dict):
+            raise ValidationError('Scraping rule must be an object')
+        data = dict(data)
+        item_keys = data.pop('items', None) or []
+        if not isinstance(item_keys, list):
+            raise ValidationError({'items': ['Not a valid list.']})
+        invalid = [key for key in item_keys if not _item_key(key)]
+        if invalid:
+            raise ValidationError({'items': [f'Items must be given by name or id: {invalid}']})
+        missing = [key for key in item_keys if key not in items]
+        if missing:
+            raise ValidationError({'items': [f'Unknown items: {missing}']})
+        rule = self.schema.load(data, session=self.session)
+        if rule.default_rule and item_keys:
+            raise ValidationError({'items': ['A default scraping rule cannot be related to specific items']})
+        if not rule.default_rule and not item_keys:
+            raise ValidationError({'items': ['A non-default scraping rule must be related to at least one item']})
+        return rule, list({items[key].id: items[key] for key in item_keys}.values())
+
+    def _flush(self, valid, errors):
+        """ Insert a batch of rules, returning the (index, rule) pairs inserted """
+        if self._try_flush([entry[1:] for entry in valid]):
+            return [(index, rule) for index, rule, _ in valid]
+        inserted = []
+        for index, rule, items in valid:
+            if self._try_flush([(rule, items)]):
+                inserted.append((index, rule))
+            else:
+                errors.append(RuleError(index, {'_rule': ['Scraping rule was rejected by the database']}))
+        return inserted
+
+    def _try_flush(self, entries):
+        """ Flush a list of (rule, items) in a savepoint, returning whether it succeeded """
+        if not entries:
+            return True
+        savepoint = self.session.begin_nested()
+        try:
+            for rule, items in entries:
+                rule.items = items
+            self.session.add_all([rule for rule, _ in entries])
+            self.session.flush()
+        except IntegrityError:
+            savepoint.rollback()
+            for rule, _ in entries:
+                rule.items = [] # Stop it being cascaded back in by its items
+                if rule in self.session:
+                    self.session.expunge(rule)
+            return False
+        savepoint.commit()
+        return True
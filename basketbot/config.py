@@ -5,6 +5,46 @@ class Config(object):
     CONFIG_NAME = "base"
     TESTING = False
     STATIC_FOLDER = os.path.realpath(os.path.join(__file__, "../static"))
+    # HTML parser used by scrapers (see basketbot.scrapers.parsers)
+    SCRAPER_PARSER_BACKEND = "bs4"
+    # Shared HTTP client connection pooling (see basketbot.util.http)
+    HTTP_POOL_MAXSIZE = 10
+    HTTP_TIMEOUT = 10
+    HTTP_USER_AGENT = None
+    HTTP_MAX_RETRIES = 0
+    # Caching of the protocol supported by hosts of URLs given without one,
+    # and the probes that find it (see basketbot.util.protocols)
+    PROTOCOL_CACHE_TTL = 86400
+    PROTOCOL_CACHE_NEGATIVE_TTL = 3600
+    PROTOCOL_PROBE_TIMEOUT = 2
+    # Local public suffix list used to split hostnames (None to use the
+    # snapshot bundled with tldextract, see basketbot.util.domains). The list
+    # is never downloaded
+    TLD_SUFFIX_LIST = None
+    TLD_INCLUDE_PRIVATE_DOMAINS = False
+    TLD_CACHE_SIZE = 4096
+    # Seconds that the rules of a retail site are cached for (see
+    # basketbot.datamodel.RuleIndex). Changes made through this processes
+    # sessions are seen straight away, and other changes within this time
+    RULE_INDEX_MAX_AGE = 60
+    # Seconds after which the index from URLs to retail sites is reloaded
+    # (see basketbot.datamodel.SiteURLIndex), with the same caveat
+    SITE_URL_INDEX_MAX_AGE = 300
+    # Seconds that the country and region catalogue is cached for (see
+    # basketbot.api.catalogue), with the same caveat
+    CATALOGUE_MAX_AGE = 300
+    # Concurrency limits and timeout (seconds) for fetching pages to scrape
+    SCRAPER_MAX_CONCURRENCY = 32
+    SCRAPER_SITE_CONCURRENCY = 4
+    SCRAPER_FETCH_TIMEOUT = 10
+    # Minimum time (seconds) between scrapes handed out for the same domain,
+    # with per domain overrides (see basketbot.scrapers.scheduler)
+    SCRAPER_DOMAIN_INTERVAL = 1.0
+    SCRAPER_DOMAIN_INTERVALS = {}
+    # Directory to save compressed snapshots of fetched pages in (disabled if
+    # None) and compression to use ('gzip' or 'zstd')
+    SCRAPER_SNAPSHOT_DIR = None
+    SCRAPER_SNAPSHOT_COMPRESSION = "gzip"
     # REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
 
 class Production(Config):
@@ -1,7 +1,10 @@
 from datetime import datetime as dtime, timedelta
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
 import pytz
-from sqlalchemy import ForeignKey, CheckConstraint, event, inspect, and_
-from sqlalchemy.orm import relationship, backref, mapper, configure_mappers
+from sqlalchemy import ForeignKey, CheckConstraint, Index, DDL, event, inspect, and_
+from sqlalchemy.orm import relationship, backref, mapper, configure_mappers, object_session, joinedload, selectinload, Session
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import Column, Integer, String, Text, Boolean, Float, Numeric, Date, BigInteger, Sequence, DateTime, Table, Binary, Interval
@@ -10,6 +13,8 @@ from flask_security import UserMixin, RoleMixin
 from basketbot import db, DefaultRuleNotUnique
 from basketbot.datamodel.types import SJSON
 from basketbot.util import setup_schema, decompose_url
+from basketbot.scrapers.rules import rule_cache
+from basketbot.scrapers.fingerprint import Fingerprint
 
 # Helpers
 
@@ -162,6 +167,7 @@ class RetailSite(Base):
     basket_url = Column(String(20832), nullable=True)
     basket_version = Column(Integer)
     basket = Column(SJSON)
+    parser_backend = Column(String(20), nullable=True) # Overrides SCRAPER_PARSER_BACKEND config if set
 
     scraping_rules = relationship('ScrapingRule', back_populates='retail_site')
 
@@ -172,13 +178,7 @@ class RetailSite(Base):
         -------------
         Get the default scraping rule associated with this retail website 
         """
-        rule = [rule for rule in self.scraping_rules if rule.default_rule] 
-        if len(rule)==0:
-            raise DefaultRuleNotUnique(f'Retail site {self.id} does not have an associated default scraping rule')
-        elif len(rule)>1:
-            raise DefaultRuleNotUnique(f'Retail site {self.id} is associated with more than one default scraping rule')
-        else:
-            return rule[0]
+        return self._get_rule(rule_index.site(self.id, self._session()).default_rule_id)
 
     @property
     def exception_rules(self):
@@ -190,6 +190,19 @@ class RetailSite(Base):
         """
         return [rule for rule in self.scraping_rules if not rule.default_rule] 
 
+    @property
+    def basket_items(self):
+        """
+        Short Summary
+        -------------
+        Get all items in the baskets of the regions served by this site
+        (including items flagged as being in all regions)
+        """
+        region_ids = [region.id for region in self.regions]
+        return Item.query.filter(
+                Item.all_regions | Item.regions.any(Region.id.in_(region_ids))
+                ).order_by(Item.id).all()
+
     def get_item_rule(self, item):
         """
         Short Summary
@@ -206,9 +219,30 @@ class RetailSite(Base):
         """
         # Get the item ID
         item_id = item if isinstance(item, int) else item.id
-        # Should really be doing all this DB side
-        exception_rule = [r for r in self.exception_rules if item_id in map(lambda x: x.id, r.items)]
-        return exception_rule[0] if len(exception_rule)==1 else self.default_rule
+        return self._get_rule(rule_index.rule_id(self.id, item_id, self._session()))
+
+    def get_item_rules(self, items):
+        """
+        Short Summary
+        -------------
+        Get the scraping rules for many items at once, as a dict from Item id
+        to ScrapingRule (see get_item_rule)
+        """
+        site_rules = rule_index.site(self.id, self._session())
+        rules = {rule.id: rule for rule in self.scraping_rules}
+        item_ids = [item if isinstance(item, int) else item.id for item in items]
+        resolved = {}
+        for item_id in item_ids:
+            rule_id = site_rules.rule_id(item_id)
+            resolved[item_id] = rules[rule_id] if rule_id in rules else self._get_rule(rule_id)
+        return resolved
+
+    def _session(self):
+        return object_session(self) or db.session
+
+    def _get_rule(self, rule_id):
+        # Rules are normally already loaded in the identity map
+        return self._session().query(ScrapingRule).get(rule_id)
 
     # url_params = relationship('ItemURL', back_populates='retail_site')
 
@@ -245,18 +279,35 @@ class RetailSite(Base):
         -------------
         Takes a URL string, extracts the base URL (if necessary)
         and then compares for entries in DB
+
+        Extended Summary
+        ----------------
+        Sites are looked up in site_url_index rather than queried for on
+        every call
         """
         rslt = decompose_url(url_str)
-        sites = cls.query.filter(and_(
-            cls.url_protocol == rslt['protocol'],
-            cls.url_subdomain == rslt['subdomain'],
-            cls.url_domain == rslt['domain'],
-            cls.url_suffix == rslt['suffix'],
+        return site_url_index.get(url_key(rslt))
+
+    @classmethod
+    def find_by_url_key(cls, key, session=None):
+        """
+        Short Summary
+        -------------
+        Query the DB for the site with a (protocol, subdomain, domain, suffix)
+        tuple, returning None if there is no such site
+        """
+        protocol, subdomain, domain, suffix = key
+        query = session.query(cls) if session is not None else cls.query
+        sites = query.filter(and_(
+            cls.url_protocol == protocol,
+            cls.url_subdomain == subdomain,
+            cls.url_domain == domain,
+            cls.url_suffix == suffix,
             )).all()
         if len(sites)==0:
             return None
         elif len(sites)>1:
-            raise IntegrityError('More than one site found with specified URL')
+            raise IntegrityError('More than one site found with specified URL', None, None)
         else:
             return sites[0]
 
@@ -278,6 +329,112 @@ def check_item_for_region(mapper, connection, target):
     if not any([isinstance(r, Region) for r in target.regions]):
         raise IntegrityError("Item objects must contain at least one Region object in their region relationship", None, None)
 
+# Item change tracking
+#
+# Regions whose baskets are changed by edits to Items are tracked with
+# attribute events on Item.name and Item.regions, so that the cost is paid by
+# the items that actually change rather than by scanning every object in the
+# session on each flush. Changes are held per Item in Session.info (or on the
+# Item itself until it is added to a session) until it is flushed, when its
+# affected regions (ids, or Regions not yet given an id) are moved into
+# Session.info for update_basket_versions.
+
+ALTERED_REGIONS_SESSION_KEY = 'altered_regions'
+ITEM_CHANGES_SESSION_KEY = 'item_changes'
+
+class ItemChanges:
+    """
+    Basket changes made to an Item since it was last flushed. removed holds
+    regions taken off the item, and all_regions is set if the change (a new
+    name or added region) affects every region the item is in
+    """
+    __slots__ = ('removed', 'all_regions')
+
+    def __init__(self):
+        self.removed = set()
+        self.all_regions = False
+
+    def update(self, other):
+        self.removed.update(other.removed)
+        self.all_regions = self.all_regions or other.all_regions
+
+def _changes(item):
+    session = object_session(item)
+    if session is None:
+        # Moved into the session by attach_item_changes
+        changes = item.__dict__.get('_basket_changes')
+        if changes is None:
+            changes = item._basket_changes = ItemChanges()
+        return changes
+    pending = session.info.setdefault(ITEM_CHANGES_SESSION_KEY, {})
+    changes = pending.get(item)
+    if changes is None:
+        changes = pending[item] = ItemChanges()
+    return changes
+
+def _pop_changes(item):
+    session = object_session(item)
+    if session is None:
+        return None
+    return session.info.get(ITEM_CHANGES_SESSION_KEY, {}).pop(item, None)
+
+@event.listens_for(Item.name, "set")
+def track_item_rename(target, value, oldvalue, initiator):
+    if value != oldvalue:
+        _changes(target).all_regions = True
+
+@event.listens_for(Item.regions, "append")
+def track_item_region_added(target, value, initiator):
+    _changes(target).all_regions = True
+
+@event.listens_for(Item.regions, "remove")
+def track_item_region_removed(target, value, initiator):
+    _changes(target).removed.add(value)
+
+@event.listens_for(Session, "before_attach")
+def attach_item_changes(session, instance):
+    """ Move the changes of an Item made before it had a session into Session.info """
+    changes = instance.__dict__.pop('_basket_changes', None) if isinstance(instance, Item) else None
+    if changes is not None:
+        pending = session.info.setdefault(ITEM_CHANGES_SESSION_KEY, {})
+        pending.setdefault(instance, ItemChanges()).update(changes)
+
+def _note_altered_regions(target, regions):
+    session = object_session(target)
+    if session is None or not regions:
+        return
+    session.info.setdefault(ALTERED_REGIONS_SESSION_KEY, set()).update(
+            region.id if region.id is not None else region for region in regions
+            )
+
+@event.listens_for(Item, "after_insert")
+@event.listens_for(Item, "after_update")
+def note_item_changes(mapper, connection, target):
+    """
+    Move the regions affected by a flushed Item into Session.info. New and
+    renamed items, and items added to a region, affect all of their regions
+    """
+    changes = _pop_changes(target)
+    if changes is None:
+        return
+    regions = changes.removed
+    if changes.all_regions:
+        regions = regions.union(target.regions)
+    _note_altered_regions(target, regions)
+
+@event.listens_for(Item, "after_delete")
+def note_item_delete(mapper, connection, target):
+    """ Deleting an item alters the basket of each of its regions """
+    changes = _pop_changes(target)
+    regions = set(target.regions)
+    if changes is not None:
+        regions.update(changes.removed)
+    _note_altered_regions(target, regions)
+
+def discard_item_changes(session):
+    """ Forget unflushed Item changes of a session, eg: after a rollback """
+    session.info.pop(ITEM_CHANGES_SESSION_KEY, None)
+
 class HistoricalBaskets(Base):
     __tablename__ = 'historical_baskets'
     id = Column(Integer, primary_key=True)
@@ -286,6 +443,140 @@ class HistoricalBaskets(Base):
 
     region = relationship('Region', back_populates='historical_baskets', uselist=None)
 
+class PriceObservation(Base):
+    """
+    Short Summary
+    -------------
+    The price of an Item on a RetailSite, for one of the Regions it serves,
+    at the time it was observed
+
+    Extended Summary
+    ----------------
+    One row per observation, rather than a JSON basket per region, so that
+    the history of an item can be read with an index range scan (see
+    history). Rows are keyed by (item, retail site, region, observed_at), and
+    prices are in the currency given by currency_id (the currency the price
+    was parsed in).
+
+    On Postgres the table is partitioned by range of observed_at. Rows go to
+    the price_observation_default partition unless a partition covering their
+    time has been created with create_partition, so partitions should be
+    created ahead of the times they cover. create_month_partitions does this
+    for the coming months, and is run by each scrape cycle and by
+    `bb db partitions`.
+    """
+    __tablename__ = 'price_observation'
+    __table_args__ = (
+            Index('ix_price_observation_site_item_time', 'retail_site_id', 'item_id', 'observed_at'),
+            Index('ix_price_observation_region_time', 'region_id', 'observed_at'),
+            {'postgresql_partition_by': 'RANGE (observed_at)'},
+            )
+    item_id = Column(Integer, ForeignKey('item.id'), primary_key=True)
+    retail_site_id = Column(Integer, ForeignKey('retail_site.id'), primary_key=True)
+    region_id = Column(Integer, ForeignKey('region.id'), primary_key=True)
+    observed_at = Column(DateTime(timezone=True), primary_key=True, default=now)
+    price = Column(Numeric(precision=12, scale=2), nullable=False)
+    currency_id = Column(Integer, ForeignKey('currency.id'), nullable=True)
+
+    item = relationship('Item')
+    retail_site = relationship('RetailSite')
+    region = relationship('Region')
+    currency = relationship('Currency')
+
+    @classmethod
+    def history(cls, item, retail_site, since=None, until=None, region=None, session=None):
+        """
+        Short Summary
+        -------------
+        Query the observations of an item on a retail site, oldest first
+
+        Parameters
+        ----------
+        item, retail_site, region : ORM object or int
+            Item, RetailSite and (optionally) Region, or their ids
+        since, until : datetime.datetime
+            Only include observations at or after since, and before until
+        """
+        session = session or db.session
+        ident = lambda obj: obj if isinstance(obj, int) else obj.id
+        query = session.query(cls).filter(
+                cls.item_id == ident(item),
+                cls.retail_site_id == ident(retail_site)
+                )
+        if region is not None:
+            query = query.filter(cls.region_id == ident(region))
+        if since is not None:
+            query = query.filter(cls.observed_at >= since)
+        if until is not None:
+            query = query.filter(cls.observed_at < until)
+        return query.order_by(cls.observed_at)
+
+    @classmethod
+    def create_partition(cls, start, end, session=None):
+        """
+        Short Summary
+        -------------
+        Create a partition (on Postgres) for observations from start until
+        end, returning its name, or None on other databases
+
+        Extended Summary
+        ----------------
+        Postgres refuses to create a partition if the default partition
+        already holds rows in its range.
+        """
+        session = session or db.session
+        if session.get_bind().dialect.name != 'postgresql':
+            return None
+        name = f'{cls.__tablename__}_{start:%Y%m%d}_{end:%Y%m%d}'
+        session.execute(
+                f'CREATE TABLE IF NOT EXISTS {name} PARTITION OF {cls.__tablename__} '
+                'FOR VALUES FROM (:start) TO (:end)',
+                {'start': start, 'end': end}
+                )
+        return name
+
+    @classmethod
+    def create_month_partitions(cls, months_ahead=1, now=None, session=None):
+        """
+        Short Summary
+        -------------
+        Create the monthly partitions (on Postgres) of the current month and
+        the months_ahead months after it that do not exist yet, returning the
+        names of the partitions created
+
+        Extended Summary
+        ----------------
+        A month that already has rows in the default partition is skipped, as
+        Postgres would refuse to create its partition.
+        """
+        session = session or db.session
+        if session.get_bind().dialect.name != 'postgresql':
+            return []
+        now = now or dtime.now(pytz.utc)
+        year, month = now.year, now.month
+        created = []
+        for _ in range(months_ahead + 1):
+            start = dtime(year, month, 1, tzinfo=pytz.utc)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+            end = dtime(year, month, 1, tzinfo=pytz.utc)
+            name = f'{cls.__tablename__}_{start:%Y%m%d}_{end:%Y%m%d}'
+            if session.execute('SELECT to_regclass(:name)', {'name': name}).scalar() is not None:
+                continue
+            in_default = session.execute(
+                    f'SELECT EXISTS (SELECT 1 FROM {cls.__tablename__}_default '
+                    'WHERE observed_at >= :start AND observed_at < :end)',
+                    {'start': start, 'end': end}
+                    ).scalar()
+            if not in_default:
+                created.append(cls.create_partition(start, end, session))
+        return created
+
+event.listen(
+        PriceObservation.__table__,
+        'after_create',
+        DDL('CREATE TABLE %(table)s_default PARTITION OF %(table)s DEFAULT').execute_if(dialect='postgresql')
+        )
+
 # class ItemURL(Base):
 #     """
 #     Store an item URL. Generally should be constructed as a set of params 
@@ -339,7 +630,8 @@ class DOMElem(Base):
         Short Summary
         -------------
         Generate a dictionary lookup table for converting between
-        all accepted beautifulsoup and javascript tag notations
+        all accepted beautifulsoup and javascript tag notations (from
+        dom_tags, so without querying the DB once it is loaded)
 
         Parameters
         ----------
@@ -347,11 +639,8 @@ class DOMElem(Base):
             If True then dict has JS notations as keys, if False then
             BS notations are keys (default: True)
         """
-        elems = cls.query.all()
-        if js_first:
-            return {elem.js_name: elem.bs_name}
-        else:
-            return {elem.bs_name: elem.js_name}
+        tags = dom_tags.get()
+        return dict(tags.js_to_bs if js_first else tags.bs_to_js)
 
 class ScrapingRule(Base):
     """
@@ -388,13 +677,15 @@ class ScrapingRule(Base):
     #         CheckConstraint('NOT(default=1 AND parent_elem_id!=1)'), 
     #         )
     id = Column(Integer, primary_key=True)
-    update_time = db.Column(DateTime(timezone=True), nullable=False, default=now, index=True)
+    update_time = db.Column(DateTime(timezone=True), nullable=False, default=now, onupdate=now, index=True)
     user_id = Column(Integer, ForeignKey('user.id'))
     retail_site_id = Column(Integer, ForeignKey('retail_site.id'), nullable=False)
     default_rule = Column(Boolean, default=False, nullable=False)
     parent_elem_id = Column(Integer, ForeignKey('dom_elem.id'), nullable=False)
     parent_id = Column(Text)
     class_chain = Column(SJSON, nullable=False)
+    # Set when the page layout around the rule changes (see RuleFingerprint)
+    possibly_broken = Column(Boolean, default=False, nullable=False)
 
     parent_elem = relationship('DOMElem')
     user = relationship('User', back_populates='scraping_rules')
@@ -404,6 +695,7 @@ class ScrapingRule(Base):
             secondary=ScrapingRuleItem,
             backref='scraping_rules'
             )
+    fingerprints = relationship('RuleFingerprint', back_populates='scraping_rule', cascade='all, delete-orphan')
 
     @classmethod
     def create_rule():
@@ -416,13 +708,518 @@ class ScrapingRule(Base):
         """
         pass
 
-    def get_rule():
+    @classmethod
+    def bundle_query(cls, retail_site_ids=None):
+        """
+        Short Summary
+        -------------
+        Query for scraping rules (of some retail site ids, or all sites) with
+        their retail site, parent element and items eagerly loaded, so that
+        serializing them needs no further queries
+        """
+        query = cls.query.options(
+                joinedload(cls.retail_site),
+                joinedload(cls.parent_elem),
+                selectinload(cls.items)
+                )
+        if retail_site_ids is not None:
+            query = query.filter(cls.retail_site_id.in_(list(retail_site_ids)))
+        return query.order_by(cls.retail_site_id, cls.id)
+
+    def get_rule(self):
         """
         Convenience for extracting the formatted data needed for 
-        traversing a DOM
+        traversing a DOM. Returns a basketbot.scrapers.rules.CompiledRule,
+        which is cached until the rules update_time changes
         """
-        pass
+        return rule_cache.get(self)
 
+@event.listens_for(ScrapingRule.parent_id, "set")
+@event.listens_for(ScrapingRule.parent_elem_id, "set")
+@event.listens_for(ScrapingRule.class_chain, "set")
+def reset_possibly_broken(target, value, oldvalue, initiator):
+    """
+    Clear the possibly_broken flag of a rule when it is edited (fingerprints
+    of the old version of the rule are ignored once its update_time changes)
+    """
+    target.possibly_broken = False
+
+class RuleFingerprint(Base):
+    """
+    Short Summary
+    -------------
+    The structural fingerprint of the last match of a ScrapingRule on a page
+
+    Extended Summary
+    ----------------
+    See basketbot.scrapers.fingerprint. rule_update_time is the update_time of
+    the rule when the fingerprint was taken, so that fingerprints of an older
+    version of a rule are not used. value holds whatever was derived from
+    raw_text (eg: the parsed price), to be reused whilst the fingerprint and
+    text are unchanged.
+    """
+    __tablename__ = 'rule_fingerprint'
+    __table_args__ = (
+            UniqueConstraint(
+                'scraping_rule_id',
+                'url',
+                name='_rule_fingerprint_url_uc'
+                ),
+            )
+    id = Column(Integer, primary_key=True)
+    scraping_rule_id = Column(Integer, ForeignKey('scraping_rule.id'), nullable=False)
+    url = Column(Text, nullable=False)
+    rule_update_time = Column(DateTime(timezone=True), nullable=False)
+    digest = Column(String(32), nullable=False)
+    path = Column(SJSON, nullable=False)
+    raw_text = Column(Text, nullable=True)
+    value = Column(SJSON, nullable=True)
+    update_time = db.Column(DateTime(timezone=True), nullable=False, default=now, onupdate=now)
+
+    scraping_rule = relationship('ScrapingRule', back_populates='fingerprints')
+
+    def get_fingerprint(self):
+        """ Get as a basketbot.scrapers.fingerprint.Fingerprint """
+        return Fingerprint(self.digest, tuple(self.path), self.raw_text, self.value)
+
+    def set_fingerprint(self, fingerprint, rule_update_time):
+        """ Update from a basketbot.scrapers.fingerprint.Fingerprint """
+        self.digest = fingerprint.digest
+        self.path = list(fingerprint.path)
+        self.raw_text = fingerprint.text
+        self.value = fingerprint.value
+        self.rule_update_time = rule_update_time
+
+
+# DOM tag registry
+
+class DOMTags:
+    """
+    Short Summary
+    -------------
+    Snapshot of the DOMElem table as sets and lookup dicts
+
+    Extended Summary
+    ----------------
+    Built from (id, bs_name, js_name) rows ordered by id. Where a tag is
+    listed more than once the row with the lowest id is used.
+    """
+    __slots__ = ('js_names', 'bs_names', 'js_to_bs', 'bs_to_js', 'js_ids', 'id_to_js')
+
+    def __init__(self, rows):
+        self.js_to_bs = {}
+        self.bs_to_js = {}
+        self.js_ids = {}
+        self.id_to_js = {}
+        for elem_id, bs_name, js_name in rows:
+            self.js_to_bs.setdefault(js_name, bs_name)
+            self.bs_to_js.setdefault(bs_name, js_name)
+            self.js_ids.setdefault(js_name, elem_id)
+            self.id_to_js[elem_id] = js_name
+        self.js_names = frozenset(self.js_to_bs)
+        self.bs_names = frozenset(self.bs_to_js)
+
+class DOMTagRegistry:
+    """
+    Short Summary
+    -------------
+    Process wide cache of the DOMElem table
+
+    Extended Summary
+    ----------------
+    The table is loaded with one query the first time it is needed, and the
+    DOMTags snapshot is shared until a DOMElem is inserted, updated or
+    deleted through the ORM, at which point it is dropped (and dropped again
+    when that transaction ends, in case the change was rolled back).
+    """
+    def __init__(self):
+        self._tags = None
+        self._lock = Lock()
+
+    def get(self, session=None):
+        """ Get the current DOMTags, loading them if necessary """
+        tags = self._tags
+        if tags is None:
+            session = session or db.session
+            rows = session.query(DOMElem.id, DOMElem.bs_name, DOMElem.js_name).order_by(DOMElem.id)
+            tags = DOMTags(rows)
+            with self._lock:
+                self._tags = tags
+        return tags
+
+    def invalidate(self):
+        with self._lock:
+            self._tags = None
+
+dom_tags = DOMTagRegistry()
+
+DOM_TAGS_SESSION_KEY = 'dom_tags_changed'
+
+@event.listens_for(DOMElem, "after_insert")
+@event.listens_for(DOMElem, "after_update")
+@event.listens_for(DOMElem, "after_delete")
+def note_dom_elem_change(mapper, connection, target):
+    """
+    Drop dom_tags now, and note in Session.info that it should be dropped
+    again once the transaction ends
+    """
+    dom_tags.invalidate()
+    session = object_session(target)
+    if session is not None:
+        session.info[DOM_TAGS_SESSION_KEY] = True
+
+# Scraping rule resolution
+
+class SiteRules:
+    """
+    Short Summary
+    -------------
+    Which scraping rule applies to each item on one retail site
+
+    Extended Summary
+    ----------------
+    Built from the scraping rules of a site and their scraping_rule_item rows
+    by RuleIndex. Resolution follows RetailSite.get_item_rule: an item with
+    exactly one exception rule uses it, and any other item uses the sites
+    default rule. All values are ScrapingRule ids.
+    """
+    __slots__ = ('retail_site_id', 'default_rule_ids', 'exception_rule_ids', 'item_rules', 'built_at')
+
+    def __init__(self, retail_site_id, rows):
+        self.retail_site_id = retail_site_id
+        self.default_rule_ids = []
+        self.exception_rule_ids = []
+        exceptions = {}
+        for rule_id, default_rule, item_id in rows:
+            rules = self.default_rule_ids if default_rule else self.exception_rule_ids
+            if rule_id not in rules:
+                rules.append(rule_id)
+            if not default_rule and item_id is not None:
+                exceptions.setdefault(item_id, []).append(rule_id)
+        self.item_rules = {item_id: rules[0] for item_id, rules in exceptions.items() if len(rules) == 1}
+        self.built_at = dtime.utcnow()
+
+    @property
+    def default_rule_id(self):
+        if len(self.default_rule_ids) == 1:
+            return self.default_rule_ids[0]
+        if not self.default_rule_ids:
+            raise DefaultRuleNotUnique(f'Retail site {self.retail_site_id} does not have an associated default scraping rule')
+        raise DefaultRuleNotUnique(f'Retail site {self.retail_site_id} is associated with more than one default scraping rule')
+
+    def rule_id(self, item_id):
+        """ Get the id of the rule for an item id """
+        rule_id = self.item_rules.get(item_id)
+        return rule_id if rule_id is not None else self.default_rule_id
+
+class RuleIndex:
+    """
+    Short Summary
+    -------------
+    Process wide index of SiteRules, keyed by RetailSite id
+
+    Extended Summary
+    ----------------
+    A sites entry is built with a single query the first time it is needed,
+    after which resolving the rule for an item takes a dict lookup. Entries
+    are dropped after a transaction that inserted, updated or deleted a
+    ScrapingRule (including changes to its items) on the site, via the events
+    registered in register_events. Changes made outside the ORM (eg: bulk
+    updates, other workers or the scrape process) are not seen until
+    invalidate is called, or an entry is older than max_age seconds.
+
+    The module level instance (rule_index) takes max_age from the
+    RULE_INDEX_MAX_AGE config value in create_app.
+
+    Parameters
+    ----------
+    max_age : float
+        Maximum age in seconds of an entry before it is rebuilt (None to keep
+        entries until invalidated)
+    """
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._sites = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """ Configure the index from a Flask app config """
+        self.invalidate()
+        self.max_age = app.config.get('RULE_INDEX_MAX_AGE', self.max_age)
+
+    def site(self, retail_site_id, session=None):
+        """ Get the SiteRules for a RetailSite id """
+        site_rules = self._sites.get(retail_site_id)
+        if site_rules is None or self._expired(site_rules):
+            site_rules = self.load([retail_site_id], session)[retail_site_id]
+        return site_rules
+
+    def load(self, retail_site_ids, session=None):
+        """
+        Build (or rebuild) the entries of several RetailSite ids with one
+        query, returning a dict of SiteRules
+        """
+        session = session or db.session
+        retail_site_ids = list(retail_site_ids)
+        rows = {retail_site_id: [] for retail_site_id in retail_site_ids}
+        query = session.query(
+                ScrapingRule.retail_site_id,
+                ScrapingRule.id,
+                ScrapingRule.default_rule,
+                ScrapingRuleItem.c.item_id
+                ).outerjoin(
+                        ScrapingRuleItem, ScrapingRuleItem.c.scraping_rule_id == ScrapingRule.id
+                ).filter(
+                        ScrapingRule.retail_site_id.in_(retail_site_ids)
+                ).order_by(ScrapingRule.id)
+        for retail_site_id, rule_id, default_rule, item_id in query:
+            rows[retail_site_id].append((rule_id, default_rule, item_id))
+        built = {retail_site_id: SiteRules(retail_site_id, site_rows) for retail_site_id, site_rows in rows.items()}
+        with self._lock:
+            self._sites.update(built)
+        return built
+
+    def rule_id(self, retail_site_id, item_id, session=None):
+        """ Get the id of the ScrapingRule for an item id on a site """
+        return self.site(retail_site_id, session).rule_id(item_id)
+
+    def invalidate(self, retail_site_id=None):
+        """
+        Drop a single site (or all sites if retail_site_id is None) from the
+        index
+        """
+        with self._lock:
+            if retail_site_id is None:
+                self._sites.clear()
+            else:
+                self._sites.pop(retail_site_id, None)
+
+    def _expired(self, site_rules):
+        return self.max_age is not None and (dtime.utcnow() - site_rules.built_at).total_seconds() > self.max_age
+
+    def __len__(self):
+        return len(self._sites)
+
+rule_index = RuleIndex()
+
+RULE_INDEX_SESSION_KEY = 'rule_index_sites'
+
+@event.listens_for(ScrapingRule, "after_insert")
+@event.listens_for(ScrapingRule, "after_update")
+@event.listens_for(ScrapingRule, "after_delete")
+def note_rule_index_change(mapper, connection, target):
+    """
+    Note the retail sites of changed scraping rules in Session.info, so that
+    their rule_index entries are dropped once the transaction ends. Note that
+    after_update is also called for rules whose items have changed.
+    """
+    session = object_session(target)
+    if session is None:
+        rule_index.invalidate()
+        return
+    sites = session.info.setdefault(RULE_INDEX_SESSION_KEY, set())
+    sites.add(target.retail_site_id)
+    # The rule may have been moved from another site
+    sites.update(inspect(target).attrs.retail_site_id.history.deleted)
+
+@event.listens_for(Item, "after_delete")
+def note_item_rule_index_change(mapper, connection, target):
+    """ Deleting an item removes its scraping_rule_item rows """
+    session = object_session(target)
+    if session is None:
+        rule_index.invalidate()
+        return
+    session.info.setdefault(RULE_INDEX_SESSION_KEY, set()).update(
+            rule.retail_site_id for rule in target.scraping_rules
+            )
+
+# Retail site URL lookup
+
+URL_KEY_COLUMNS = ('url_protocol', 'url_subdomain', 'url_domain', 'url_suffix')
+
+def url_key(parts):
+    """
+    Short Summary
+    -------------
+    Get the (protocol, subdomain, domain, suffix) key of a URL from the dict
+    returned by basketbot.util.decompose_url
+    """
+    return (parts['protocol'], parts['subdomain'], parts['domain'], parts['suffix'])
+
+class SiteURLIndex:
+    """
+    Short Summary
+    -------------
+    Process wide index from URL keys to RetailSite ids
+
+    Extended Summary
+    ----------------
+    Keys are (protocol, subdomain, domain, suffix) tuples as built by url_key.
+    All sites are loaded with one query the first time the index is used,
+    after which a lookup costs a dict lookup plus Query.get, which does not
+    touch the DB if the site is already in the sessions identity map.
+
+    Inserts, URL changes and deletes of RetailSites made through the ORM are
+    applied once the transaction that made them commits, via the events
+    registered in register_events. Keys that are not in the index are looked
+    up in the DB, and misses are remembered for negative_ttl seconds (at most
+    max_negative of them), which bounds how long a site added by another
+    process can go unseen. A site whose URL no longer matches its key (eg:
+    changed by another process) is dropped as soon as it is found there, as
+    is one deleted by another process once Query.get fails to find it, and
+    the whole index is reloaded once it is older than max_age seconds.
+
+    The module level instance (site_url_index) takes max_age from the
+    SITE_URL_INDEX_MAX_AGE config value in create_app.
+
+    Parameters
+    ----------
+    max_age : float
+        Maximum age in seconds of the index before it is reloaded (None to
+        keep it until invalidated)
+    negative_ttl : float
+        Seconds for which a key with no site is remembered
+    max_negative : int
+        Maximum number of keys with no site to remember (oldest are dropped)
+    """
+    def __init__(self, max_age=300, negative_ttl=300, max_negative=10000):
+        self.max_age = max_age
+        self.negative_ttl = negative_ttl
+        self.max_negative = max_negative
+        self._sites = None
+        self._loaded_at = None
+        self._keys = {}
+        self._negative = OrderedDict()
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """ Configure the index from a Flask app config """
+        self.invalidate()
+        self.max_age = app.config.get('SITE_URL_INDEX_MAX_AGE', self.max_age)
+
+    def get(self, key, session=None):
+        """ Get the RetailSite for a URL key, or None if there is no such site """
+        session = session or db.session
+        sites = self._sites
+        if sites is None or self._expired():
+            sites = self.load(session)
+        site_id = sites.get(key)
+        if site_id is not None:
+            site = session.query(RetailSite).get(site_id)
+            if site is not None and site_url_key(site) == key:
+                return site
+            self.discard(site_id) # Deleted or moved elsewhere
+        elif self._is_negative(key):
+            return None
+        site = RetailSite.find_by_url_key(key, session)
+        with self._lock:
+            if site is None:
+                # A miss caused by this sessions own uncommitted changes
+                # would hide the site from other sessions
+                if session.info.get(SITE_URL_INDEX_SESSION_KEY):
+                    return None
+                self._negative[key] = monotonic() + self.negative_ttl
+                self._negative.move_to_end(key)
+                while len(self._negative) > self.max_negative:
+                    self._negative.popitem(last=False)
+            elif self._sites is not None:
+                # If this transaction is rolled back the key is dropped
+                # again by the next lookup, when Query.get finds nothing
+                self._add(key, site.id)
+        return site
+
+    def load(self, session=None):
+        """ (Re)load the index from the DB with a single query """
+        session = session or db.session
+        columns = [getattr(RetailSite, column) for column in URL_KEY_COLUMNS]
+        sites = {tuple(row[1:]): row[0] for row in session.query(RetailSite.id, *columns)}
+        with self._lock:
+            self._sites = sites
+            self._keys = {site_id: key for key, site_id in sites.items()}
+            self._negative.clear()
+            self._loaded_at = monotonic()
+        return sites
+
+    def apply(self, changes):
+        """
+        Apply committed changes, a list of (retail_site_id, key) tuples where
+        key is None for deleted sites
+        """
+        with self._lock:
+            for site_id, key in changes:
+                if self._sites is not None:
+                    self._discard(site_id)
+                    if key is not None:
+                        self._add(key, site_id)
+                if key is not None:
+                    self._negative.pop(key, None)
+
+    def discard(self, site_id):
+        """ Drop the key of a RetailSite id """
+        with self._lock:
+            if self._sites is not None:
+                self._discard(site_id)
+
+    def _add(self, key, site_id):
+        self._sites[key] = site_id
+        self._keys[site_id] = key
+
+    def _discard(self, site_id):
+        key = self._keys.pop(site_id, None)
+        if key is not None and self._sites.get(key) == site_id:
+            del self._sites[key]
+
+    def invalidate(self):
+        """ Drop the index and all remembered misses """
+        with self._lock:
+            self._sites = None
+            self._keys = {}
+            self._negative.clear()
+
+    def _expired(self):
+        return self.max_age is not None and monotonic() - self._loaded_at > self.max_age
+
+    def _is_negative(self, key):
+        expiry = self._negative.get(key)
+        if expiry is None:
+            return False
+        if expiry < monotonic():
+            with self._lock:
+                self._negative.pop(key, None)
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._sites) if self._sites is not None else 0
+
+site_url_index = SiteURLIndex()
+
+SITE_URL_INDEX_SESSION_KEY = 'site_url_changes'
+
+def note_site_url_change(target, key):
+    """
+    Note the URL key of an inserted or updated RetailSite (or None for a
+    deleted one) in Session.info so that site_url_index can be updated once
+    the transaction commits
+    """
+    session = object_session(target)
+    if session is None:
+        site_url_index.invalidate()
+        return
+    session.info.setdefault(SITE_URL_INDEX_SESSION_KEY, []).append((target.id, key))
+
+def site_url_key(site):
+    """ Get the URL key of a RetailSite from its URL columns """
+    return tuple(getattr(site, column) for column in URL_KEY_COLUMNS)
+
+@event.listens_for(RetailSite, "after_insert")
+@event.listens_for(RetailSite, "after_update")
+def note_site_url_save(mapper, connection, target):
+    note_site_url_change(target, site_url_key(target))
+
+@event.listens_for(RetailSite, "after_delete")
+def note_site_url_delete(mapper, connection, target):
+    note_site_url_change(target, None)
 
 # This listener needs to be added here to catch the mapper config trigger
 # early enough
@@ -431,11 +1228,59 @@ configure_mappers() # No idea why we need to manually call this
 
 # Events
 
+def bump_basket_versions(session, regions):
+    """
+    Short Summary
+    -------------
+    Increment the basket_version of a set of regions with a single UPDATE
+
+    Extended Summary
+    ----------------
+    The increment is done in the DB (basket_version = basket_version + 1), so
+    Regions do not need to be loaded or flushed, and concurrent transactions
+    bumping the same region cannot lose an increment. The bumped attributes
+    of any of the regions loaded in the session are expired, so they are
+    reloaded when next used.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.Session
+        Session whose transaction the update is made in
+    regions : iterable(basketbot.datamodel.Region or int)
+        Regions (or Region ids) to bump
+    """
+    regions = [region for region in regions if region is not None]
+    region_ids = {region.id if isinstance(region, Region) else region for region in regions}
+    region_ids.discard(None)
+    if not region_ids:
+        return
+    table = Region.__table__
+    session.execute(
+            table.update().where(
+                table.c.id.in_(sorted(region_ids))
+            ).values(
+                basket_version=table.c.basket_version + 1,
+                basket_version_update_time=now()
+            )
+            )
+    for region in regions:
+        if isinstance(region, Region) and region in session:
+            session.expire(region, ['basket_version', 'basket_version_update_time'])
+
+def is_outermost(transaction):
+    """
+    Whether a SessionTransaction is the outermost transaction of its session,
+    rather than a savepoint (begin_nested) or subtransaction within it
+    """
+    return transaction.parent is None
+
 # Note that these functions are defined here, but actually registered
 # in main basketbot __init__. This encapsulation allows also registering
-# events easily on pytest stateless DB sessions
-def register_events(session):
-    SESSION_INFO_KEY = 'altered_regions'
+# events easily on pytest stateless DB sessions, where each tests
+# transactions are savepoints, so outermost can be given to pick out
+# those that stand in for the outermost transaction
+def register_events(session, outermost=is_outermost):
+    SESSION_INFO_KEY = ALTERED_REGIONS_SESSION_KEY
 
     # Autogenerate marshmallow schemas from model
     # from basketbot.schemas import setup_schema
@@ -454,35 +1299,43 @@ def register_events(session):
     # We should really also do a check for when Items are inserted too in case one is associated with
     # a scraping rule from the other side
 
-    # Changed this from before_flush to after_flush as could not resolve some
-    # relations in before_flush (no autocommit?)
-    # @event.listens_for(session, "before_flush")
-    # def check_for_items(session, flush_context, instance):
-    @event.listens_for(session, "after_flush")
-    def check_for_items(session, flush_context):
-        """
-        Detect whether any items have been altered or addded during a flush
-        and take a note of their regions in the Session.info dict
-        """
-        altered_regions = set()
-        for _ in session.new.union(session.dirty):
-            if isinstance(_, Item):
-                state = inspect(_)
-                # Flag any regions with changed item names or new items
-                # NB: state.attrs.name.histroy.added also catches new items
-                if len(state.attrs.name.history.added)>0 or len(state.attrs.regions.history.added)>0:
-                    altered_regions.update(_.regions)
-                # Flag any regions removed from item
-                if len(state.attrs.regions.history.deleted)>0:
-                    altered_regions.update(state.attrs.regions.history.deleted)
-        for _ in session.deleted:
-            # Flag any regions with deleted items
-            if isinstance(_, Item):
-                altered_regions.update(_.regions)
-        if SESSION_INFO_KEY in session.info:
-            session.info[SESSION_INFO_KEY].update(altered_regions)
-        else:
-            session.info[SESSION_INFO_KEY] = altered_regions
+    @event.listens_for(session, "after_transaction_end")
+    def invalidate_rule_index(session, transaction):
+        """
+        Drop rule_index entries for sites whose scraping rules changed (and
+        dom_tags if any DOMElem changed), once the transaction that changed
+        them has been committed or rolled back. Savepoints ending are
+        ignored, as their changes are not yet visible to other sessions.
+        """
+        if not outermost(transaction):
+            return
+        for retail_site_id in session.info.pop(RULE_INDEX_SESSION_KEY, ()):
+            rule_index.invalidate(retail_site_id)
+        if session.info.pop(DOM_TAGS_SESSION_KEY, False):
+            dom_tags.invalidate()
+
+    @event.listens_for(session, "after_commit")
+    def update_site_url_index(session):
+        """
+        Apply committed RetailSite URL changes to site_url_index, once the
+        outermost transaction commits (session.transaction is still the
+        committed one here)
+        """
+        if not outermost(session.transaction):
+            return
+        if changes := session.info.pop(SITE_URL_INDEX_SESSION_KEY, None):
+            site_url_index.apply(changes)
+
+    @event.listens_for(session, "after_transaction_end")
+    def discard_site_url_changes(session, transaction):
+        """
+        Forget RetailSite URL changes that have not been applied once the
+        outermost transaction ends, as it has been rolled back. Changes
+        in a savepoint that is rolled back are kept until then, as lookups
+        drop any entry that no longer matches its site.
+        """
+        if outermost(transaction):
+            session.info.pop(SITE_URL_INDEX_SESSION_KEY, None)
 
     @event.listens_for(session, "after_rollback")
     def remove_items(session):
@@ -492,6 +1345,7 @@ def register_events(session):
         """
         if SESSION_INFO_KEY in session.info:
             del session.info[SESSION_INFO_KEY]
+        discard_item_changes(session)
 
     @event.listens_for(session, "before_commit")
     def update_basket_versions(session):
@@ -502,23 +1356,8 @@ def register_events(session):
         been added/edited.
         """
         session.flush() # see https://stackoverflow.com/a/36732359 for why this is here
-        # Should really optimize this all if it's going to run on every
-        # session flush (DB trigger?)
-        # altered_regions = set()
-        # for _ in session.new.union(session.dirty):
-        #     if isinstance(_, Item):
-        #         altered_regions.update(_.region)
-
-        if len(altered_regions:=session.info.get(SESSION_INFO_KEY, set()))>0:
-            for region in altered_regions:
-                region.basket_version += 1
-                # Trigger alerts for any regions with updated basket_versions
-                # could go here if there is not also an update in this commit 
-                # for their baskets
-            session.add_all(altered_regions)
-            # session.commit()
-            # session.flush()
-
-        # Make sure to clear altered_regions from session.info
-        if SESSION_INFO_KEY in session.info:
-            del session.info[SESSION_INFO_KEY]
+        if altered_regions := session.info.pop(SESSION_INFO_KEY, None):
+            bump_basket_versions(session, altered_regions)
+            # Trigger alerts for any regions with updated basket_versions
+            # could go here if there is not also an update in this commit 
+            # for their baskets
@@ -21,6 +21,14 @@ class InvalidURL(Exception):
     def __init__(self, msg='URL could not be resolved to a valid website', *args, **kwargs):
         super().__init__(msg, *args, **kwargs)
 
+class ProtocolProbeFailed(InvalidURL):
+    def __init__(self, msg='Protocol supported by website could not be determined', *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+class SnapshotNotFound(Exception):
+    def __init__(self, msg='HTML snapshot not found in snapshot store', *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
 
 # Build enum of all our custom errors (warning: brittle)
 all_classes = inspect.getmembers(sys.modules[__name__], inspect.isclass)
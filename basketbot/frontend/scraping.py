@@ -3,7 +3,7 @@ from basketbot import db
 from basketbot.datamodel import model as dm
 from basketbot.forms import ScrapingRuleForm, RetailSiteForm
 from basketbot.util import decompose_url
-from basketbot.schemas import CountryRegions
+from basketbot.api.catalogue import catalogue
 
 def get_form():
     """
@@ -16,8 +16,7 @@ def get_form():
     if site is None:
         form = RetailSiteForm(csrf_enabled=False)
         deconstructed_url = decompose_url(site_url)
-        countries = CountryRegions(many=True).dump(dm.Country.query.all())
-        country_region_dict = {country.pop('country_id'): country for country in countries}
+        country_region_dict = catalogue.get('country_region_dict').data
         return render_template(
                 'retail_site/create.html',
                 form=form,
@@ -1,8 +1,11 @@
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
-from marshmallow import Schema, fields, ValidationError, validates_schema
+from marshmallow import Schema, fields, ValidationError, validates_schema, pre_dump
+from sqlalchemy import inspect
+from sqlalchemy.orm.attributes import set_committed_value
 from marshmallow.validate import Range
 import requests
-from basketbot import ma
+from basketbot import ma, db
+from basketbot.util import http_client
 from basketbot.datamodel import model as dm
 from basketbot import InvalidDOMElem, InvalidClassChain, InvalidRetailSiteURL, InvalidURL
 
@@ -23,11 +26,8 @@ def validate_dom_elem(check, js=False):
         in DOMElem relation). Otherwise checks against bs_name column which uses 
         BeautifulSoup formatting. Default - False
     """
-    if js:
-        known_elems = [x[0] for x in dm.DOMElem.query.with_entities(dm.DOMElem.js_name)]
-    else:
-        known_elems = [x[0] for x in dm.DOMElem.query.with_entities(dm.DOMElem.bs_name)]
-    if check not in known_elems:
+    tags = dm.dom_tags.get()
+    if check not in (tags.js_names if js else tags.bs_names):
         raise InvalidDOMElem(f"Provided Parent element does not match any {'JavaScript' if js else 'BeautifulSoup'} element tag listed in basketbot DB")
 
 def validate_class_chain(check):
@@ -73,6 +73,7 @@ class ExtensionScrapingRule(ma.SQLAlchemyAutoSchema):
         load_instance = True
         include_relationships = False
         exclude = ("id", "update_time", "user_id") # Add back user eventually
+        dump_only = ("possibly_broken",)
 
     # Override some fields
     class_chain = fields.Raw(validate=validate_class_chain)
@@ -95,6 +96,43 @@ class ExtensionScrapingRule(ma.SQLAlchemyAutoSchema):
             data_key="retail_site" # Need to confirm that this is the serialized key
             )
 
+    @pre_dump(pass_many=True)
+    def prefetch(self, data, many, **kwargs):
+        """
+        Short Summary
+        -------------
+        Load the retail sites and items of all rules being dumped in one
+        query each
+
+        Extended Summary
+        ----------------
+        Dumping a list of rules would otherwise lazy load the retail site and
+        items of each rule separately. Parent elements are looked up in
+        dm.dom_tags, so need no queries. Relationships already loaded (eg: by
+        dm.ScrapingRule.bundle_query) are used as they are. Everything loaded
+        is set on the rules themselves, as schema instances are shared between
+        requests (eg: by blp.response) so must not hold per dump state.
+        """
+        rules = [rule for rule in (data if many else [data]) if isinstance(rule, dm.ScrapingRule)]
+        persistent = [rule for rule in rules if inspect(rule).persistent]
+        without_site = [rule for rule in persistent if 'retail_site' not in rule.__dict__]
+        site_ids = {rule.retail_site_id for rule in without_site}
+        if site_ids:
+            sites = {site.id: site for site in dm.RetailSite.query.filter(dm.RetailSite.id.in_(site_ids))}
+            for rule in without_site:
+                set_committed_value(rule, 'retail_site', sites.get(rule.retail_site_id))
+        unloaded = {rule.id: rule for rule in persistent if 'items' not in rule.__dict__}
+        if unloaded:
+            items = {rule_id: [] for rule_id in unloaded}
+            query = db.session.query(dm.ScrapingRuleItem.c.scraping_rule_id, dm.Item).join(
+                    dm.Item, dm.Item.id == dm.ScrapingRuleItem.c.item_id
+                    ).filter(dm.ScrapingRuleItem.c.scraping_rule_id.in_(list(unloaded)))
+            for rule_id, item in query:
+                items[rule_id].append(item)
+            for rule_id, rule in unloaded.items():
+                set_committed_value(rule, 'items', items[rule_id])
+        return data
+
     def serialize_retail_site(self, obj):
         return obj.retail_site.get_site_url()
 
@@ -108,16 +146,16 @@ class ExtensionScrapingRule(ma.SQLAlchemyAutoSchema):
             raise InvalidRetailSiteURL()
 
     def serialize_parent_elem(self, obj):
-        dom_elem = dm.DOMElem.query.get(obj.parent_elem_id)
-        if dom_elem is not None:
-            return dom_elem.js_name
+        js_name = dm.dom_tags.get().id_to_js.get(obj.parent_elem_id)
+        if js_name is not None:
+            return js_name
         else:
             raise InvalidDOMElem('DOM element not found from ID')
 
     def deserialize_parent_elem(self, obj):
-        dom_elem = dm.DOMElem.query.filter(dm.DOMElem.js_name==obj).scalar()
-        if dom_elem is not None:
-            return dom_elem.id
+        dom_elem_id = dm.dom_tags.get().js_ids.get(obj)
+        if dom_elem_id is not None:
+            return dom_elem_id
         else:
             raise InvalidDOMElem('DOM element not found from JavaScript tag name')
 
@@ -147,6 +185,11 @@ class CountryRegionsDict(ma.SQLAlchemySchema):
     name = ma.auto_field() 
     regions = fields.Nested(FormRegion, many=True)
 
+class RuleBundleArgs(ma.Schema):
+    """ Arguments selecting the retail site to get a bundle of rules for """
+    retail_site = fields.Str(required=False)
+    retail_site_id = fields.Integer(required=False, validate=Range(min=1, max=None))
+
 class SiteURL(ma.Schema):
     url = ma.Str()
 
@@ -163,7 +206,7 @@ class DeconstructedURL(ma.Schema):
         f"{data.get('domain')}."\
         f"{data.get('suffix')}"
         try:
-            response = requests.head(url)
+            response = http_client.head(url)
         except requests.exceptions.ConnectionError:
             return False
         if not response.ok:
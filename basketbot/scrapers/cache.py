@@ -0,0 +1,111 @@
+"""
+Conditional-GET page cache for the scraper fetch path.
+
+Many retailer pages do not change between scrape cycles. PageCache keeps the
+last body fetched for each URL along with its ETag and Last-Modified
+validators, so that the next fetch can ask the server whether the page has
+changed (If-None-Match / If-Modified-Since) and reuse the cached body on a 304
+response. Extraction results are stored against the hash of the page body, so
+they are reused for as long as the page content is unchanged.
+"""
+
+import hashlib
+import time
+from collections import namedtuple, OrderedDict
+from threading import Lock
+
+CachedPage = namedtuple('CachedPage', ['url', 'content', 'etag', 'last_modified', 'content_hash', 'fetched_at'])
+
+def content_hash(content):
+    """ Hash page content (bytes or str) """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+class PageCache:
+    """
+    Short Summary
+    -------------
+    Thread safe, size bounded (least recently used) cache of fetched pages
+
+    Parameters
+    ----------
+    max_entries : int
+        Maximum number of URLs to keep pages for (default: 10000)
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._pages = OrderedDict()
+        self._extractions = {}
+        self._lock = Lock()
+
+    def get(self, url):
+        """ Get the CachedPage for a URL, or None """
+        with self._lock:
+            page = self._pages.get(url)
+            if page is not None:
+                self._pages.move_to_end(url)
+            return page
+
+    def put(self, url, content, etag=None, last_modified=None):
+        """
+        Short Summary
+        -------------
+        Store a fetched page, returning the new CachedPage
+
+        Extended Summary
+        ----------------
+        Stored extraction results for the URL are kept if the page content is
+        unchanged, and dropped otherwise.
+        """
+        page = CachedPage(url, content, etag, last_modified, content_hash(content), time.time())
+        with self._lock:
+            old = self._pages.pop(url, None)
+            if old is not None and old.content_hash != page.content_hash:
+                self._extractions.pop(url, None)
+            self._pages[url] = page
+            while len(self._pages) > self.max_entries:
+                evicted, _ = self._pages.popitem(last=False)
+                self._extractions.pop(evicted, None)
+        return page
+
+    def conditional_headers(self, url):
+        """ Get the request headers for revalidating the cached copy of a URL """
+        page = self.get(url)
+        headers = {}
+        if page is not None:
+            if page.etag:
+                headers['If-None-Match'] = page.etag
+            if page.last_modified:
+                headers['If-Modified-Since'] = page.last_modified
+        return headers
+
+    def get_extraction(self, url, key, default=None):
+        """
+        Get a stored extraction result for the current cached page of a URL.
+        key identifies what was extracted (eg: a CompiledRule)
+        """
+        with self._lock:
+            return self._extractions.get(url, {}).get(key, default)
+
+    def set_extraction(self, url, key, value):
+        """ Store an extraction result for the current cached page of a URL """
+        with self._lock:
+            if url in self._pages:
+                self._extractions.setdefault(url, {})[key] = value
+
+    def invalidate(self, url=None):
+        """ Drop a single URL (or everything if url is None) from the cache """
+        with self._lock:
+            if url is None:
+                self._pages.clear()
+                self._extractions.clear()
+            else:
+                self._pages.pop(url, None)
+                self._extractions.pop(url, None)
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __contains__(self, url):
+        return url in self._pages
@@ -0,0 +1,388 @@
+"""
+A full scrape cycle: fetch every retail site page, extract prices for every
+basket item and write them back to RetailSite.basket (and record them as
+PriceObservations).
+
+Fetching (basketbot.scrapers.fetch.AsyncFetcher) and extraction
+(basketbot.scrapers.workers.ExtractionPool) run as a single streaming
+pipeline, so pages are parsed as soon as they arrive, and results are written
+to the database in batches rather than one commit per site.
+"""
+
+import asyncio
+import time
+from collections import namedtuple
+from decimal import Decimal
+from sqlalchemy.orm import selectinload
+from basketbot import db, DefaultRuleNotUnique
+from basketbot.datamodel import model as dm
+from basketbot.scrapers.extract import MultiRuleExtractor
+from basketbot.scrapers.fetch import AsyncFetcher, FetchJob
+from basketbot.scrapers.prices import PriceParser
+from basketbot.scrapers.workers import ExtractionPool, ExtractionJob, ruleset
+
+# Everything needed to turn the extraction results of a sites page into
+# prices. names and item_rules map Item ids to Item names and ScrapingRule
+# ids, and fingerprints maps Item ids to the previous Fingerprint of their rule
+SitePage = namedtuple('SitePage', ['site', 'url', 'names', 'rules', 'parser', 'item_rules', 'fingerprints'])
+
+# The outcome of a sites page: prices by Item id (or name once ready to
+# write), the abbreviation of the currency they were parsed in (see
+# ParsedPrice.currency), new Fingerprints by (ScrapingRule id, URL), and ids
+# of rules to flag as possibly broken
+SiteResult = namedtuple('SiteResult', ['site', 'prices', 'currency', 'fingerprints', 'broken_rules'])
+
+class CycleStats:
+    """
+    Short Summary
+    -------------
+    Counters and throughput figures for a scrape cycle
+    """
+    def __init__(self):
+        self.sites = 0
+        self.skipped_sites = 0
+        self.pages = 0
+        self.failed_pages = 0
+        self.bytes = 0
+        self.rules = 0
+        self.matched_rules = 0
+        self.unparsed_prices = 0
+        self.unit_prices = 0
+        self.cached_prices = 0
+        self.possibly_broken_rules = 0
+        self.extraction_errors = 0
+        self.written_sites = 0
+        self.elapsed = 0.0
+
+    @property
+    def pages_per_second(self):
+        return self.pages / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def success_rate(self):
+        """ Fraction of item rules that extracted a parseable price """
+        return self.matched_rules / self.rules if self.rules else 0.0
+
+    def summary(self):
+        return (
+                f'Sites: {self.sites} ({self.skipped_sites} skipped without rules, {self.written_sites} written)\n'
+                f'Pages: {self.pages} fetched, {self.failed_pages} failed in {self.elapsed:.2f}s '
+                f'({self.pages_per_second:.2f} pages/s, {self.bytes_per_second / 1024:.1f} KiB/s)\n'
+                f'Extraction: {self.matched_rules}/{self.rules} rules matched '
+                f'({100 * self.success_rate:.1f}% success, {self.extraction_errors} page errors, '
+                f'{self.unparsed_prices} unparseable prices, {self.unit_prices} per unit prices skipped)\n'
+                f'Fingerprints: {self.cached_prices} prices reused, '
+                f'{self.possibly_broken_rules} rules possibly broken'
+                )
+
+def site_page_url(retail_site):
+    """ The page fetched for a RetailSite: its basket_url, or its site URL """
+    return retail_site.basket_url or retail_site.get_site_url()
+
+def site_price_parser(retail_site):
+    """ The PriceParser for a RetailSite, from the first region it serves """
+    if retail_site.regions:
+        return PriceParser.for_region(retail_site.regions[0])
+    return PriceParser.for_currency(None)
+
+def load_sites(regions=None, sites=None, session=None):
+    """
+    Short Summary
+    -------------
+    Load RetailSites to scrape, along with their scraping rules
+
+    Parameters
+    ----------
+    regions : list(str)
+        Only load sites serving one of these region names
+    sites : list(str)
+        Only load sites with one of these names
+    """
+    session = session or db.session
+    query = session.query(dm.RetailSite).options(
+            selectinload(dm.RetailSite.scraping_rules).selectinload(dm.ScrapingRule.items),
+            selectinload(dm.RetailSite.scraping_rules).joinedload(dm.ScrapingRule.parent_elem),
+            selectinload(dm.RetailSite.regions).joinedload(dm.Region.currency),
+            selectinload(dm.RetailSite.regions).joinedload(dm.Region.country),
+            )
+    if regions:
+        query = query.filter(dm.RetailSite.regions.any(dm.Region.name.in_(regions)))
+    if sites:
+        query = query.filter(dm.RetailSite.name.in_(sites))
+    return query.order_by(dm.RetailSite.id).all()
+
+def page_result(page, checks, stats):
+    """
+    Short Summary
+    -------------
+    Turn the FingerprintChecks of a SitePage into a SiteResult, updating
+    stats
+
+    Extended Summary
+    ----------------
+    Prices are reused from the previous fingerprint where it and the
+    extracted text are unchanged, and the rest are parsed in one batch.
+    Prices are Decimals rounded to the minor unit, and are kept in
+    fingerprints as strings. Prices per weight or volume (eg: "£1.20/kg")
+    are not prices of an item, so they are skipped.
+    """
+    prices, to_parse, broken = {}, [], set()
+    for item_id, check in checks.items():
+        if check.possibly_broken:
+            broken.add(page.item_rules[item_id])
+        if check.unchanged and check.fingerprint.value is not None:
+            prices[item_id] = Decimal(str(check.fingerprint.value))
+            stats.cached_prices += 1
+        else:
+            to_parse.append(item_id)
+    texts = [checks[item_id].text for item_id in to_parse]
+    fingerprints = {}
+    for item_id, text, price in zip(to_parse, texts, page.parser.parse_many(texts)):
+        if price is not None and not price.per_item:
+            stats.unit_prices += 1
+            price = None
+        elif price is None and text is not None:
+            stats.unparsed_prices += 1
+        prices[item_id] = None if price is None else price.unit_price
+        fingerprint = checks[item_id].fingerprint
+        if fingerprint is not None:
+            value = None if price is None else str(prices[item_id])
+            fingerprints[page.item_rules[item_id], page.url] = fingerprint._replace(value=value)
+    stats.matched_rules += sum(price is not None for price in prices.values())
+    stats.possibly_broken_rules += len(broken)
+    return SiteResult(page.site, prices, page.parser.currency, fingerprints, broken)
+
+def load_fingerprints(rules, session=None):
+    """
+    Short Summary
+    -------------
+    Load the stored RuleFingerprints of the current versions of some rules,
+    as a dict keyed by (ScrapingRule id, URL)
+    """
+    session = session or db.session
+    versions = {rule.id: rule.update_time for rule in rules}
+    if not versions:
+        return {}
+    records = session.query(dm.RuleFingerprint).filter(dm.RuleFingerprint.scraping_rule_id.in_(versions))
+    return {
+            (record.scraping_rule_id, record.url): record
+            for record in records
+            if record.rule_update_time == versions[record.scraping_rule_id]
+            }
+
+def write_results(results, fingerprint_ids, rule_versions, session=None):
+    """
+    Short Summary
+    -------------
+    Write the results of a batch of sites in one transaction
+
+    Extended Summary
+    ----------------
+    Prices are merged into each sites current RetailSite.basket and recorded
+    as a PriceObservation, in the currency they were parsed in, for each
+    region the site serves, new fingerprints are stored, and rules whose page layout has changed are
+    flagged as possibly_broken (without changing their update_time, which
+    would make them recompile and drop their fingerprints).
+
+    Parameters
+    ----------
+    results : list(SiteResult)
+        The results to write
+    fingerprint_ids : dict
+        Map from (ScrapingRule id, URL) to the id of its stored
+        RuleFingerprint, as loaded at the start of the cycle (each rule and
+        URL is only scraped once per cycle)
+    rule_versions : dict
+        Map from ScrapingRule id to its update_time when it was loaded
+    """
+    session = session or db.session
+    baskets, inserts, updates, broken = [], [], [], set()
+    observations = []
+    observed_at = dm.now()
+    names = {name for result in results for name in result.prices}
+    item_ids = dict(session.query(dm.Item.name, dm.Item.id).filter(dm.Item.name.in_(names))) if names else {}
+    abbreviations = {result.currency for result in results if result.prices and result.currency}
+    currency_ids = dict(
+            session.query(dm.Currency.abbreviation, dm.Currency.id).filter(dm.Currency.abbreviation.in_(abbreviations))
+            ) if abbreviations else {}
+    # Baskets may have been edited since the cycle loaded its sites, so merge
+    # into their current values, locked until the batch is committed
+    site_ids = [result.site.id for result in results if result.prices]
+    current = dict(
+            session.query(dm.RetailSite.id, dm.RetailSite.basket)
+            .filter(dm.RetailSite.id.in_(site_ids))
+            .with_for_update()
+            ) if site_ids else {}
+    for result in results:
+        if result.prices:
+            basket = dict(current.get(result.site.id) or {})
+            basket.update({name: str(price) for name, price in result.prices.items()})
+            baskets.append({'id': result.site.id, 'basket': basket})
+        for name, price in result.prices.items():
+            if name not in item_ids:
+                continue # Item deleted since the cycle started
+            for region in result.site.regions:
+                observations.append({
+                    'item_id': item_ids[name],
+                    'retail_site_id': result.site.id,
+                    'region_id': region.id,
+                    'observed_at': observed_at,
+                    'price': price,
+                    'currency_id': currency_ids.get(result.currency),
+                    })
+        for (rule_id, url), fingerprint in result.fingerprints.items():
+            mapping = {
+                    'scraping_rule_id': rule_id,
+                    'url': url,
+                    'rule_update_time': rule_versions[rule_id],
+                    'digest': fingerprint.digest,
+                    'path': list(fingerprint.path),
+                    'raw_text': fingerprint.text,
+                    'value': fingerprint.value,
+                    }
+            if (rule_id, url) in fingerprint_ids:
+                mapping['id'] = fingerprint_ids[rule_id, url]
+                updates.append(mapping)
+            else:
+                inserts.append(mapping)
+        broken.update(result.broken_rules)
+    session.bulk_update_mappings(dm.RetailSite, baskets)
+    session.bulk_insert_mappings(dm.RuleFingerprint, inserts)
+    session.bulk_insert_mappings(dm.PriceObservation, observations)
+    session.bulk_update_mappings(dm.RuleFingerprint, updates)
+    if broken:
+        table = dm.ScrapingRule.__table__
+        session.execute(
+                table.update()
+                .where(table.c.id.in_(broken))
+                .values(possibly_broken=True, update_time=table.c.update_time)
+                )
+    session.commit()
+
+def run_cycle(regions=None, sites=None, workers=None, dry_run=False, batch_size=50, config=None, session=None, fetcher=None, on_result=None):
+    """
+    Short Summary
+    -------------
+    Run a scrape cycle, returning its CycleStats
+
+    Extended Summary
+    ----------------
+    Each site has one page fetched, from which the prices of all of the items
+    in its basket (RetailSite.basket_items) are extracted using each items
+    scraping rule. Extracted text is parsed with the sites PriceParser (see
+    site_price_parser) and the price of a single item is written to
+    RetailSite.basket keyed by item name (as a decimal string), batch_size sites at a time. Sites
+    without a default scraping rule are skipped.
+
+    Rules are checked against the fingerprint of their last match on the
+    page (see basketbot.scrapers.fingerprint). Prices whose fingerprint and
+    text are unchanged are reused without being parsed again, and rules
+    whose page layout has changed are flagged as possibly_broken.
+
+    Parameters
+    ----------
+    regions, sites : list(str)
+        Filters passed to load_sites
+    workers : int
+        Number of extraction worker processes (default: number of CPUs)
+    dry_run : bool
+        Fetch and extract but do not write anything to the database
+    batch_size : int
+        Number of sites written per database transaction
+    config : dict
+        Config to create the fetcher from (default: the current app config)
+    fetcher : basketbot.scrapers.fetch.AsyncFetcher
+        Fetcher to use instead of one created from config
+    on_result : callable
+        Called with (RetailSite, dict from item name to price or None) for
+        every site that is extracted
+    """
+    from flask import current_app
+    session = session or db.session
+    config = config if config is not None else current_app.config
+    stats = CycleStats()
+    if not dry_run:
+        # So that this (and the next) months prices do not go to the default
+        # partition, which would stop their partitions being created
+        dm.PriceObservation.create_month_partitions(session=session)
+        session.commit()
+    loaded = load_sites(regions, sites, session)
+    rules = [rule for site in loaded for rule in site.scraping_rules]
+    rule_versions = {rule.id: rule.update_time for rule in rules}
+    stored = load_fingerprints(rules, session)
+    fingerprint_ids = {key: record.id for key, record in stored.items()}
+    jobs = []
+    for site in loaded:
+        stats.sites += 1
+        items = site.basket_items
+        try:
+            extractor = MultiRuleExtractor.from_retail_site(site, items)
+        except DefaultRuleNotUnique:
+            stats.skipped_sites += 1
+            continue
+        url = site_page_url(site)
+        item_rules = {item_id: rule.id for item_id, rule in site.get_item_rules(items).items()}
+        page = SitePage(
+                site,
+                url,
+                {item.id: item.name for item in items},
+                ruleset(extractor.rules),
+                site_price_parser(site),
+                item_rules,
+                {
+                    item_id: stored[rule_id, url].get_fingerprint()
+                    for item_id, rule_id in item_rules.items() if (rule_id, url) in stored
+                    }
+                )
+        jobs.append(FetchJob(url, site=site.id, context=page))
+
+    own_fetcher = fetcher is None
+    fetcher = fetcher or AsyncFetcher.from_config(config)
+    batch = []
+
+    def flush():
+        if batch and not dry_run:
+            write_results(batch, fingerprint_ids, rule_versions, session)
+            stats.written_sites += sum(bool(result.prices) for result in batch)
+        batch.clear()
+
+    async def pipeline(pool):
+        async def extraction_jobs():
+            async for result in fetcher.fetch(jobs):
+                if result.ok:
+                    stats.pages += 1
+                    stats.bytes += len(result.content)
+                    page = result.job.context
+                    yield ExtractionJob(result.content, page.rules, page, page.fingerprints)
+                else:
+                    stats.failed_pages += 1
+        async for result in pool.extract(extraction_jobs()):
+            page = result.job.context
+            stats.rules += len(page.rules)
+            if result.error is not None:
+                stats.extraction_errors += 1
+                continue
+            site_result = page_result(page, result.checks, stats)
+            if on_result is not None:
+                on_result(page.site, {page.names[item_id]: price for item_id, price in site_result.prices.items()})
+            site_result = site_result._replace(prices={
+                page.names[item_id]: price for item_id, price in site_result.prices.items() if price is not None
+                })
+            batch.append(site_result)
+            if len(batch) >= batch_size:
+                flush()
+
+    start = time.monotonic()
+    try:
+        with ExtractionPool(max_workers=workers) as pool:
+            asyncio.run(pipeline(pool))
+        flush()
+    finally:
+        if own_fetcher:
+            fetcher.close()
+    stats.elapsed = time.monotonic() - start
+    return stats
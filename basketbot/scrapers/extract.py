@@ -0,0 +1,187 @@
+"""
+Extraction of many scraping rules from a single page.
+
+Listing and category pages can hold prices for many basket items, each of
+which may have its own scraping rule. Rather than parsing and walking the page
+once per rule, MultiRuleExtractor merges all rules into a trie (one per parent
+element) and evaluates them together in a single traversal of one DOM.
+"""
+
+from basketbot.scrapers.parsers import get_backend
+from basketbot.scrapers.fingerprint import check_previous, check_match
+
+class RuleTrie:
+    """
+    Short Summary
+    -------------
+    A node in a trie of compiled class chain levels
+
+    Extended Summary
+    ----------------
+    Each edge is a CompiledNode (tag and class set). keys holds the extraction
+    keys of rules whose chain ends at this node, and keys_below holds the keys
+    of all rules ending at or below it, which lets a traversal skip subtrees
+    once all of their rules have been resolved.
+    """
+    __slots__ = ('children', 'keys', 'keys_below')
+
+    def __init__(self):
+        self.children = {}
+        self.keys = []
+        self.keys_below = set()
+
+    def add(self, levels, key):
+        node = self
+        node.keys_below.add(key)
+        for level in levels:
+            node = node.children.setdefault(level.tree_node, RuleTrie())
+            node.keys_below.add(key)
+        node.keys.append(key)
+
+
+class MultiRuleExtractor:
+    """
+    Short Summary
+    -------------
+    Evaluate a set of compiled scraping rules against one DOM in one pass
+
+    Extended Summary
+    ----------------
+    rules is a dict from an arbitrary key (eg: an Item id) to a CompiledRule.
+    Several keys may share the same rule. Results are identical to calling
+    CompiledRule.extract for each rule separately: the depth-first order in
+    which the DOM is visited is the same, so the first matching route is
+    found for every rule.
+    """
+    def __init__(self, rules):
+        self.rules = dict(rules)
+        self.anchors = {}
+        for key, rule in self.rules.items():
+            anchor = (rule.parent_tag, rule.parent_id)
+            self.anchors.setdefault(anchor, RuleTrie()).add(rule.levels, key)
+
+    @classmethod
+    def from_retail_site(cls, retail_site, items=None):
+        """
+        Short Summary
+        -------------
+        Build an extractor for a set of items on a retail site
+
+        Extended Summary
+        ----------------
+        Each item is mapped to the same rule as RetailSite.get_item_rule would
+        give it: its exception rule if it has exactly one, otherwise the sites
+        default rule. Results are keyed by Item id.
+
+        Parameters
+        ----------
+        retail_site : basketbot.datamodel.RetailSite
+            The site whose rules should be used
+        items : list(basketbot.datamodel.Item or int)
+            Items (or Item ids) to extract. If None then all items in the
+            baskets of the regions served by the site are used.
+        """
+        if items is None:
+            items = retail_site.basket_items
+        return cls({item_id: rule.get_rule() for item_id, rule in retail_site.get_item_rules(items).items()})
+
+    def extract(self, dom, backend=None):
+        """
+        Short Summary
+        -------------
+        Extract the values of all rules from a DOM
+
+        Extended Summary
+        ----------------
+        Returns a dict from each rule key to the stripped text located by its
+        rule, or None if the rule did not match the DOM.
+
+        Parameters
+        ----------
+        dom
+            A DOM produced by the parse method of backend
+        backend : basketbot.scrapers.parsers.ParserBackend or str
+            The parser backend that built dom (default: configured backend)
+        """
+        backend = get_backend(backend)
+        results = {}
+        found = backend.find_anchors(dom, self.anchors.keys())
+        for anchor, elem in found.items():
+            self._walk(elem, self.anchors[anchor], results, backend)
+        for key in self.rules:
+            results.setdefault(key, None)
+        return results
+
+    def check(self, dom, previous, backend=None):
+        """
+        Short Summary
+        -------------
+        Check all rules against a DOM using their previous fingerprints
+
+        Extended Summary
+        ----------------
+        Returns a dict from each rule key to a
+        basketbot.scrapers.fingerprint.FingerprintCheck. Rules with a previous
+        Fingerprint follow their recorded route rather than being searched for,
+        and keys sharing the same rule and previous fingerprint are only
+        checked once. All rules that still have to be matched (new rules, and
+        those whose fingerprint has changed) are matched together in the same
+        single traversal as extract.
+
+        Parameters
+        ----------
+        dom
+            A DOM produced by the parse method of backend
+        previous : dict
+            Map from rule key to the Fingerprint from the last check of its
+            rule on this page (keys without one are matched from scratch)
+        backend : basketbot.scrapers.parsers.ParserBackend or str
+            The parser backend that built dom (default: configured backend)
+        """
+        backend = get_backend(backend)
+        found = backend.find_anchors(dom, self.anchors.keys())
+        checks = {}
+        results = {}
+        for key, rule in self.rules.items():
+            fingerprint = previous.get(key)
+            if (rule, fingerprint) not in checks:
+                anchor = found.get((rule.parent_tag, rule.parent_id))
+                checks[rule, fingerprint] = check_previous(anchor, backend, fingerprint)
+            if checks[rule, fingerprint] is not None:
+                results[key] = checks[rule, fingerprint]
+        if len(results) < len(self.rules):
+            # Keys already checked are marked as resolved, so the traversal
+            # skips any subtree holding only those
+            texts, paths = dict.fromkeys(results), {}
+            for anchor, elem in found.items():
+                self._walk(elem, self.anchors[anchor], texts, backend, paths)
+            for key, rule in self.rules.items():
+                if key in results:
+                    continue
+                fingerprint = previous.get(key)
+                if checks[rule, fingerprint] is None:
+                    anchor = found.get((rule.parent_tag, rule.parent_id))
+                    checks[rule, fingerprint] = check_match(anchor, paths.get(key), backend, fingerprint)
+                results[key] = checks[rule, fingerprint]
+        return results
+
+    def _walk(self, elem, node, results, backend, paths=None, path=()):
+        for key in node.keys:
+            if key not in results:
+                results[key] = backend.text(elem)
+                if paths is not None:
+                    paths[key] = path
+        if not node.children:
+            return
+        for index, child in enumerate(backend.child_elements(elem)):
+            if node.keys_below.issubset(results):
+                return
+            tag = backend.tag(child)
+            classes = None
+            for level, subtrie in node.children.items():
+                if level.tag != tag or subtrie.keys_below.issubset(results):
+                    continue
+                if classes is None:
+                    classes = set(backend.classes(child))
+                if level.classes.issubset(classes):
+                    self._walk(child, subtrie, results, backend, paths, path + (index,))
@@ -0,0 +1,220 @@
+"""
+Concurrent fetching of pages for scraping.
+
+A scrape cycle spends nearly all of its time waiting on the network, so pages
+are fetched concurrently with asyncio. Each fetch runs a blocking HTTP request
+in a thread pool, limited by a global concurrency cap and a per retail site
+cap so that no single retailer is hammered. Results are streamed back as they
+complete so that parsing can start before the whole cycle has been fetched.
+"""
+
+import asyncio
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlsplit
+from basketbot.util import http_client
+
+# A page to fetch. site is used to apply per-site concurrency limits (eg: a
+# RetailSite id) and defaults to the URL host. context is passed through to
+# the corresponding FetchResult untouched.
+FetchJob = namedtuple('FetchJob', ['url', 'site', 'context'], defaults=[None, None])
+
+class FetchResult(namedtuple('FetchResult', ['job', 'status', 'content', 'error', 'elapsed', 'snapshot_id'], defaults=[None])):
+    """
+    Short Summary
+    -------------
+    The outcome of fetching a FetchJob
+
+    Extended Summary
+    ----------------
+    job - the FetchJob that was fetched
+    status - HTTP status code, or None if no response was received
+    content - the response body as bytes (the cached body for a 304), or None
+    error - the exception raised whilst fetching, or None
+    elapsed - wall clock time taken by the fetch in seconds
+    snapshot_id - id of the page in the fetchers SnapshotStore, if it has one
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None and self.content is not None and (200 <= self.status < 300 or self.not_modified)
+
+    @property
+    def not_modified(self):
+        """ Whether the server confirmed that the cached copy is current """
+        return self.status == 304
+
+def fetch_page(url, timeout=None, cache=None):
+    """
+    Short Summary
+    -------------
+    Fetch a single page, returning a (status_code, content) tuple
+
+    Extended Summary
+    ----------------
+    If a basketbot.scrapers.cache.PageCache is given then a conditional GET is
+    made using the validators of any cached copy of the page. On a 304
+    response the cached content is returned (with the 304 status code), and
+    successful responses are stored in the cache.
+    """
+    headers = cache.conditional_headers(url) if cache is not None else {}
+    response = http_client.get(url, timeout=timeout, headers=headers)
+    if cache is None:
+        return response.status_code, response.content
+    if response.status_code == 304:
+        page = cache.get(url)
+        if page is not None:
+            return response.status_code, page.content
+        # Cached copy was evicted mid-request, so fetch unconditionally
+        return fetch_page(url, timeout)
+    if 200 <= response.status_code < 300:
+        cache.put(
+                url,
+                response.content,
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified')
+                )
+    return response.status_code, response.content
+
+
+class AsyncFetcher:
+    """
+    Short Summary
+    -------------
+    Fetch many pages concurrently with global and per-site concurrency limits
+
+    Extended Summary
+    ----------------
+    Usage from a coroutine:
+
+        fetcher = AsyncFetcher(max_concurrency=32, site_concurrency=4)
+        async for result in fetcher.fetch(jobs):
+            ...
+
+    or from synchronous code with fetcher.fetch_all(jobs).
+
+    Fetches keep hold of their concurrency slots until their result has been
+    handed to the consumer (up to max_pending results are buffered), so a slow
+    consumer naturally slows fetching down rather than piling up pages in
+    memory.
+
+    Parameters
+    ----------
+    max_concurrency : int
+        Maximum number of fetches in flight at once (default: 32)
+    site_concurrency : int
+        Default maximum number of fetches in flight per site (default: 4)
+    site_limits : dict
+        Per site overrides of site_concurrency, keyed by FetchJob.site
+    timeout : float
+        Timeout in seconds passed to fetch_fn for each fetch (default: 10)
+    max_pending : int
+        Maximum number of completed results buffered before fetching is
+        paused (default: max_concurrency)
+    cache : basketbot.scrapers.cache.PageCache
+        Optional page cache used to make conditional requests
+    snapshots : basketbot.scrapers.snapshots.SnapshotStore
+        Optional store that every successfully fetched page is saved to. The
+        FetchJob.site value is recorded as the snapshots retail_site_id.
+    fetch_fn : callable
+        Blocking function taking (url, timeout, cache=None) and returning a
+        (status, content) tuple (default: fetch_page)
+    """
+    def __init__(self, max_concurrency=32, site_concurrency=4, site_limits=None, timeout=10, max_pending=None, cache=None, snapshots=None, fetch_fn=fetch_page):
+        self.max_concurrency = max_concurrency
+        self.site_concurrency = site_concurrency
+        self.site_limits = dict(site_limits or {})
+        self.timeout = timeout
+        self.max_pending = max_pending or max_concurrency
+        self.cache = cache
+        self.snapshots = snapshots
+        self.fetch_fn = fetch_fn
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='basketbot-fetch')
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """
+        Create a fetcher using SCRAPER_* values from a Flask config, with any
+        kwargs taking precedence
+        """
+        settings = dict(
+                max_concurrency=config.get('SCRAPER_MAX_CONCURRENCY', 32),
+                site_concurrency=config.get('SCRAPER_SITE_CONCURRENCY', 4),
+                timeout=config.get('SCRAPER_FETCH_TIMEOUT', 10),
+                )
+        settings.update(kwargs)
+        return cls(**settings)
+
+    def site_key(self, job):
+        return job.site if job.site is not None else urlsplit(job.url).netloc
+
+    async def fetch(self, jobs):
+        """
+        Short Summary
+        -------------
+        Asynchronously fetch an iterable of FetchJob (or URL strings),
+        yielding FetchResult objects in the order they complete
+        """
+        jobs = [job if isinstance(job, FetchJob) else FetchJob(job) for job in jobs]
+        results = asyncio.Queue(maxsize=self.max_pending)
+        global_limit = asyncio.Semaphore(self.max_concurrency)
+        site_limits = {}
+        for job in jobs:
+            key = self.site_key(job)
+            if key not in site_limits:
+                site_limits[key] = asyncio.Semaphore(self.site_limits.get(key, self.site_concurrency))
+        tasks = [
+                asyncio.ensure_future(self._fetch_one(job, global_limit, site_limits[self.site_key(job)], results))
+                for job in jobs
+                ]
+        try:
+            for _ in range(len(tasks)):
+                yield await results.get()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _fetch_one(self, job, global_limit, site_limit, results):
+        # Take the site slot first, so that jobs queued behind a busy site
+        # don't hold up global slots that other sites could be using
+        async with site_limit, global_limit:
+            loop = asyncio.get_running_loop()
+            start = time.monotonic()
+            status, content, error, snapshot_id = None, None, None, None
+            try:
+                # Timeouts are left to fetch_fn, as the executor thread can't
+                # be stopped and must keep its slots until it finishes
+                status, content = await loop.run_in_executor(
+                        self._executor,
+                        partial(self.fetch_fn, job.url, self.timeout, cache=self.cache)
+                        )
+                if self.snapshots is not None and content is not None and (200 <= status < 300 or status == 304):
+                    snapshot_id = await loop.run_in_executor(
+                            self._executor,
+                            partial(self.snapshots.put, content, url=job.url, retail_site_id=job.site)
+                            )
+            except Exception as e:
+                error = e
+            await results.put(FetchResult(job, status, content, error, time.monotonic() - start, snapshot_id))
+
+    def fetch_all(self, jobs):
+        """
+        Synchronously fetch all jobs, returning a list of FetchResult objects
+        in the order they completed
+        """
+        async def collect():
+            return [result async for result in self.fetch(jobs)]
+        return asyncio.run(collect())
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
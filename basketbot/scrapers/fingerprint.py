@@ -0,0 +1,171 @@
+"""
+Structural fingerprints of the DOM path matched by a scraping rule.
+
+When a rule matches a page, the route it took from its parent element is
+recorded as the position of the chosen child element at each level, along
+with a hash of the tag names and classes of the elements on that route. On
+the next scrape of the same page the stored route is followed directly, which
+costs one step per level rather than a depth-first search. If the fingerprint
+and the extracted text are both unchanged then the value computed last time
+(eg: the parsed price) can be reused. Positions are only a hint: if siblings
+are added, removed or reordered the rule searches again, and finding the same
+fingerprint at new positions is not a layout change. If the rule ends up on a
+route with a different fingerprint (or no longer matches at all), the
+retailer has most likely changed their page layout, and the rule is reported
+as possibly broken.
+"""
+
+import hashlib
+from collections import namedtuple
+
+# Result of a previous match of a rule on a page. digest is the fingerprint of
+# the matched route, path the child element positions along it, text the text
+# extracted and value whatever was derived from the text (eg: a price)
+Fingerprint = namedtuple('Fingerprint', ['digest', 'path', 'text', 'value'], defaults=[None])
+
+# Bytes in a digest
+DIGEST_SIZE = 12
+
+NEW = 'new'                             # Matched, with no previous fingerprint
+UNCHANGED = 'unchanged'                 # Same route and text as last time
+TEXT_CHANGED = 'text_changed'           # Same route, different text
+MOVED = 'moved'                         # Same route, at different positions
+STRUCTURE_CHANGED = 'structure_changed' # Matched, but on a different route
+LOST = 'lost'                           # Matched last time, but not any more
+NOT_FOUND = 'not_found'                 # No match, and no previous fingerprint
+
+class FingerprintCheck(namedtuple('FingerprintCheck', ['status', 'fingerprint'])):
+    """
+    Short Summary
+    -------------
+    Outcome of checking a rule against a page and its previous Fingerprint
+
+    Extended Summary
+    ----------------
+    status - one of the status constants in this module
+    fingerprint - the new Fingerprint (None if the rule did not match). Its
+        value is carried over from the previous fingerprint when UNCHANGED,
+        otherwise it is None and should be recomputed from its text
+    """
+    __slots__ = ()
+
+    @property
+    def text(self):
+        return None if self.fingerprint is None else self.fingerprint.text
+
+    @property
+    def unchanged(self):
+        return self.status == UNCHANGED
+
+    @property
+    def possibly_broken(self):
+        """ Whether the page layout around the rule has changed """
+        return self.status in (STRUCTURE_CHANGED, LOST)
+
+def _signature(backend, elem):
+    classes = ' '.join(sorted(backend.classes(elem)))
+    return f'{backend.tag(elem)}|{classes};'.encode('utf-8')
+
+def follow_path(anchor, path, backend):
+    """
+    Short Summary
+    -------------
+    Follow a recorded route from an anchor element, returning a (digest,
+    element) tuple, or None if the route no longer exists in the DOM
+    """
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    elem = anchor
+    for index in path:
+        for position, child in enumerate(backend.child_elements(elem)):
+            if position == index:
+                elem = child
+                break
+        else:
+            return None
+        hasher.update(_signature(backend, elem))
+    return hasher.hexdigest(), elem
+
+def match_path(rule, anchor, backend):
+    """
+    Short Summary
+    -------------
+    Match a CompiledRule from its anchor element as CompiledRule.match does,
+    returning the route taken as a tuple of child element positions (or None
+    if the rule does not match)
+    """
+    def descend(elem, depth):
+        if depth == len(rule.levels):
+            return ()
+        node = rule.levels[depth].tree_node
+        for index, child in enumerate(backend.child_elements(elem)):
+            if backend.tag(child) == node.tag and node.classes.issubset(backend.classes(child)):
+                found = descend(child, depth + 1)
+                if found is not None:
+                    return (index,) + found
+        return None
+    return descend(anchor, 0)
+
+def check_rule(rule, anchor, backend, previous=None):
+    """
+    Short Summary
+    -------------
+    Check a CompiledRule against the DOM below its anchor element, returning
+    a FingerprintCheck
+
+    Extended Summary
+    ----------------
+    If a previous Fingerprint is given its route is tried first, and only if
+    the fingerprint of that route has changed is the rule matched from
+    scratch. Note that an unchanged route is trusted even if an earlier
+    sibling branch (that failed to match last time) would now match. A match
+    with the previous fingerprint at different positions is MOVED, and only a
+    different fingerprint (STRUCTURE_CHANGED) or no match (LOST) suggests the
+    rule is broken.
+
+    Parameters
+    ----------
+    rule : basketbot.scrapers.rules.CompiledRule
+        The rule to check
+    anchor
+        The rules parent element in the DOM, or None if it was not found
+    backend : basketbot.scrapers.parsers.ParserBackend
+        The parser backend that built the DOM
+    previous : Fingerprint
+        Fingerprint from the last check of this rule on this page
+    """
+    check = check_previous(anchor, backend, previous)
+    if check is not None:
+        return check
+    path = match_path(rule, anchor, backend) if anchor is not None else None
+    return check_match(anchor, path, backend, previous)
+
+def check_previous(anchor, backend, previous):
+    """
+    Follow the route of a previous Fingerprint, returning an UNCHANGED or
+    TEXT_CHANGED FingerprintCheck, or None if its fingerprint has changed (or
+    there is no previous fingerprint) and the rule must be matched again
+    """
+    if anchor is None or previous is None:
+        return None
+    followed = follow_path(anchor, previous.path, backend)
+    if followed is None or followed[0] != previous.digest:
+        return None
+    text = backend.text(followed[1])
+    if text == previous.text:
+        return FingerprintCheck(UNCHANGED, Fingerprint(previous.digest, tuple(previous.path), text, previous.value))
+    return FingerprintCheck(TEXT_CHANGED, Fingerprint(previous.digest, tuple(previous.path), text))
+
+def check_match(anchor, path, backend, previous):
+    """
+    FingerprintCheck for a rule matched from scratch along path (as given by
+    match_path, or None if it did not match), compared with its previous
+    Fingerprint
+    """
+    if path is None:
+        return FingerprintCheck(NOT_FOUND if previous is None else LOST, None)
+    digest, elem = follow_path(anchor, path, backend)
+    if previous is None:
+        status = NEW
+    else:
+        status = MOVED if digest == previous.digest else STRUCTURE_CHANGED
+    return FingerprintCheck(status, Fingerprint(digest, tuple(path), backend.text(elem)))
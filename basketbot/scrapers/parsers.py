@@ -0,0 +1,236 @@
+"""
+Pluggable HTML parser backends used by the scrapers.
+
+A backend knows how to parse HTML into a DOM and how to answer the handful of
+questions that matching a CompiledRule needs (finding the parent element,
+listing children, reading classes and text). Every backend must give identical
+results for the same rule, so the choice of backend is purely a performance
+decision that can be made per deployment (SCRAPER_PARSER_BACKEND config
+value) or per retail site (RetailSite.parser_backend).
+"""
+
+from flask import current_app, has_app_context
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.dammit import UnicodeDammit
+import lxml.html
+import lxml.etree
+
+DEFAULT_BACKEND = 'bs4'
+
+class ParserBackend:
+    """
+    Short Summary
+    -------------
+    Base class for HTML parser backends
+    """
+    name = None
+
+    def parse(self, html):
+        """ Parse a string (or bytes) of HTML, returning the DOM root """
+        raise NotImplementedError
+
+    def parse_subtree(self, html, tag, elem_id):
+        """
+        Short Summary
+        -------------
+        Parse only the subtree rooted at the element with tag name tag and id
+        elem_id
+
+        Extended Summary
+        ----------------
+        The returned DOM contains the anchor element and its descendants only
+        (or nothing if the anchor is not in the page), and can be passed to
+        find_anchor and the other methods exactly like a full DOM. Matching a
+        rule against it must give the same result as against the full DOM.
+        """
+        raise NotImplementedError
+
+    def find_anchor(self, dom, tag, elem_id):
+        """ Find the element with tag name tag and id elem_id, or None """
+        raise NotImplementedError
+
+    def find_anchors(self, dom, anchors):
+        """
+        Find several parent elements in a single pass over the DOM. anchors is
+        a collection of (tag, elem_id) tuples, and a dict from each tuple found
+        to the first matching element is returned
+        """
+        raise NotImplementedError
+
+    def children(self, elem, tag):
+        """ Iterate over the direct children of elem with tag name tag """
+        raise NotImplementedError
+
+    def child_elements(self, elem):
+        """ Iterate over all direct child elements (not text) of elem """
+        raise NotImplementedError
+
+    def tag(self, elem):
+        """ Get the tag name of elem """
+        raise NotImplementedError
+
+    def classes(self, elem):
+        """ Get a list of the class names of elem """
+        raise NotImplementedError
+
+    def text(self, elem):
+        """ Get the stripped text content of elem and all its descendants """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.name}>'
+
+class BS4Backend(ParserBackend):
+    """
+    BeautifulSoup backend. Uses the pure python html.parser builder so that
+    results do not depend on which optional parsers are installed.
+    """
+    name = 'bs4'
+
+    def __init__(self, features='html.parser'):
+        self.features = features
+
+    def parse(self, html):
+        return BeautifulSoup(html, self.features)
+
+    def parse_subtree(self, html, tag, elem_id):
+        # The whole document is still tokenized, but only the anchor and
+        # its descendants are built into the tree
+        return BeautifulSoup(html, self.features, parse_only=SoupStrainer(tag, id=elem_id))
+
+    def find_anchor(self, dom, tag, elem_id):
+        if dom.name == tag and dom.get('id') == elem_id:
+            return dom
+        return dom.find(tag, id=elem_id)
+
+    def find_anchors(self, dom, anchors):
+        anchors = set(anchors)
+        found = {}
+        elems = dom.find_all(id=True)
+        if dom.name is not None and dom.get('id') is not None:
+            elems.insert(0, dom)
+        for elem in elems:
+            key = (elem.name, elem.get('id'))
+            if key in anchors and key not in found:
+                found[key] = elem
+                if len(found) == len(anchors):
+                    break
+        return found
+
+    def children(self, elem, tag):
+        return elem.find_all(tag, recursive=False)
+
+    def child_elements(self, elem):
+        return elem.find_all(True, recursive=False)
+
+    def tag(self, elem):
+        return elem.name
+
+    def classes(self, elem):
+        return elem.get('class', ())
+
+    def text(self, elem):
+        return elem.get_text().strip()
+
+class LXMLBackend(ParserBackend):
+    """
+    lxml.html backend. Parsing and tree walking are done in C by libxml2,
+    which is typically an order of magnitude faster than BeautifulSoup.
+    """
+    name = 'lxml'
+
+    def parse(self, html):
+        html = self._decode(html)
+        try:
+            return lxml.html.document_fromstring(html)
+        except ValueError:
+            # lxml refuses unicode strings carrying an XML encoding declaration
+            return lxml.html.document_fromstring(html.encode('utf-8'))
+
+    def parse_subtree(self, html, tag, elem_id):
+        """
+        libxml2 builds a full tree faster than a pull parser can stream the
+        document to the anchor, so this is a full parse with the anchor then
+        detached from the rest of the tree
+        """
+        dom = self.parse(html)
+        anchor = self.find_anchor(dom, tag, elem_id)
+        return dom if anchor is None else self._detach(anchor)
+
+    def _detach(self, elem):
+        """ Detach elem from the rest of the tree so it can be freed """
+        parent = elem.getparent()
+        if parent is not None:
+            parent.remove(elem)
+        return elem
+
+    def _decode(self, html):
+        if isinstance(html, bytes):
+            # Detect the encoding the same way BeautifulSoup does, so both
+            # backends see the same text
+            html = UnicodeDammit(html, is_html=True).unicode_markup
+        return html
+
+    def find_anchor(self, dom, tag, elem_id):
+        for elem in dom.iter(tag):
+            if elem.get('id') == elem_id:
+                return elem
+        return None
+
+    def find_anchors(self, dom, anchors):
+        anchors = set(anchors)
+        found = {}
+        for elem in dom.iter(lxml.etree.Element):
+            elem_id = elem.get('id')
+            if elem_id is None:
+                continue
+            key = (elem.tag, elem_id)
+            if key in anchors and key not in found:
+                found[key] = elem
+                if len(found) == len(anchors):
+                    break
+        return found
+
+    def children(self, elem, tag):
+        return elem.iterchildren(tag)
+
+    def child_elements(self, elem):
+        return elem.iterchildren(lxml.etree.Element)
+
+    def tag(self, elem):
+        return elem.tag
+
+    def classes(self, elem):
+        return (elem.get('class') or '').split()
+
+    def text(self, elem):
+        return elem.text_content().strip()
+
+PARSER_BACKENDS = {
+        BS4Backend.name: BS4Backend,
+        LXMLBackend.name: LXMLBackend,
+        }
+
+_backends = {}
+
+def get_backend(name=None):
+    """
+    Short Summary
+    -------------
+    Get a (shared) parser backend instance by name
+
+    Extended Summary
+    ----------------
+    If name is None then the SCRAPER_PARSER_BACKEND value from the current app
+    config is used, falling back to DEFAULT_BACKEND outside of an app context.
+    Passing a ParserBackend instance returns it unchanged.
+    """
+    if isinstance(name, ParserBackend):
+        return name
+    if name is None:
+        name = current_app.config.get('SCRAPER_PARSER_BACKEND', DEFAULT_BACKEND) if has_app_context() else DEFAULT_BACKEND
+    if name not in _backends:
+        if name not in PARSER_BACKENDS:
+            raise ValueError(f'Unknown parser backend {name}, must be one of {", ".join(PARSER_BACKENDS)}')
+        _backends[name] = PARSER_BACKENDS[name]()
+    return _backends[name]
@@ -0,0 +1,244 @@
+"""
+Parsing of scraped price text into Decimal values.
+
+Scraping rules extract prices as the text shown on the page, eg: "£1,234.50",
+"1 234,50 грн", "50p", "3 for £2" or "£1.20/kg". Which characters are decimal
+and grouping separators, and which currency symbols to expect, depends on the
+locale of the region being scraped, so a PriceParser is built per currency
+(and optionally country) with a single precompiled regular expression, and
+can parse whole lists of strings in one call.
+"""
+
+import re
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
+
+# Separators and symbols used to write prices in a currency. minor_symbols are
+# suffixes marking an amount in the minor unit (eg: 50p), and symbol_after is
+# whether the currency symbol is written after the amount (eg: 12,99 €)
+PriceFormat = namedtuple('PriceFormat', ['decimal', 'groups', 'symbols', 'minor_symbols', 'symbol_after'], defaults=[(), False])
+
+DEFAULT_FORMAT = PriceFormat('.', (',',), ('$', '£', '€'))
+
+# Formats by Currency.abbreviation
+CURRENCY_FORMATS = {
+        'GBP': PriceFormat('.', (',',), ('£', 'GBP'), ('p',)),
+        'USD': PriceFormat('.', (',',), ('US$', '$', 'USD'), ('¢', 'c')),
+        'EUR': PriceFormat(',', ('.', ' ', ' '), ('€', 'EUR'), ('c',), symbol_after=True),
+        'UAH': PriceFormat(',', (' ', ' ', '.'), ('грн.', 'грн', '₴', 'UAH', 'HRN'), symbol_after=True),
+        'HRN': PriceFormat(',', (' ', ' ', '.'), ('грн.', 'грн', '₴', 'UAH', 'HRN'), symbol_after=True),
+        'PLN': PriceFormat(',', (' ', ' ', '.'), ('zł', 'PLN'), symbol_after=True),
+        'CHF': PriceFormat('.', ("'", '’', ','), ('CHF', 'Fr.')),
+        'JPY': PriceFormat('.', (',',), ('¥', '円', 'JPY')),
+        }
+
+# Overrides for countries that write a shared currency differently, keyed by
+# (Currency.abbreviation, Country.name)
+COUNTRY_FORMATS = {
+        ('EUR', 'Ireland'): PriceFormat('.', (',',), ('€', 'EUR'), ('c',)),
+        ('EUR', 'Malta'): PriceFormat('.', (',',), ('€', 'EUR'), ('c',)),
+        }
+
+# Units that a price can be given per, as written after "/" or "per"
+UNITS = ('100g', '100ml', 'kg', 'g', 'l', 'ltr', 'litre', 'ml', 'lb', 'oz', 'each', 'ea', 'unit', 'item', 'pack')
+
+# Units which still mean the price of a single item
+ITEM_UNITS = ('each', 'ea', 'unit', 'item')
+
+# Words between the quantity and the amount of a multibuy, eg: "3 for £2"
+MULTIBUY_WORDS = ('for', 'x', 'для')
+
+# Words marking an amount that is not the current price, eg: "Was £2.00"
+REFERENCE_WORDS = ('was', 'rrp', 'save')
+
+CENT = Decimal('0.01')
+
+class ParsedPrice(namedtuple('ParsedPrice', ['amount', 'quantity', 'unit', 'currency'])):
+    """
+    Short Summary
+    -------------
+    A price parsed from text
+
+    Extended Summary
+    ----------------
+    amount - the price as written, as a Decimal (2 for "3 for £2")
+    quantity - number of items the amount buys (3 for "3 for £2", otherwise 1)
+    unit - unit the price is given per (eg: 'kg' for "£1.20/kg"), or None
+    currency - abbreviation of the currency the text was parsed as
+    """
+    __slots__ = ()
+
+    @property
+    def unit_price(self):
+        """ Price of a single item (or unit) rounded to the nearest minor unit """
+        return (self.amount / self.quantity).quantize(CENT, rounding=ROUND_HALF_UP)
+
+    @property
+    def per_item(self):
+        """ Whether this is the price of an item, rather than per weight or volume """
+        return self.unit is None or self.unit in ITEM_UNITS
+
+class PriceParser:
+    """
+    Short Summary
+    -------------
+    Parse price text written in a particular locale
+
+    Extended Summary
+    ----------------
+    Usage, eg:
+
+        parser = PriceParser.for_region(region)
+        parser.parse("3 for £2").unit_price    # Decimal('0.67')
+        parser.parse_many(texts)               # [ParsedPrice or None, ...]
+
+    Numbers next to a currency symbol are preferred, so counts and sizes such
+    as "Pack of 6 £3.00" or "1,5 kg 3,99 €" are ignored, along with amounts
+    after "was", "RRP" or "save". Of several such prices, the last price of an
+    item (rather than per weight or volume) is taken, eg: £1.50 from "Was
+    £2.00 Now £1.50". Only text with no currency symbol at all is parsed as a
+    bare number, and then only if a single number (or a single one with a
+    decimal fraction) could be the price. Multibuys are only recognised with
+    a currency, so "3 for 2" gives None. Text containing no price gives None.
+
+    Parameters
+    ----------
+    price_format : PriceFormat
+        Separators and symbols of the locale
+    currency : str
+        Currency abbreviation recorded in parsed prices
+    """
+    def __init__(self, price_format=DEFAULT_FORMAT, currency=None):
+        self.format = price_format
+        self.currency = currency
+        self._pattern = self._compile(price_format)
+        self._strip = str.maketrans('', '', ''.join(price_format.groups))
+
+    @classmethod
+    def for_currency(cls, currency, country=None):
+        """
+        Get the (shared) parser for a currency abbreviation and optionally a
+        country name
+        """
+        return _get_parser(currency.upper() if currency else None, country)
+
+    @classmethod
+    def for_region(cls, region):
+        """ Get the (shared) parser for a Regions currency and country """
+        currency = region.currency.abbreviation if region.currency is not None else None
+        country = region.country.name if region.country is not None else None
+        return cls.for_currency(currency, country)
+
+    @staticmethod
+    def _compile(price_format):
+        def alternatives(values):
+            # Longest first, so eg: "грн." is preferred over "грн"
+            return '|'.join(re.escape(value) for value in sorted(values, key=len, reverse=True))
+        dec = re.escape(price_format.decimal)
+        groups = ''.join(re.escape(group) for group in price_format.groups)
+        symbol = f'(?:{alternatives(price_format.symbols)})'
+        # A separator followed by one or two digits can only be a decimal
+        # point, so the locale only decides the meaning of eg: "1,234"
+        number = (
+                rf'(?P<integer>\d{{1,3}}(?:[{groups}]\d{{3}})+(?!\d)|\d+|(?=[.,]\d))'
+                rf'(?:(?:{dec}|[.,](?=\d{{1,2}}(?!\d)))(?P<fraction>\d+))?'
+                )
+        minor = rf'(?P<minor>{alternatives(price_format.minor_symbols)})(?![^\W\d_])' if price_format.minor_symbols else '(?P<minor>(?!))'
+        # A percentage or a weight or volume written straight after a number,
+        # eg: "20%" or "1,5 kg", is a size rather than a price
+        size = rf'(?:%|(?:{alternatives(unit for unit in UNITS if unit not in ITEM_UNITS)})(?![^\W\d_]))'
+        # Where the symbol is written before amounts, one between two amounts
+        # belongs to the second (eg: "Pack of 6 £3.00"), unless that is a size
+        suffix_end = '' if price_format.symbol_after else rf'(?!\s?[\d.,]*\d(?![\d.,]*\s?{size}))'
+        return re.compile(
+                rf'(?:(?P<quantity>\d+)\s*(?:{alternatives(MULTIBUY_WORDS)})\s+)?'
+                rf'(?P<prefix>{symbol}\s?)?'
+                rf'{number}'
+                rf'(?:\s?{minor}|\s?(?P<suffix>{symbol}){suffix_end}|\s?(?P<measure>{size}))?'
+                rf'(?:\s*(?:/|per\s)\s*(?P<unit>{alternatives(UNITS)})\b)?',
+                re.IGNORECASE
+                )
+
+    def parse(self, text):
+        """ Parse a single price string, returning a ParsedPrice or None """
+        if text is None:
+            return None
+        match = self._choose(text)
+        if match is None:
+            return None
+        return self._build(match)
+
+    def parse_many(self, texts):
+        """
+        Short Summary
+        -------------
+        Parse a list of price strings, returning a list of ParsedPrice (or
+        None for strings with no price) in the same order
+
+        Extended Summary
+        ----------------
+        Identical strings (common across sites and cycles) are only parsed
+        once per call.
+        """
+        parse = self.parse
+        parsed = {}
+        results = []
+        for text in texts:
+            try:
+                result = parsed[text]
+            except KeyError:
+                result = parsed[text] = parse(text)
+            results.append(result)
+        return results
+
+    def _choose(self, text):
+        """ Pick the match of the price out of all the numbers in text """
+        marked, bare = [], []
+        for match in self._pattern.finditer(text):
+            if _REFERENCE.search(text, 0, match.start()):
+                continue
+            if match.group('prefix') or match.group('suffix') or match.group('minor'):
+                if match.group('measure') != '%':
+                    marked.append(match)
+            elif not (match.group('quantity') or match.group('measure')):
+                bare.append(match)
+        if marked:
+            items = [match for match in marked if self._unit(match) in (None,) + ITEM_UNITS]
+            return (items or marked)[-1]
+        if self._has_symbol(text):
+            return None
+        if len(bare) > 1:
+            bare = [match for match in bare if match.group('fraction')]
+        return bare[0] if len(bare) == 1 else None
+
+    def _has_symbol(self, text):
+        text = text.lower()
+        return any(symbol.lower() in text for symbol in self.format.symbols)
+
+    @staticmethod
+    def _unit(match):
+        unit = match.group('unit') or match.group('measure')
+        return unit.lower() if unit else None
+
+    def _build(self, match):
+        integer, fraction, minor, quantity = match.group('integer', 'fraction', 'minor', 'quantity')
+        integer = integer.translate(self._strip) or '0'
+        amount = Decimal(f'{integer}.{fraction}' if fraction else integer)
+        if minor:
+            amount = amount / 100
+        return ParsedPrice(
+                amount,
+                int(quantity) if quantity and int(quantity) > 0 else 1,
+                self._unit(match),
+                self.currency
+                )
+
+# An amount straight after one of REFERENCE_WORDS, searched for in the text
+# before a match
+_REFERENCE = re.compile(rf'\b(?:{"|".join(REFERENCE_WORDS)})\b\W*$', re.IGNORECASE)
+
+@lru_cache(maxsize=None)
+def _get_parser(currency, country):
+    price_format = COUNTRY_FORMATS.get((currency, country)) or CURRENCY_FORMATS.get(currency, DEFAULT_FORMAT)
+    return PriceParser(price_format, currency)
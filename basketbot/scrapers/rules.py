@@ -0,0 +1,202 @@
+"""
+Compiled representations of scraping rules.
+
+A ScrapingRule stores its class chain as JSON, with JavaScript style tag names
+and class lists. Compiling a rule turns this into an immutable structure of
+pre-split tag names and class sets that can be matched against a DOM many times
+without re-reading the JSON.
+"""
+
+from collections import namedtuple
+from threading import Lock
+from basketbot import InvalidClassChain
+from basketbot.scrapers.parsers import get_backend
+
+TEXT_NODE = '#text'
+
+# A single DOM node in a compiled class chain. tag is the BeautifulSoup style
+# (lower case) tag name and classes is a frozenset of required class names
+CompiledNode = namedtuple('CompiledNode', ['tag', 'classes'])
+
+# One level of a compiled class chain: the tree_node to descend into, along
+# with its recorded siblings
+CompiledLevel = namedtuple('CompiledLevel', ['tree_node', 'siblings'])
+
+def bs_tag(dom_type):
+    """
+    Short Summary
+    -------------
+    Convert a JavaScript style tag name (eg: DIV) to BeautifulSoup notation
+
+    Extended Summary
+    ----------------
+    JavaScript reports element tagName values in upper case for HTML documents,
+    whilst BeautifulSoup lower cases all tag names. Text nodes keep their
+    #text name in both notations.
+    """
+    return dom_type if dom_type == TEXT_NODE else dom_type.lower()
+
+def compile_node(node):
+    """
+    Short Summary
+    -------------
+    Compile a single {"dom_type": ..., "classes": [...]} class chain node
+    """
+    classes = node.get('classes') or []
+    if isinstance(classes, str):
+        classes = classes.split()
+    return CompiledNode(bs_tag(node['dom_type']), frozenset(classes))
+
+def compile_class_chain(class_chain):
+    """
+    Short Summary
+    -------------
+    Compile a class chain JSON object into a tuple of CompiledLevel objects
+
+    Extended Summary
+    ----------------
+    Levels are ordered by their numeric tree level. A #text tree_node can only
+    appear as the final level of a chain (it denotes the text of the element
+    above it), and is dropped from the compiled chain as the text of the
+    final element is what is extracted anyway.
+    """
+    if not isinstance(class_chain, dict):
+        raise InvalidClassChain("ClassChain is not an object")
+    try:
+        keys = sorted(class_chain.keys(), key=int)
+    except ValueError:
+        raise InvalidClassChain("Provided ClassChain does not use numeric keys")
+    levels = []
+    for pos, key in enumerate(keys):
+        level = class_chain[key]
+        tree_node = compile_node(level['tree_node'])
+        if tree_node.tag == TEXT_NODE:
+            if pos != len(keys) - 1:
+                raise InvalidClassChain("A #text tree_node can only be the final level of a ClassChain")
+            break
+        siblings = tuple(compile_node(s) for s in level.get('siblings') or [])
+        levels.append(CompiledLevel(tree_node, siblings))
+    return tuple(levels)
+
+
+class CompiledRule(namedtuple('CompiledRule', ['parent_tag', 'parent_id', 'levels'])):
+    """
+    Short Summary
+    -------------
+    An immutable, pre-processed version of a ScrapingRule ready for matching
+
+    Extended Summary
+    ----------------
+    parent_tag - BeautifulSoup style tag name of the rules parent element
+    parent_id - the HTML id of the parent element
+    levels - tuple of CompiledLevel objects to descend through from the parent
+
+    Compiled rules are plain tuples, so they can be hashed, compared and
+    pickled (eg: for sending to worker processes).
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_rule(cls, rule):
+        """
+        Build a CompiledRule from a basketbot.datamodel.ScrapingRule
+        """
+        return cls(
+                bs_tag(rule.parent_elem.bs_name),
+                rule.parent_id,
+                compile_class_chain(rule.class_chain)
+                )
+
+    def match(self, dom, backend=None):
+        """
+        Short Summary
+        -------------
+        Find the DOM element located by this rule, or None if not found
+
+        Extended Summary
+        ----------------
+        Starting from the parent element, the tree_node of each level must
+        be a direct child of the previous element with the required tag and
+        (at least) the required classes. Where several children match a level,
+        a depth-first search is used and the first route through the DOM that
+        satisfies the remainder of the chain wins.
+
+        Parameters
+        ----------
+        dom
+            A DOM produced by the parse method of backend
+        backend : basketbot.scrapers.parsers.ParserBackend or str
+            The parser backend that built dom (default: configured backend)
+        """
+        backend = get_backend(backend)
+        anchor = backend.find_anchor(dom, self.parent_tag, self.parent_id)
+        if anchor is None:
+            return None
+        return self._descend(anchor, 0, backend)
+
+    def _descend(self, elem, depth, backend):
+        if depth == len(self.levels):
+            return elem
+        node = self.levels[depth].tree_node
+        for child in backend.children(elem, node.tag):
+            if node.classes.issubset(backend.classes(child)):
+                found = self._descend(child, depth + 1, backend)
+                if found is not None:
+                    return found
+        return None
+
+    def extract(self, dom, backend=None):
+        """
+        Return the stripped text of the element located by this rule, or
+        None if the rule does not match the DOM
+        """
+        backend = get_backend(backend)
+        elem = self.match(dom, backend)
+        return None if elem is None else backend.text(elem)
+
+
+class RuleCache:
+    """
+    Short Summary
+    -------------
+    Process wide cache of CompiledRule objects
+
+    Extended Summary
+    ----------------
+    Entries are keyed by ScrapingRule id and are only reused whilst the rules
+    update_time is unchanged, so editing a rule causes it to be recompiled the
+    next time it is requested.
+    """
+    def __init__(self):
+        self._rules = {}
+        self._lock = Lock()
+
+    def get(self, rule):
+        """
+        Get the CompiledRule for a ScrapingRule, compiling it if necessary
+        """
+        key = (rule.id, rule.update_time)
+        entry = self._rules.get(rule.id)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        compiled = CompiledRule.from_rule(rule)
+        # Unsaved rules have no id, so don't keep them around
+        if rule.id is not None:
+            with self._lock:
+                self._rules[rule.id] = (key, compiled)
+        return compiled
+
+    def invalidate(self, rule_id=None):
+        """
+        Drop a single rule (or all rules if rule_id is None) from the cache
+        """
+        with self._lock:
+            if rule_id is None:
+                self._rules.clear()
+            else:
+                self._rules.pop(rule_id, None)
+
+    def __len__(self):
+        return len(self._rules)
+
+rule_cache = RuleCache()
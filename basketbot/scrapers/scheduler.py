@@ -0,0 +1,438 @@
+"""
+Staleness-driven scheduling of scrapes.
+
+There are far more (retail site, item) prices than can be fetched in a cycle,
+so ScrapeScheduler keeps them all in a priority queue and hands out the ones
+that matter most first. A task grows more urgent the longer it has been since
+its price was last scraped successfully, jumps ahead when the basket of a
+region that uses it has changed (a new Region.basket_version), and is weighted
+by how many regions depend on its retail site. Per-domain minimum intervals
+stop the scheduler from handing out back-to-back work for one retailer.
+"""
+
+import heapq
+import itertools
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func
+from basketbot import db
+from basketbot.datamodel import model as dm
+
+# A price to scrape: one item on one retail site
+ScrapeTask = namedtuple('ScrapeTask', ['retail_site_id', 'item_id'])
+
+_REMOVED = object() # Placeholder for queue entries that have been superseded
+
+def _now():
+    return datetime.now(timezone.utc)
+
+def _seconds(value):
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+class _TaskState:
+    """ Everything the scheduler knows about a single ScrapeTask """
+    __slots__ = ('domain', 'n_regions', 'basket_versions', 'basket_update_time', 'last_success', 'success_versions')
+
+    def __init__(self, domain, n_regions=0, basket_versions=None, basket_update_time=None):
+        self.domain = domain
+        self.n_regions = n_regions
+        self.basket_versions = basket_versions or {}
+        self.basket_update_time = basket_update_time
+        self.last_success = None
+        self.success_versions = None # basket_versions as of last_success
+
+    def basket_changed(self):
+        """ Whether a relevant regions basket has changed since the last success """
+        if self.last_success is None:
+            return False
+        if self.success_versions is not None and self.success_versions != self.basket_versions:
+            return True
+        return self.basket_update_time is not None and self.basket_update_time > self.last_success
+
+
+class ScrapeScheduler:
+    """
+    Short Summary
+    -------------
+    Priority queue of ScrapeTasks, most stale and most important first
+
+    Extended Summary
+    ----------------
+    The priority of a task is
+
+        (staleness + basket_change_bonus) * (1 + number of regions served by the site)
+
+    where staleness is the time since the last successful scrape of the task
+    (never_scraped_age if it has never succeeded) and basket_change_bonus is
+    only added when a region the task belongs to has had its basket version
+    changed since then. Usage, eg:
+
+        scheduler = ScrapeScheduler.from_config(app.config).load()
+        for retail_site_id, tasks in scheduler.take(budget, group_site=True):
+            ... fetch and scrape ...
+            for task in tasks:
+                scheduler.complete(task, success)
+
+    Priorities grow with time, so they are computed when a task is queued and
+    can be brought up to date for the whole queue with refresh().
+
+    Parameters
+    ----------
+    min_interval : float or timedelta
+        Default minimum time in seconds between tasks handed out for the same
+        domain (default: 0)
+    domain_intervals : dict
+        Per domain overrides of min_interval
+    never_scraped_age : float or timedelta
+        Staleness in seconds given to tasks that have never succeeded
+        (default: 7 days)
+    basket_change_bonus : float or timedelta
+        Extra staleness in seconds given to tasks whose region baskets have
+        changed since their last success (default: 1 day)
+    """
+    def __init__(self, min_interval=0, domain_intervals=None, never_scraped_age=timedelta(days=7), basket_change_bonus=timedelta(days=1)):
+        self.min_interval = _seconds(min_interval)
+        self.domain_intervals = {domain: _seconds(interval) for domain, interval in (domain_intervals or {}).items()}
+        self.never_scraped_age = _seconds(never_scraped_age)
+        self.basket_change_bonus = _seconds(basket_change_bonus)
+        self._tasks = {}
+        self._entries = {} # Queue entry of each queued task
+        self._counter = itertools.count()
+        # Each domain has its own queue of tasks, and the domains are queued
+        # by the (possibly outdated, but never less urgent) key of their most
+        # urgent task. Domains waiting out their interval are parked in a
+        # queue ordered by when they are next allowed, so a pop never has to
+        # step over the tasks of busy domains.
+        self._queues = {}
+        self._sizes = {}
+        self._domain_queue = []
+        self._domain_keys = {}
+        self._parked = []
+        self._parked_domains = set()
+        self._next_allowed = {}
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """
+        Create a scheduler using SCRAPER_DOMAIN_INTERVAL and
+        SCRAPER_DOMAIN_INTERVALS from a Flask config, with any kwargs taking
+        precedence
+        """
+        settings = dict(
+                min_interval=config.get('SCRAPER_DOMAIN_INTERVAL', 0),
+                domain_intervals=config.get('SCRAPER_DOMAIN_INTERVALS'),
+                )
+        settings.update(kwargs)
+        return cls(**settings)
+
+    @staticmethod
+    def site_domain(retail_site):
+        """ Domain that intervals are applied to for a RetailSite """
+        return f'{retail_site.url_domain}.{retail_site.url_suffix}'.lower()
+
+    # Building the queue
+
+    def add(self, task, domain, n_regions=0, basket_versions=None, basket_update_time=None, last_success=None, now=None):
+        """
+        Short Summary
+        -------------
+        Add a task, or update what is known about a queued one
+
+        Parameters
+        ----------
+        task : ScrapeTask
+            The task to add
+        domain : str
+            Domain of the tasks retail site
+        n_regions : int
+            Number of regions served by the tasks retail site
+        basket_versions : dict
+            Map from region id to Region.basket_version, for the regions whose
+            baskets contain the item
+        basket_update_time : datetime
+            Latest Region.basket_version_update_time of those regions
+        last_success : datetime
+            Time of the last successful scrape known from stored data (only
+            used if later than the one recorded by the scheduler)
+        """
+        state = self._tasks.get(task)
+        if state is None:
+            state = self._tasks[task] = _TaskState(domain)
+        state.domain = domain
+        state.n_regions = n_regions
+        state.basket_versions = dict(basket_versions or {})
+        state.basket_update_time = basket_update_time
+        if last_success is not None and (state.last_success is None or last_success > state.last_success):
+            # Basket versions at that time are unknown, so basket_changed
+            # compares against basket_update_time
+            state.last_success = last_success
+            state.success_versions = None
+        self._push(task, now)
+
+    def remove(self, task):
+        """ Drop a task from the scheduler entirely """
+        self._tasks.pop(task, None)
+        self._discard(task)
+
+    def load(self, session=None, now=None):
+        """
+        Short Summary
+        -------------
+        Queue a task for every item in the basket of every retail site
+
+        Extended Summary
+        ----------------
+        A sites basket is the same as RetailSite.basket_items: items flagged as
+        in all regions, and items in any region the site serves. The whole load
+        takes a fixed number of queries. The last success of each task is
+        seeded from the latest PriceObservation of its item on its site, so
+        scrape history survives restarts. Tasks that are no longer in any
+        basket are dropped, and the scrape history of remaining tasks is kept,
+        so this can be called again to pick up changes. Returns the scheduler.
+        """
+        session = session or db.session
+        sites = session.query(dm.RetailSite.id, dm.RetailSite.url_domain, dm.RetailSite.url_suffix).all()
+        site_regions = {}
+        for site_id, region_id in session.query(dm.RegionRetailSite.c.retail_site_id, dm.RegionRetailSite.c.region_id):
+            site_regions.setdefault(site_id, set()).add(region_id)
+        regions = {
+                region_id: (version, update_time)
+                for region_id, version, update_time in session.query(dm.Region.id, dm.Region.basket_version, dm.Region.basket_version_update_time)
+                }
+        item_regions = {}
+        for item_id, region_id in session.query(dm.RegionItem.c.item_id, dm.RegionItem.c.region_id):
+            item_regions.setdefault(item_id, set()).add(region_id)
+        all_region_items = [item_id for item_id, in session.query(dm.Item.id).filter(dm.Item.all_regions)]
+        observed = dm.PriceObservation
+        last_observed = {
+                ScrapeTask(site_id, item_id): observed_at
+                for site_id, item_id, observed_at in session.query(
+                    observed.retail_site_id, observed.item_id, func.max(observed.observed_at)
+                    ).group_by(observed.retail_site_id, observed.item_id)
+                }
+
+        loaded = set()
+        for site in sites:
+            served = site_regions.get(site.id, set())
+            basket = {item_id: served & item_regions.get(item_id, set()) for item_id in item_regions}
+            basket = {item_id: relevant for item_id, relevant in basket.items() if relevant}
+            for item_id in all_region_items:
+                basket[item_id] = served
+            for item_id, relevant in basket.items():
+                task = ScrapeTask(site.id, item_id)
+                self.add(
+                        task,
+                        self.site_domain(site),
+                        n_regions=len(served),
+                        basket_versions={region_id: regions[region_id][0] for region_id in relevant},
+                        basket_update_time=max((regions[region_id][1] for region_id in relevant), default=None),
+                        last_success=last_observed.get(task),
+                        now=now
+                        )
+                loaded.add(task)
+        for task in set(self._tasks) - loaded:
+            self.remove(task)
+        return self
+
+    # Priorities
+
+    def priority(self, task, now=None):
+        """ Current priority of a task (higher is more urgent) """
+        state = self._tasks[task]
+        now = now or _now()
+        if state.last_success is None:
+            staleness = self.never_scraped_age
+        else:
+            staleness = max((now - state.last_success).total_seconds(), 0)
+        if state.basket_changed():
+            staleness += self.basket_change_bonus
+        return staleness * (1 + state.n_regions)
+
+    def refresh(self, now=None):
+        """ Recompute the priority of every queued task """
+        now = now or _now()
+        tasks = list(self._entries)
+        # Rebuild the queues rather than leave an entry behind for every task
+        self._entries.clear()
+        self._queues.clear()
+        self._sizes.clear()
+        self._domain_queue = []
+        self._domain_keys.clear()
+        for task in tasks:
+            self._push(task, now)
+
+    # Handing out tasks
+
+    def interval(self, domain):
+        return self.domain_intervals.get(domain, self.min_interval)
+
+    def pop(self, now=None):
+        """
+        Short Summary
+        -------------
+        Take the most urgent task whose domain is not waiting out its minimum
+        interval, or None if there is no such task
+        """
+        now = now or _now()
+        task = self._pop_ready(now)
+        if task is not None:
+            self._mark_domain(task, now)
+        return task
+
+    def pop_site(self, now=None):
+        """
+        Short Summary
+        -------------
+        Take the most urgent ready task along with every other queued task for
+        the same retail site
+
+        Extended Summary
+        ----------------
+        A single page fetch can provide the prices of many items on a site
+        (see basketbot.scrapers.extract), so this hands out all of a sites
+        queued tasks at once. Returns a (retail_site_id, [ScrapeTask]) tuple
+        with tasks in priority order, or None if nothing is ready.
+        """
+        now = now or _now()
+        first = self._pop_ready(now)
+        if first is None:
+            return None
+        domain = self._tasks[first].domain
+        self._mark_domain(first, now)
+        others = [
+                entry for entry in self._queues.get(domain, ())
+                if entry[-1] is not _REMOVED and entry[-1].retail_site_id == first.retail_site_id
+                ]
+        others = [entry[-1] for entry in sorted(others)]
+        for task in others:
+            self._discard(task)
+        return first.retail_site_id, [first] + others
+
+    def take(self, budget, now=None, group_site=False):
+        """
+        Take up to budget tasks (or (retail_site_id, tasks) groups if
+        group_site is True), stopping early if no more are ready
+        """
+        pop = self.pop_site if group_site else self.pop
+        taken = []
+        while len(taken) < budget:
+            task = pop(now)
+            if task is None:
+                break
+            taken.append(task)
+        return taken
+
+    def complete(self, task, success, when=None):
+        """
+        Short Summary
+        -------------
+        Record the outcome of a scrape task and put it back in the queue
+
+        Extended Summary
+        ----------------
+        A failed task keeps its last success time, so it stays stale and will
+        be handed out again once its domain is ready.
+        """
+        state = self._tasks.get(task)
+        if state is None:
+            return
+        when = when or _now()
+        if success:
+            state.last_success = when
+            state.success_versions = dict(state.basket_versions)
+        self._push(task, when)
+
+    def record_success(self, task, when):
+        """ Set the time of the last successful scrape of a task, eg: from stored prices """
+        state = self._tasks.get(task)
+        if state is not None:
+            state.last_success = when
+            state.success_versions = dict(state.basket_versions)
+            if task in self._entries:
+                self._push(task)
+
+    def next_ready(self):
+        """ Earliest time that a queued task's domain will be ready, or None if there are no tasks """
+        domains = [domain for domain, size in self._sizes.items() if size]
+        if not domains:
+            return None
+        return min(self._next_allowed.get(domain, datetime.min.replace(tzinfo=timezone.utc)) for domain in domains)
+
+    # Queue internals
+
+    def _push(self, task, now=None):
+        self._discard(task)
+        domain = self._tasks[task].domain
+        entry = [-self.priority(task, now), next(self._counter), domain, task]
+        self._entries[task] = entry
+        heapq.heappush(self._queues.setdefault(domain, []), entry)
+        self._sizes[domain] = self._sizes.get(domain, 0) + 1
+        key = self._domain_keys.get(domain)
+        if domain not in self._parked_domains and (key is None or entry[:2] < key):
+            self._queue_domain(domain, entry[:2])
+
+    def _discard(self, task):
+        entry = self._entries.pop(task, None)
+        if entry is not None:
+            entry[-1] = _REMOVED
+            self._sizes[entry[2]] -= 1
+
+    def _head(self, domain):
+        """ Queue entry of the most urgent task of a domain, or None """
+        queue = self._queues.get(domain)
+        while queue and queue[0][-1] is _REMOVED:
+            heapq.heappop(queue)
+        return queue[0] if queue else None
+
+    def _queue_domain(self, domain, key):
+        self._domain_keys[domain] = key
+        heapq.heappush(self._domain_queue, (key, domain))
+
+    def _pop_ready(self, now):
+        # Bring back parked domains that are now allowed
+        while self._parked and self._parked[0][0] <= now:
+            _, _, domain = heapq.heappop(self._parked)
+            allowed = self._next_allowed.get(domain)
+            if allowed is not None and allowed > now:
+                heapq.heappush(self._parked, (allowed, next(self._counter), domain))
+                continue
+            self._parked_domains.discard(domain)
+            head = self._head(domain)
+            if head is not None:
+                self._queue_domain(domain, head[:2])
+        while self._domain_queue:
+            key, domain = heapq.heappop(self._domain_queue)
+            if self._domain_keys.get(domain) != key:
+                continue # Superseded by a more urgent key
+            del self._domain_keys[domain]
+            head = self._head(domain)
+            if head is None:
+                continue
+            if head[:2] != key:
+                # The most urgent task was removed, so requeue at the next one
+                self._queue_domain(domain, head[:2])
+                continue
+            allowed = self._next_allowed.get(domain)
+            if allowed is not None and allowed > now:
+                self._parked_domains.add(domain)
+                heapq.heappush(self._parked, (allowed, next(self._counter), domain))
+                continue
+            heapq.heappop(self._queues[domain])
+            task = head[-1]
+            del self._entries[task]
+            self._sizes[domain] -= 1
+            head = self._head(domain)
+            if head is not None:
+                self._queue_domain(domain, head[:2])
+            return task
+        return None
+
+    def _mark_domain(self, task, now):
+        domain = self._tasks[task].domain
+        self._next_allowed[domain] = now + timedelta(seconds=self.interval(domain))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, task):
+        return task in self._entries
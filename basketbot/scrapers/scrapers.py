@@ -1,13 +1,52 @@
-import requests
-from bs4 import BeautifulSoup
-import bs4
+from basketbot.scrapers.fetch import fetch_page
+from basketbot.scrapers.rules import CompiledRule, compile_class_chain, bs_tag, rule_cache
+from basketbot.scrapers.parsers import get_backend
 
 class ScrapeWithClassChain:
-    def __init__(self, base_id, class_chain):
+    def __init__(self, base_id, class_chain, parent_elem='div', compiled=None, backend=None, partial=False):
+        """
+        Parameters
+        ----------
+        base_id : str
+            The HTML id of the parent element to start scraping from
+        class_chain : dict
+            Class chain JSON to follow from the parent element
+        parent_elem : str
+            Tag name of the parent element (default: 'div')
+        compiled : basketbot.scrapers.rules.CompiledRule
+            Optional precompiled rule, used instead of compiling class_chain
+        backend : str or basketbot.scrapers.parsers.ParserBackend
+            Parser backend to build DOMs with (default: configured backend)
+        partial : bool
+            If True then only the subtree below the parent element is parsed
+            and kept, rather than the whole document (default: False)
+        """
         self.base_id = base_id
         self.class_chain = class_chain
+        if compiled is None:
+            compiled = CompiledRule(bs_tag(parent_elem), base_id, compile_class_chain(class_chain))
+        self.rule = compiled
+        self.backend = get_backend(backend)
+        self.partial = partial
         self.dom = None
 
+    @classmethod
+    def from_rule(cls, rule, backend=None, partial=False):
+        """
+        Short Summary
+        -------------
+        Create a scraper from a basketbot.datamodel.ScrapingRule, using the
+        cached compiled version of the rule
+
+        Extended Summary
+        ----------------
+        If backend is not given then the parser backend set for the rules
+        retail site is used (or the deployment default if it has none)
+        """
+        if backend is None and rule.retail_site is not None:
+            backend = rule.retail_site.parser_backend
+        return cls(rule.parent_id, rule.class_chain, compiled=rule_cache.get(rule), backend=backend, partial=partial)
+
     def dom_from_html(self, html):
         """
         Short Summary
@@ -19,11 +58,10 @@ class ScrapeWithClassChain:
         todo
 
         """
-        self.dom = BeautifulSoup(html)
-        print(self.dom.prettify())
+        self.dom = self.__parse(html)
         return self.dom
 
-    def dom_from_url(self, url):
+    def dom_from_url(self, url, cache=None):
         """
         Short Summary
         -------------
@@ -31,59 +69,61 @@ class ScrapeWithClassChain:
         
         Extended Summary
         ----------------
-        todo
+        If a basketbot.scrapers.cache.PageCache is passed then the page is
+        revalidated against the cached copy rather than downloaded again
         """
-        html = requests.get(url)
-        self.dom = BeautifulSoup(html)
-        print(self.dom.prettify())
+        status, content = fetch_page(url, cache=cache)
+        self.dom = self.__parse(content)
         return self.dom
 
-    def scrape(self):
+    def dom_from_snapshot(self, snapshot_id, store):
         """
         Short Summary
         -------------
-        Scrape with loaded DOM and rules
+        Loads DOM from a page saved in a basketbot.scrapers.snapshots.SnapshotStore
         """
-        self.__check_for_dom()
-        pass
-
-    def __check_for_dom(self):
-        if self.dom is None:
-            raise Exception('DOM must first be loaded using ScrapeWithClassChain.dom_from_url or ScrapeWithClassChain.dom_from_html.')
+        self.dom = self.__parse(store.get(snapshot_id))
+        return self.dom
 
-    def __elem_by_classes(self, elem, classes, dom):
+    def scrape_url(self, url, cache=None):
         """
         Short Summary
         -------------
-        Given a position in the dom and a list of classes, find all elements containing all specified classes
+        Load the DOM from a URL and scrape it
 
         Extended Summary
         ----------------
-        Note that default behavior is:
-        * All listed classes must be present, if only a subset are, then the DOM element is not returned.
-        * A DOM element that contains these classes _and additional classes_ will be returned.
-        
-        Parameters
-        ----------
-        elem - str
-            A string naming the type of element to search for (eg: "div", "a", etc...)
-        classes - list(str)
-            A list of class names that the desired element of type elem posseses
-        dom - str
-            A specification of the area of DOM to search. Must contain bs4 style attr attribute and findAll method.
+        If a basketbot.scrapers.cache.PageCache is passed and the page content
+        is unchanged since this rule was last scraped from it, the previous
+        result is returned without parsing the page.
         """
-        if not (hasattr(dom, 'attrs') and hasattr(dom, 'findAll')):
-            raise Exception('Passed DOM object must have bs4 attrs and findAll attributes')
-        classes = classes if isinstance(classes, list) else [classes]
-        elems = dom.findAll(elem, {"class": classes.pop()})
-        
-        for cls in classes:
-            elems = [elem for elem in elems if cls in elem.attrs['class']]
-            if len(elems)==0:
-                break
-
-        return elems
+        status, content = fetch_page(url, cache=cache)
+        if cache is not None:
+            missing = object()
+            value = cache.get_extraction(url, self.rule, missing)
+            if value is not missing:
+                return value
+        self.dom = self.__parse(content)
+        value = self.scrape()
+        if cache is not None:
+            cache.set_extraction(url, self.rule, value)
+        return value
 
+    def scrape(self):
+        """
+        Short Summary
+        -------------
+        Scrape with loaded DOM and rules. Returns the text found at the end of
+        the class chain, or None if the rule does not match the DOM
+        """
+        self.__check_for_dom()
+        return self.rule.extract(self.dom, self.backend)
 
-        
+    def __parse(self, html):
+        if self.partial:
+            return self.backend.parse_subtree(html, self.rule.parent_tag, self.rule.parent_id)
+        return self.backend.parse(html)
 
+    def __check_for_dom(self):
+        if self.dom is None:
+            raise Exception('DOM must first be loaded using ScrapeWithClassChain.dom_from_url or ScrapeWithClassChain.dom_from_html.')
@@ -0,0 +1,165 @@
+"""
+Content-addressed store of compressed HTML snapshots.
+
+Every fetched page can be saved to a SnapshotStore, so that changed scraping
+rules can be re-run over past pages without fetching them again. Pages are
+keyed by the SHA-256 hash of their content, so a page that is identical across
+scrape cycles only takes up disk space once. Each scrape of a page appends a
+metadata record (URL, retail site and scrape time) alongside the snapshot.
+
+Layout on disk, for a snapshot with id abcdef...:
+
+    <root>/ab/abcdef....html.gz     compressed page content
+    <root>/ab/abcdef....jsonl       one JSON metadata record per scrape
+"""
+
+import gzip
+import json
+import os
+import re
+import tempfile
+from datetime import datetime, timezone
+from threading import Lock
+from basketbot import SnapshotNotFound
+from basketbot.scrapers.cache import content_hash
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SNAPSHOT_ID = re.compile('[0-9a-f]{64}')
+
+COMPRESSIONS = {
+        'gzip': '.html.gz',
+        'zstd': '.html.zst',
+        }
+
+class SnapshotStore:
+    """
+    Short Summary
+    -------------
+    A local, content-addressed store of compressed HTML pages
+
+    Parameters
+    ----------
+    root : str
+        Directory to keep snapshots in (created if necessary)
+    compression : str
+        Either 'gzip' or 'zstd' (requires the zstandard package). Snapshots
+        written with either compression can always be read back.
+    """
+    def __init__(self, root, compression='gzip'):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compression}, must be one of {", ".join(COMPRESSIONS)}')
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+        self.root = os.path.abspath(root)
+        self.compression = compression
+        self._lock = Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a store from SCRAPER_SNAPSHOT_DIR and SCRAPER_SNAPSHOT_COMPRESSION
+        config values. Returns None if no snapshot directory is configured.
+        """
+        root = config.get('SCRAPER_SNAPSHOT_DIR')
+        if not root:
+            return None
+        return cls(root, config.get('SCRAPER_SNAPSHOT_COMPRESSION', 'gzip'))
+
+    def _path(self, snapshot_id, suffix):
+        return os.path.join(self.root, snapshot_id[:2], snapshot_id + suffix)
+
+    def put(self, content, url=None, retail_site_id=None, fetched_at=None):
+        """
+        Short Summary
+        -------------
+        Store page content and record a scrape of it, returning the snapshot id
+
+        Extended Summary
+        ----------------
+        Content that is already in the store is not written again, only a new
+        metadata record is added.
+
+        Parameters
+        ----------
+        content : bytes or str
+            The page content as fetched
+        url : str
+            URL the page was fetched from
+        retail_site_id : int
+            Id of the RetailSite the page belongs to
+        fetched_at : datetime
+            Time of the scrape (default: now)
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        snapshot_id = content_hash(content)
+        if self._find(snapshot_id) is None:
+            self._write(self._path(snapshot_id, COMPRESSIONS[self.compression]), self._compress(content))
+        fetched_at = fetched_at or datetime.now(timezone.utc)
+        record = {
+                'url': url,
+                'retail_site_id': retail_site_id,
+                'fetched_at': fetched_at.isoformat(),
+                }
+        with self._lock:
+            with open(self._path(snapshot_id, '.jsonl'), 'a') as file:
+                file.write(json.dumps(record) + '\n')
+        return snapshot_id
+
+    def get(self, snapshot_id):
+        """ Get the (decompressed) content of a snapshot as bytes """
+        path = self._find(snapshot_id)
+        if path is None:
+            raise SnapshotNotFound(f'Snapshot {snapshot_id} not found')
+        with open(path, 'rb') as file:
+            data = file.read()
+        if path.endswith(COMPRESSIONS['zstd']):
+            if zstandard is None:
+                raise ValueError('Reading zstd snapshots requires the zstandard package')
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+    def metadata(self, snapshot_id):
+        """ Get the list of scrape metadata records for a snapshot """
+        if self._find(snapshot_id) is None:
+            raise SnapshotNotFound(f'Snapshot {snapshot_id} not found')
+        try:
+            with open(self._path(snapshot_id, '.jsonl')) as file:
+                return [json.loads(line) for line in file if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def _find(self, snapshot_id):
+        if not SNAPSHOT_ID.fullmatch(snapshot_id):
+            return None
+        for suffix in COMPRESSIONS.values():
+            path = self._path(snapshot_id, suffix)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _compress(self, content):
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(content)
+        return gzip.compress(content)
+
+    def _write(self, path, data):
+        # Write to a temporary file and rename, so that concurrent writers
+        # and readers never see a partially written snapshot
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def __contains__(self, snapshot_id):
+        return self._find(snapshot_id) is not None
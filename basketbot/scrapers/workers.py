@@ -0,0 +1,209 @@
+"""
+Process pool stage for the CPU bound parse/extract work of a scrape.
+
+Parsing HTML and walking class chains is pure Python (or holds the GIL), so a
+single scrape worker can only use one core for it. ExtractionPool sends
+(page content, compiled rule set) jobs to a pool of worker processes and gets
+back only the small dict of extracted values, never DOM objects. The number of
+jobs in flight is bounded, so when the pool is saturated it stops pulling from
+the fetch stage, which in turn pauses fetching.
+"""
+
+import asyncio
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from basketbot.scrapers.extract import MultiRuleExtractor
+from basketbot.scrapers.parsers import get_backend
+
+# A page to extract values from. rules is a tuple of (key, CompiledRule) pairs
+# (see ruleset), and context is passed through to the ExtractionResult. If
+# fingerprints is a dict from rule key to the previous Fingerprint of the rule
+# on this page (see basketbot.scrapers.fingerprint) then the rules are checked
+# against them
+ExtractionJob = namedtuple('ExtractionJob', ['content', 'rules', 'context', 'fingerprints'], defaults=[None, None])
+
+# The outcome of an ExtractionJob. values is a dict from rule key to the
+# extracted text (or None if the rule did not match), error is the exception
+# raised during extraction (or None). checks is a dict from rule key to
+# FingerprintCheck for jobs with fingerprints
+ExtractionResult = namedtuple('ExtractionResult', ['job', 'values', 'error', 'elapsed', 'checks'], defaults=[None])
+
+def ruleset(rules):
+    """
+    Convert a dict from key to CompiledRule into the hashable form used by
+    ExtractionJob, so that worker processes can reuse extractors between jobs
+    """
+    return tuple(sorted(rules.items(), key=lambda item: repr(item[0])))
+
+@lru_cache(maxsize=256)
+def _get_extractor(rules):
+    return MultiRuleExtractor(dict(rules))
+
+def extract_page(content, rules, backend=None):
+    """
+    Short Summary
+    -------------
+    Parse a page and extract all rules from it, returning a dict of values
+
+    Extended Summary
+    ----------------
+    This is the function run in worker processes. Where every rule starts
+    from the same parent element only that subtree of the page is parsed.
+
+    Parameters
+    ----------
+    content : bytes or str
+        The page HTML
+    rules : tuple
+        Rule set as produced by ruleset
+    backend : str
+        Name of the parser backend to use
+    """
+    extractor = _get_extractor(rules)
+    backend = get_backend(backend)
+    return extractor.extract(_parse_page(content, extractor, backend), backend)
+
+def check_page(content, rules, fingerprints, backend=None):
+    """
+    Parse a page and check all rules against their previous fingerprints,
+    returning a dict of FingerprintCheck (see MultiRuleExtractor.check)
+    """
+    extractor = _get_extractor(rules)
+    backend = get_backend(backend)
+    return extractor.check(_parse_page(content, extractor, backend), fingerprints, backend)
+
+def _parse_page(content, extractor, backend):
+    if len(extractor.anchors) == 1:
+        (tag, elem_id), = extractor.anchors
+        return backend.parse_subtree(content, tag, elem_id)
+    return backend.parse(content)
+
+
+class ExtractionPool:
+    """
+    Short Summary
+    -------------
+    Run extraction jobs in a pool of worker processes with backpressure
+
+    Extended Summary
+    ----------------
+    Usage from a coroutine, eg: fed by basketbot.scrapers.fetch.AsyncFetcher:
+
+        async def jobs():
+            async for result in fetcher.fetch(fetch_jobs):
+                if result.ok:
+                    yield ExtractionJob(result.content, rules, result.job)
+
+        with ExtractionPool(max_workers=16) as pool:
+            async for result in pool.extract(jobs()):
+                ...
+
+    At most max_pending jobs are in flight or waiting to be consumed at once.
+    Whilst that many are outstanding no more jobs are taken from the input, so
+    a fast producer is slowed down to the pace of the workers (or of the
+    consumer of the results, whichever is slower).
+
+    Parameters
+    ----------
+    max_workers : int
+        Number of worker processes (default: number of CPUs)
+    max_pending : int
+        Maximum number of jobs in flight or awaiting consumption (default:
+        twice max_workers)
+    backend : str
+        Name of the parser backend workers should use (default: configured
+        backend, resolved when the pool is created)
+    """
+    def __init__(self, max_workers=None, max_pending=None, backend=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.max_workers
+        self.backend = get_backend(backend).name
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+    async def extract(self, jobs):
+        """
+        Short Summary
+        -------------
+        Extract values for an (async or sync) iterable of ExtractionJob,
+        yielding ExtractionResult objects in the order they complete
+        """
+        loop = asyncio.get_running_loop()
+        # A slot is held from before a job is taken from the input until its
+        # result has been handed to the consumer
+        slots = asyncio.Semaphore(self.max_pending)
+        results = asyncio.Queue()
+        tasks = set()
+        finished = object()
+
+        async def run(job):
+            start = time.monotonic()
+            values, error, checks = None, None, None
+            try:
+                if job.fingerprints is None:
+                    values = await loop.run_in_executor(self._executor, extract_page, job.content, job.rules, self.backend)
+                else:
+                    checks = await loop.run_in_executor(self._executor, check_page, job.content, job.rules, job.fingerprints, self.backend)
+                    values = {key: check.text for key, check in checks.items()}
+            except Exception as e:
+                error = e
+            await results.put(ExtractionResult(job, values, error, time.monotonic() - start, checks))
+
+        async def feed():
+            try:
+                if hasattr(jobs, '__aiter__'):
+                    source = jobs.__aiter__()
+                    next_job = source.__anext__
+                else:
+                    source = iter(jobs)
+                    async def next_job():
+                        try:
+                            return next(source)
+                        except StopIteration:
+                            raise StopAsyncIteration
+                while True:
+                    await slots.acquire()
+                    try:
+                        job = await next_job()
+                    except StopAsyncIteration:
+                        slots.release()
+                        break
+                    task = asyncio.ensure_future(run(job))
+                    tasks.add(task)
+                    # Forget finished tasks, so long runs don't hold on to them
+                    task.add_done_callback(tasks.discard)
+                await asyncio.gather(*tasks)
+            finally:
+                await results.put(finished)
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            while (result := await results.get()) is not finished:
+                slots.release()
+                yield result
+            await feeder # Re-raise any error from the input iterable
+        finally:
+            feeder.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(feeder, *tasks, return_exceptions=True)
+
+    def map(self, jobs):
+        """
+        Synchronously extract an iterable of ExtractionJob, returning a list
+        of ExtractionResult objects in the order they completed
+        """
+        async def collect():
+            return [result async for result in self.extract(jobs)]
+        return asyncio.run(collect())
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
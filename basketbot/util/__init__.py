@@ -1,2 +1,5 @@
 from .db import *
+from .domains import *
 from .scraping import *
+from .http import *
+from .protocols import *
@@ -0,0 +1,92 @@
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+from threading import Lock
+from urllib.parse import urlsplit
+import tldextract
+
+# Parts of a hostname, eg: ('www', 'example', 'co.uk') for www.example.co.uk
+HostParts = namedtuple('HostParts', ['subdomain', 'domain', 'suffix'])
+
+def url_host(url_str):
+    """ Get the lower case hostname of a URL, which may not have a protocol """
+    if '://' not in url_str and not url_str.startswith('//'):
+        url_str = '//' + url_str
+    try:
+        return urlsplit(url_str).hostname or ''
+    except ValueError:
+        return ''
+
+class DomainExtractor:
+    """
+    Short Summary
+    -------------
+    Split hostnames into subdomain, domain and public suffix without using
+    the network
+
+    Extended Summary
+    ----------------
+    tldextract.extract with default settings may download (or refresh) the
+    public suffix list, and only builds its suffix data on the first call in
+    each process. DomainExtractor never fetches anything: it reads the suffix
+    list from a local file if suffix_list is given, and otherwise from the
+    snapshot bundled with tldextract. The data is loaded by load (called from
+    init_app at app startup) and results are memoized per hostname.
+
+    A module level instance (basketbot.util.domain_extractor) is configured
+    from the app config in create_app using the TLD_* config values.
+
+    Parameters
+    ----------
+    suffix_list : str or pathlib.Path
+        Path of a local public suffix list snapshot (default: None, use the
+        snapshot bundled with tldextract)
+    include_private_domains : bool
+        Whether to treat private suffixes (eg: blogspot.com) as suffixes
+    cache_size : int
+        Number of hostnames to memoize results for
+    """
+    def __init__(self, suffix_list=None, include_private_domains=False, cache_size=4096):
+        self.suffix_list = suffix_list
+        self.include_private_domains = include_private_domains
+        self.cache_size = cache_size
+        self._extractor = None
+        self._split = None
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """ Configure the extractor from a Flask app config, and load it """
+        self.suffix_list = app.config.get('TLD_SUFFIX_LIST', self.suffix_list)
+        self.include_private_domains = app.config.get('TLD_INCLUDE_PRIVATE_DOMAINS', self.include_private_domains)
+        self.cache_size = app.config.get('TLD_CACHE_SIZE', self.cache_size)
+        self.load()
+
+    def load(self):
+        """ (Re)build the extractor and load its suffix data """
+        urls = (Path(self.suffix_list).resolve().as_uri(),) if self.suffix_list else ()
+        extractor = tldextract.TLDExtract(
+                cache_dir=None,
+                suffix_list_urls=urls,
+                fallback_to_snapshot=not urls,
+                include_psl_private_domains=self.include_private_domains
+                )
+        extractor('example.com') # Loads the suffix data now, not on first use
+
+        @lru_cache(maxsize=self.cache_size)
+        def split(host):
+            result = extractor.extract_str(host)
+            return HostParts(result.subdomain, result.domain, result.suffix)
+
+        with self._lock:
+            self._extractor, self._split = extractor, split
+        return self
+
+    def extract(self, url_str):
+        """ Get the HostParts of a URL (or hostname) """
+        split = self._split if self._split is not None else self.load()._split
+        return split(url_host(url_str))
+
+    def cache_info(self):
+        return self._split.cache_info() if self._split is not None else None
+
+domain_extractor = DomainExtractor()
@@ -0,0 +1,99 @@
+from threading import Lock
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+class HTTPClient:
+    """
+    Short Summary
+    -------------
+    Shared HTTP client with a pool of keep-alive connections per host
+
+    Extended Summary
+    ----------------
+    Calling requests.get directly opens (and TLS handshakes) a new connection
+    for every request. HTTPClient instead keeps one requests.Session per host,
+    each with its own connection pool, so repeated requests to the same
+    retailer reuse open connections (and their TLS sessions).
+
+    A module level instance (basketbot.util.http_client) is configured from the
+    app config in create_app using the HTTP_* config values, and should be used
+    for all outgoing HTTP requests.
+
+    Parameters
+    ----------
+    pool_maxsize : int
+        Maximum number of connections kept open per host (default: 10)
+    timeout : float
+        Default timeout in seconds for requests (default: 10)
+    user_agent : str
+        User-Agent header to send, or None to use the requests default
+    max_retries : int
+        Number of retries for failed connections (default: 0)
+    """
+    def __init__(self, pool_maxsize=10, timeout=10, user_agent=None, max_retries=0):
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self.max_retries = max_retries
+        self._sessions = {}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """ Configure the client from a Flask app config """
+        self.close()
+        self.pool_maxsize = app.config.get('HTTP_POOL_MAXSIZE', self.pool_maxsize)
+        self.timeout = app.config.get('HTTP_TIMEOUT', self.timeout)
+        self.user_agent = app.config.get('HTTP_USER_AGENT', self.user_agent)
+        self.max_retries = app.config.get('HTTP_MAX_RETRIES', self.max_retries)
+
+    def session(self, url):
+        """
+        Get the (shared) requests.Session for the host of a URL
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc.lower())
+        session = self._sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = self._sessions[key] = self._create_session()
+        return session
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=self.pool_maxsize,
+                max_retries=self.max_retries
+                )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if self.user_agent:
+            session.headers['User-Agent'] = self.user_agent
+        return session
+
+    def request(self, method, url, **kwargs):
+        """
+        Make a request using the pooled session for the URLs host. Accepts the
+        same arguments as requests.request
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def close(self):
+        """ Close all pooled connections """
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for session in sessions.values():
+            session.close()
+
+http_client = HTTPClient()
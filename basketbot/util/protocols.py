@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+class ProtocolCache:
+    """
+    Short Summary
+    -------------
+    Cache of the protocol (http or https) supported by each host
+
+    Extended Summary
+    ----------------
+    decompose_url needs to know whether a host supports https when a URL is
+    given without a scheme, which means probing the live site. ProtocolCache
+    remembers the result of each probe per host: hosts found to support https
+    for ttl seconds, and hosts that did not for the shorter negative_ttl, so
+    that a host which starts serving https is noticed. Probes are bounded by
+    a strict timeout, and a probe that fails (eg: times out, or the host can
+    not be reached) raises basketbot.ProtocolProbeFailed rather than being
+    cached or taken to mean http.
+
+    A module level instance (basketbot.util.protocol_cache) is configured from
+    the app config in create_app using the PROTOCOL_* config values.
+
+    Parameters
+    ----------
+    ttl : float
+        Seconds for which a host found to support https is remembered
+    negative_ttl : float
+        Seconds for which a host that does not support https is remembered
+    timeout : float
+        Timeout in seconds of a probe request
+    max_hosts : int
+        Maximum number of hosts to remember (least recently probed are dropped)
+    """
+    def __init__(self, ttl=86400, negative_ttl=3600, timeout=2, max_hosts=10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.max_hosts = max_hosts
+        self._hosts = OrderedDict()
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """ Configure the cache from a Flask app config """
+        self.clear()
+        self.ttl = app.config.get('PROTOCOL_CACHE_TTL', self.ttl)
+        self.negative_ttl = app.config.get('PROTOCOL_CACHE_NEGATIVE_TTL', self.negative_ttl)
+        self.timeout = app.config.get('PROTOCOL_PROBE_TIMEOUT', self.timeout)
+
+    def get(self, host):
+        """
+        Get the protocol for a host (eg: www.example.com), probing it if
+        necessary
+        """
+        host = host.lower()
+        entry = self._hosts.get(host)
+        if entry is not None and entry[1] > monotonic():
+            return entry[0]
+        return self.probe(host)
+
+    def probe(self, host):
+        """
+        Probe a host now, caching and returning its protocol. Raises
+        basketbot.ProtocolProbeFailed (and caches nothing) if the probe fails
+        """
+        # Imported here, as basketbot.util.scraping uses this module
+        from basketbot.util.scraping import check_for_https
+        supported = check_for_https(f'http://{host}', timeout=self.timeout, strict=True)
+        protocol = 'https' if supported else 'http'
+        self.set(host, protocol, self.ttl if supported else self.negative_ttl)
+        return protocol
+
+    def set(self, host, protocol, ttl=None):
+        """ Record the protocol of a host, eg: for a host known in the DB """
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._hosts[host.lower()] = (protocol, monotonic() + ttl)
+            self._hosts.move_to_end(host.lower())
+            while len(self._hosts) > self.max_hosts:
+                self._hosts.popitem(last=False)
+
+    def clear(self):
+        """ Forget all hosts """
+        with self._lock:
+            self._hosts.clear()
+
+    def __len__(self):
+        return len(self._hosts)
+
+protocol_cache = ProtocolCache()
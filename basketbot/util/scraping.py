@@ -1,6 +1,9 @@
 from urllib.parse import urlparse
 import requests
-import tldextract
+from basketbot.util.http import http_client
+from basketbot.util.domains import domain_extractor, url_host
+from basketbot.util.protocols import protocol_cache
+from basketbot.exceptions import ProtocolProbeFailed
 
 def decompose_url(url_str):
     """
@@ -13,6 +16,12 @@ def decompose_url(url_str):
     Note that at the moment we include a subdomain (eg: www in www.example.com).
     But maybe we should only be storing and comparing the host (eg: example.com).
     A simple additional regex after the use of netloc could fix this.
+
+    If the URL has no protocol then the protocol supported by its host is
+    taken from protocol_cache, which only probes the live site when the host
+    is not cached, and raises basketbot.ProtocolProbeFailed if that probe
+    fails. The hostname is split using domain_extractor, which does not use
+    the network.
     """
     # Extract protocol, or determine it if necessary
     if 'http://' in url_str:
@@ -20,9 +29,8 @@ def decompose_url(url_str):
     elif 'https://' in url_str:
         protocol = 'https'
     else:
-        protocol = 'https' if check_for_https(url_str) else 'http'
-    tld_inf = tldextract.extract(url_str)
-    sd, d, s = (tld_inf.subdomain, tld_inf.domain, tld_inf.suffix)
+        protocol = protocol_cache.get(url_host(url_str) or url_str)
+    sd, d, s = domain_extractor.extract(url_str)
     return {
             'subdomain': sd if sd!='' else None,
             'domain': d if d!='' else None,
@@ -30,7 +38,7 @@ def decompose_url(url_str):
             'protocol': protocol
             }
 
-def check_for_https(uri):
+def check_for_https(uri, timeout=None, strict=False):
     """
     Short Summary
     -------------
@@ -38,17 +46,29 @@ def check_for_https(uri):
 
     Extended Summary
     ----------------
+    This always makes a request to the site (with the http_client timeout,
+    unless timeout is given), so decompose_url uses the cached result from
+    protocol_cache instead. A request that fails is taken to mean https is
+    not supported, unless strict is True, in which case
+    basketbot.ProtocolProbeFailed is raised for anything other than an SSL
+    error (eg: a timeout or a host that can not be reached).
+
     Code inspired by https://github.com/creativecommons/cccatalog-api/blob/5ddee98fcb39a25d34b64894ec96ec11f61c4c31/ingestion_server/ingestion_server/cleanup.py#L152
     which is available under MIT license: https://github.com/creativecommons/cccatalog-api/blob/master/LICENSE
     """
     if 'https://' not in uri and 'http://' not in uri:
-        return check_for_https('http://' + uri)
+        return check_for_https('http://' + uri, timeout, strict)
     elif 'http://' in uri:
         try:
             uri_https = uri.replace('http://', 'https://')
-            result = requests.get(uri_https)
+            kwargs = {'timeout': timeout} if timeout is not None else {}
+            result = http_client.get(uri_https, **kwargs)
             return 200 <= result.status_code < 400
-        except requests.RequestException:
+        except requests.exceptions.SSLError:
+            return False
+        except requests.RequestException as err:
+            if strict:
+                raise ProtocolProbeFailed() from err
             return False
     return True
     
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""
+Benchmarks for basketbot.scrapers on synthetic pages.
+
+For every parser backend and rule shape (see synthetic.SHAPES) this measures:
+
+    parse         full parse of the page
+    partial_parse parse of only the anchor subtree (single anchor shapes)
+    extract       extraction of every rule from an already parsed page
+    end_to_end    parse and extract as done by scrape workers
+                  (basketbot.scrapers.workers.extract_page)
+
+reporting the best and median wall time over a number of repeats, along with
+the peak memory allocated through Python (tracemalloc) during a full parse and
+an end to end run. Note that tracemalloc does not see memory allocated
+directly by C libraries, such as the libxml2 tree built by the lxml backend.
+
+Results are written as JSON keyed by git commit, eg:
+
+    python benchmarks/bench_scrapers.py                   # writes benchmarks/results/<commit>.json
+    python benchmarks/bench_scrapers.py --shape deep --backend lxml
+    python benchmarks/bench_scrapers.py --compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from synthetic import SHAPES, generate
+from basketbot.scrapers.extract import MultiRuleExtractor
+from basketbot.scrapers.parsers import PARSER_BACKENDS, get_backend
+from basketbot.scrapers.rules import CompiledRule, compile_class_chain
+from basketbot.scrapers.workers import extract_page, ruleset
+
+RESULTS_DIR = os.path.join(HERE, 'results')
+METRICS = ('parse', 'partial_parse', 'extract', 'end_to_end')
+
+def git_revision():
+    """ Get the current commit hash and whether the tree has local changes """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE, text=True).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=HERE, text=True).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return commit, dirty
+
+def timed(fn, repeat):
+    """ Best and median wall time of fn over repeat runs, in seconds """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'best': min(times), 'median': statistics.median(times)}
+
+def peak_memory(fn):
+    """ Peak memory in bytes allocated through Python whilst running fn """
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_shape(shape, spec, backend_name, repeat):
+    html, targets = generate(spec)
+    content = html.encode('utf-8')
+    backend = get_backend(backend_name)
+    rules = {
+            n: CompiledRule(target.parent_tag, target.parent_id, compile_class_chain(target.class_chain))
+            for n, target in enumerate(targets)
+            }
+    expected = {n: target.price for n, target in enumerate(targets)}
+    extractor = MultiRuleExtractor(rules)
+    rule_set = ruleset(rules)
+
+    # Check that the benchmark measures a working scrape
+    values = extract_page(content, rule_set, backend_name)
+    if values != expected:
+        raise RuntimeError(f'{backend_name} backend extracted wrong values for shape {shape}')
+
+    dom = backend.parse(content)
+    timings = {
+            'parse': timed(lambda: backend.parse(content), repeat),
+            'partial_parse': None,
+            'extract': timed(lambda: extractor.extract(dom, backend), repeat),
+            'end_to_end': timed(lambda: extract_page(content, rule_set, backend_name), repeat),
+            }
+    if len(targets) == 1:
+        timings['partial_parse'] = timed(lambda: backend.parse_subtree(content, targets[0].parent_tag, targets[0].parent_id), repeat)
+    return {
+            'shape': shape,
+            'backend': backend_name,
+            'spec': spec._asdict(),
+            'page_bytes': len(content),
+            'rules': len(rules),
+            'seconds': timings,
+            'peak_memory_bytes': {
+                'parse': peak_memory(lambda: backend.parse(content)),
+                'end_to_end': peak_memory(lambda: extract_page(content, rule_set, backend_name)),
+                },
+            }
+
+def run(shapes, backends, repeat):
+    commit, dirty = git_revision()
+    results = []
+    for shape in shapes:
+        for backend_name in backends:
+            result = bench_shape(shape, SHAPES[shape], backend_name, repeat)
+            results.append(result)
+            seconds = result['seconds']
+            print(
+                    f'{shape:>14} {backend_name:>5}  '
+                    + '  '.join(f'{metric} {1000 * seconds[metric]["median"]:8.2f}ms' for metric in METRICS if seconds[metric])
+                    + f'  peak {result["peak_memory_bytes"]["end_to_end"] / 1024:8.0f}KiB'
+                    )
+    return {
+            'commit': commit,
+            'dirty': dirty,
+            'created': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'results': results,
+            }
+
+def compare(old_path, new_path):
+    """ Print the ratio of new to old median times for each shape and backend """
+    with open(old_path) as file:
+        old = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+    old_results = {(r['shape'], r['backend']): r for r in old['results']}
+    print(f'{old["commit"][:10]} -> {new["commit"][:10]} (new / old median time, < 1 is faster)')
+    for result in new['results']:
+        key = (result['shape'], result['backend'])
+        if key not in old_results:
+            continue
+        ratios = []
+        for metric in METRICS:
+            before, after = old_results[key]['seconds'].get(metric), result['seconds'].get(metric)
+            if before and after:
+                ratios.append(f'{metric} {after["median"] / before["median"]:5.2f}x')
+        print(f'{key[0]:>14} {key[1]:>5}  ' + '  '.join(ratios))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark basketbot scrapers on synthetic pages')
+    parser.add_argument('--shape', action='append', choices=sorted(SHAPES), help='Rule shape to run (default: all, can be repeated)')
+    parser.add_argument('--backend', action='append', choices=sorted(PARSER_BACKENDS), help='Parser backend to run (default: all, can be repeated)')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs of each measurement')
+    parser.add_argument('--output', help='File to write results to (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two results files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    report = run(args.shape or list(SHAPES), args.backend or sorted(PARSER_BACKENDS), args.repeat)
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f'{report["commit"]}{"-dirty" if report["dirty"] else ""}.json')
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'Results written to {output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""
+Generator for synthetic retail pages and class chains aimed at them.
+
+Pages are made of filler markup (navigation, scripts, unrelated product
+tiles) padded out to a target size, around one or more product sections that
+each hold a price reachable from an element with an id by a class chain of
+the requested depth. Every level of the path has width - 1 siblings, some of
+which (decoys) share the tag and classes of the path element but lead nowhere,
+so rule matching has to backtrack as it would on real, repetitive markup.
+"""
+
+import random
+from collections import namedtuple
+
+# Parameters of a synthetic page
+#   depth - number of levels between the anchor element and the price
+#   width - number of elements at each level of the path to a price
+#   classes - number of classes on each element
+#   page_kib - approximate total page size in KiB
+#   targets - number of prices (and class chains) on the page
+#   decoys - fraction of siblings that look like the path element
+#   seed - random seed, so pages are identical between runs
+PageSpec = namedtuple(
+        'PageSpec',
+        ['depth', 'width', 'classes', 'page_kib', 'targets', 'decoys', 'seed'],
+        defaults=[1, 0.0, 0]
+        )
+
+# A price on a synthetic page and the rule that finds it
+Target = namedtuple('Target', ['parent_tag', 'parent_id', 'class_chain', 'price'])
+
+# Rule shapes measured by the benchmark suite
+SHAPES = {
+        'shallow': PageSpec(depth=2, width=4, classes=2, page_kib=256),
+        'deep': PageSpec(depth=16, width=3, classes=2, page_kib=256),
+        'wide': PageSpec(depth=4, width=40, classes=3, page_kib=256, decoys=0.5),
+        'many_classes': PageSpec(depth=6, width=6, classes=12, page_kib=256),
+        'many_rules': PageSpec(depth=4, width=4, classes=2, page_kib=256, targets=50),
+        'large_page': PageSpec(depth=6, width=6, classes=3, page_kib=4096),
+        }
+
+# Tags that parsers allow to nest freely (eg: not <p>, which can't hold a <div>)
+TAGS = ('div', 'span', 'section', 'article', 'aside')
+
+WORDS = (
+        'product', 'tile', 'grid', 'item', 'card', 'details', 'price', 'layout',
+        'wrapper', 'container', 'main', 'content', 'offer', 'promo', 'badge',
+        'media', 'info', 'title', 'row', 'col', 'inner', 'outer', 'block',
+        'list', 'entry', 'value', 'label', 'primary', 'secondary', 'active',
+        )
+
+class PageGenerator:
+    """
+    Short Summary
+    -------------
+    Build a synthetic page and class chains from a PageSpec
+
+    Extended Summary
+    ----------------
+    Usage:
+
+        html, targets = PageGenerator(SHAPES['deep']).generate()
+
+    Each Target holds the class chain JSON (in the format sent by the
+    frontend) that extracts its price from the page.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.rng = random.Random(spec.seed)
+
+    def classes(self):
+        words = self.rng.sample(WORDS, min(self.spec.classes, len(WORDS)))
+        return [f'{word}-{self.rng.randrange(1000)}' for word in words]
+
+    def node(self):
+        return {'dom_type': self.rng.choice(TAGS).upper(), 'classes': self.classes()}
+
+    def element(self, node, inner):
+        tag = node['dom_type'].lower()
+        return f'<{tag} class="{" ".join(node["classes"])}">{inner}</{tag}>'
+
+    def dead_end(self, depth):
+        """ Markup that does not lead to a price """
+        if depth == 0:
+            return 'n/a'
+        return self.element(self.node(), self.dead_end(depth - 1))
+
+    def section(self, index):
+        """ A product section holding one price, and its Target """
+        price = f'£{self.rng.randrange(1, 100)}.{self.rng.randrange(100):02d}'
+        path = [self.node() for _ in range(self.spec.depth)]
+        inner = price
+        levels = {}
+        for level in reversed(range(self.spec.depth)):
+            node = path[level]
+            siblings = []
+            markup = []
+            for _ in range(self.spec.width - 1):
+                # The last level cant have decoys, as they would hold a price
+                if level < self.spec.depth - 1 and self.rng.random() < self.spec.decoys:
+                    sibling = node # Looks like the path, but leads nowhere
+                    markup.append(self.element(sibling, self.dead_end(self.spec.depth - level - 1)))
+                else:
+                    sibling = self.node()
+                    markup.append(self.element(sibling, 'filler'))
+                siblings.append(sibling)
+            # Decoys come first in document order, to force backtracking
+            markup.append(self.element(node, inner))
+            inner = ''.join(markup)
+            levels[level] = {'tree_node': node, 'siblings': siblings[:3]}
+        levels[self.spec.depth] = {'tree_node': {'dom_type': '#text', 'classes': []}, 'siblings': []}
+        parent_id = f'product-{index}'
+        class_chain = {str(level): levels[level] for level in sorted(levels)}
+        return f'<div id="{parent_id}">{inner}</div>', Target('div', parent_id, class_chain, price)
+
+    def filler(self, size):
+        """ Navigation, scripts and tiles totalling about size characters """
+        parts = []
+        total = 0
+        while total < size:
+            kind = self.rng.randrange(3)
+            if kind == 0:
+                part = '<script>var data = ' + repr([self.rng.random() for _ in range(40)]) + ';</script>'
+            elif kind == 1:
+                links = ''.join(f'<li><a class="nav-link" href="/c/{n}">Category {n}</a></li>' for n in range(20))
+                part = f'<nav class="menu"><ul class="nav">{links}</ul></nav>'
+            else:
+                part = self.dead_end(self.rng.randrange(2, 8))
+            parts.append(part)
+            total += len(part)
+        return ''.join(parts)
+
+    def generate(self):
+        """ Generate the page, returning (html, list of Target) """
+        sections, targets = [], []
+        for index in range(self.spec.targets):
+            markup, target = self.section(index)
+            sections.append(markup)
+            targets.append(target)
+        body = ''.join(sections)
+        padding = max(self.spec.page_kib * 1024 - len(body), 0)
+        html = (
+                '<!DOCTYPE html><html><head><title>Synthetic page</title></head><body>'
+                f'<header>{self.filler(padding // 2)}</header>'
+                f'<main class="layout">{body}</main>'
+                f'<footer>{self.filler(padding - padding // 2)}</footer>'
+                '</body></html>'
+                )
+        return html, targets
+
+def generate(spec):
+    """ Generate a page for a PageSpec, returning (html, list of Target) """
+    return PageGenerator(spec).generate()
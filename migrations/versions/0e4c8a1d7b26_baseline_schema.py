@@ -0,0 +1,180 @@
+"""Baseline schema
+
+Revision ID: 0e4c8a1d7b26
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+
+Creates the tables as they were before any migrations were added. Databases
+that already have these tables (built with `bb db create` before migrations
+existed) should be stamped at this revision (`flask db stamp 0e4c8a1d7b26`)
+and then upgraded. `bb db create` builds the current schema directly from the
+models and stamps it at head itself.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0e4c8a1d7b26'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('country',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('currency',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=True),
+    sa.Column('abbreviation', sa.String(length=3), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('abbreviation'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('dom_elem',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('bs_name', sa.String(length=10), nullable=True),
+    sa.Column('js_name', sa.String(length=10), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('item',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=True),
+    sa.Column('all_regions', sa.Boolean(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('retail_site',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=True),
+    sa.Column('url_protocol', sa.String(length=253), nullable=True),
+    sa.Column('url_subdomain', sa.String(length=253), nullable=True),
+    sa.Column('url_domain', sa.String(length=253), nullable=False),
+    sa.Column('url_suffix', sa.String(length=253), nullable=False),
+    sa.Column('basket_url', sa.String(length=20832), nullable=True),
+    sa.Column('basket_version', sa.Integer(), nullable=True),
+    sa.Column('basket', sa.JSON(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name'),
+    sa.UniqueConstraint('url_domain', 'url_subdomain', 'url_suffix', name='_retail_site_url_uc')
+    )
+    op.create_table('role',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=80), nullable=True),
+    sa.Column('description', sa.String(length=255), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_table('user',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('email', sa.String(length=255), nullable=True),
+    sa.Column('username', sa.String(length=255), nullable=True),
+    sa.Column('password', sa.String(length=255), nullable=True),
+    sa.Column('last_login_at', sa.DateTime(), nullable=True),
+    sa.Column('current_login_at', sa.DateTime(), nullable=True),
+    sa.Column('last_login_ip', sa.String(length=100), nullable=True),
+    sa.Column('current_login_ip', sa.String(length=100), nullable=True),
+    sa.Column('login_count', sa.Integer(), nullable=True),
+    sa.Column('active', sa.Boolean(), nullable=True),
+    sa.Column('confirmed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('email')
+    )
+    op.create_table('conversion_rate',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('currency_id', sa.Integer(), nullable=True),
+    sa.Column('rate', sa.Float(), nullable=False),
+    sa.ForeignKeyConstraint(['currency_id'], ['currency.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('region',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=100), nullable=True),
+    sa.Column('update_time', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('country_id', sa.Integer(), nullable=True),
+    sa.Column('currency_id', sa.Integer(), nullable=True),
+    sa.Column('basket_price', sa.Numeric(precision=10, scale=2), nullable=True),
+    sa.Column('basket_version', sa.Integer(), nullable=False),
+    sa.Column('basket_version_update_time', sa.DateTime(timezone=True), nullable=False),
+    sa.ForeignKeyConstraint(['country_id'], ['country.id'], ),
+    sa.ForeignKeyConstraint(['currency_id'], ['currency.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    op.create_index(op.f('ix_region_basket_version_update_time'), 'region', ['basket_version_update_time'], unique=False)
+    op.create_index(op.f('ix_region_update_time'), 'region', ['update_time'], unique=False)
+    op.create_table('roles_users',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('role_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['role_id'], ['role.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('scraping_rule',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('update_time', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('retail_site_id', sa.Integer(), nullable=False),
+    sa.Column('default_rule', sa.Boolean(), nullable=False),
+    sa.Column('parent_elem_id', sa.Integer(), nullable=False),
+    sa.Column('parent_id', sa.Text(), nullable=True),
+    sa.Column('class_chain', sa.JSON(), nullable=False),
+    sa.ForeignKeyConstraint(['parent_elem_id'], ['dom_elem.id'], ),
+    sa.ForeignKeyConstraint(['retail_site_id'], ['retail_site.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_scraping_rule_update_time'), 'scraping_rule', ['update_time'], unique=False)
+    op.create_table('historical_baskets',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('region_id', sa.Integer(), nullable=True),
+    sa.Column('basket', sa.JSON(), nullable=False),
+    sa.ForeignKeyConstraint(['region_id'], ['region.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('regions_items',
+    sa.Column('region_id', sa.Integer(), nullable=True),
+    sa.Column('item_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['item_id'], ['item.id'], ),
+    sa.ForeignKeyConstraint(['region_id'], ['region.id'], )
+    )
+    op.create_table('regions_retail_sites',
+    sa.Column('region_id', sa.Integer(), nullable=True),
+    sa.Column('retail_site_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['region_id'], ['region.id'], ),
+    sa.ForeignKeyConstraint(['retail_site_id'], ['retail_site.id'], )
+    )
+    op.create_table('scraping_rule_item',
+    sa.Column('scraping_rule_id', sa.Integer(), nullable=True),
+    sa.Column('item_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['item_id'], ['item.id'], ),
+    sa.ForeignKeyConstraint(['scraping_rule_id'], ['scraping_rule.id'], )
+    )
+
+
+def downgrade():
+    op.drop_table('scraping_rule_item')
+    op.drop_table('regions_retail_sites')
+    op.drop_table('regions_items')
+    op.drop_table('historical_baskets')
+    op.drop_index(op.f('ix_scraping_rule_update_time'), table_name='scraping_rule')
+    op.drop_table('scraping_rule')
+    op.drop_table('roles_users')
+    op.drop_index(op.f('ix_region_update_time'), table_name='region')
+    op.drop_index(op.f('ix_region_basket_version_update_time'), table_name='region')
+    op.drop_table('region')
+    op.drop_table('conversion_rate')
+    op.drop_table('user')
+    op.drop_table('role')
+    op.drop_table('retail_site')
+    op.drop_table('item')
+    op.drop_table('dom_elem')
+    op.drop_table('currency')
+    op.drop_table('country')
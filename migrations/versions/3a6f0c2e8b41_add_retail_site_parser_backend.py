@@ -0,0 +1,25 @@
+"""Add retail_site.parser_backend
+
+Revision ID: 3a6f0c2e8b41
+Revises: 0e4c8a1d7b26
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a6f0c2e8b41'
+down_revision = '0e4c8a1d7b26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Overrides the SCRAPER_PARSER_BACKEND config for a site if set
+    op.add_column('retail_site', sa.Column('parser_backend', sa.String(length=20), nullable=True))
+
+
+def downgrade():
+    op.drop_column('retail_site', 'parser_backend')
@@ -0,0 +1,43 @@
+"""Add rule_fingerprint and scraping_rule.possibly_broken
+
+Revision ID: 5d2b9e7f1c08
+Revises: 3a6f0c2e8b41
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2b9e7f1c08'
+down_revision = '3a6f0c2e8b41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+            'scraping_rule',
+            sa.Column('possibly_broken', sa.Boolean(), nullable=False, server_default=sa.false())
+            )
+    op.create_table(
+            'rule_fingerprint',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('scraping_rule_id', sa.Integer(), nullable=False),
+            sa.Column('url', sa.Text(), nullable=False),
+            sa.Column('rule_update_time', sa.DateTime(timezone=True), nullable=False),
+            sa.Column('digest', sa.String(length=32), nullable=False),
+            sa.Column('path', sa.JSON(), nullable=False),
+            sa.Column('raw_text', sa.Text(), nullable=True),
+            sa.Column('value', sa.JSON(), nullable=True),
+            sa.Column('update_time', sa.DateTime(timezone=True), nullable=False),
+            sa.ForeignKeyConstraint(['scraping_rule_id'], ['scraping_rule.id']),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('scraping_rule_id', 'url', name='_rule_fingerprint_url_uc')
+            )
+
+
+def downgrade():
+    op.drop_table('rule_fingerprint')
+    op.drop_column('scraping_rule', 'possibly_broken')
@@ -0,0 +1,143 @@
+"""Add price_observation and unpack historical_baskets into it
+
+Revision ID: 7c1e4a9b2d35
+Revises: 5d2b9e7f1c08
+Create Date: 2026-10-18 12:00:00.000000
+
+historical_baskets rows are unpacked assuming each basket holds, for each
+retail site (keyed by RetailSite id or name), the prices of its items keyed by
+Item name (the layout of RetailSite.basket), along with an optional
+'observed_at' (or 'update_time') ISO timestamp. Rows without a valid timestamp
+are given the basket_version_update_time of their region. Prices of sites and
+items that no longer exist, and prices not nested under a site (which cannot
+be attributed to one), are skipped and counted in the log.
+historical_baskets itself is left in place.
+
+"""
+import json
+import logging
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e4a9b2d35'
+down_revision = '5d2b9e7f1c08'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+TIMESTAMP_KEYS = ('observed_at', 'update_time')
+
+price_observation = sa.table(
+        'price_observation',
+        sa.column('item_id', sa.Integer),
+        sa.column('retail_site_id', sa.Integer),
+        sa.column('region_id', sa.Integer),
+        sa.column('observed_at', sa.DateTime(timezone=True)),
+        sa.column('price', sa.Numeric(precision=12, scale=2)),
+        sa.column('currency_id', sa.Integer),
+        )
+
+
+def upgrade():
+    bind = op.get_bind()
+    op.create_table(
+            'price_observation',
+            sa.Column('item_id', sa.Integer(), sa.ForeignKey('item.id'), nullable=False),
+            sa.Column('retail_site_id', sa.Integer(), sa.ForeignKey('retail_site.id'), nullable=False),
+            sa.Column('region_id', sa.Integer(), sa.ForeignKey('region.id'), nullable=False),
+            sa.Column('observed_at', sa.DateTime(timezone=True), nullable=False),
+            sa.Column('price', sa.Numeric(precision=12, scale=2), nullable=False),
+            sa.Column('currency_id', sa.Integer(), sa.ForeignKey('currency.id'), nullable=True),
+            sa.PrimaryKeyConstraint('item_id', 'retail_site_id', 'region_id', 'observed_at'),
+            postgresql_partition_by='RANGE (observed_at)'
+            )
+    if bind.dialect.name == 'postgresql':
+        op.execute('CREATE TABLE price_observation_default PARTITION OF price_observation DEFAULT')
+    op.create_index('ix_price_observation_site_item_time', 'price_observation', ['retail_site_id', 'item_id', 'observed_at'])
+    op.create_index('ix_price_observation_region_time', 'price_observation', ['region_id', 'observed_at'])
+    unpack_historical_baskets(bind)
+
+
+def downgrade():
+    op.drop_index('ix_price_observation_region_time', table_name='price_observation')
+    op.drop_index('ix_price_observation_site_item_time', table_name='price_observation')
+    # Partitions are dropped along with the table
+    op.drop_table('price_observation')
+
+
+def unpack_historical_baskets(bind, batch_size=5000):
+    """
+    Insert a price_observation row for every price in historical_baskets,
+    keeping the first of any with the same key
+    """
+    sites = {}
+    for site_id, name in bind.execute(sa.text('SELECT id, name FROM retail_site')):
+        sites[site_id] = sites[str(site_id)] = sites[name] = site_id
+    items = dict(bind.execute(sa.text('SELECT name, id FROM item')).fetchall())
+    regions = {
+            region_id: (currency_id, update_time)
+            for region_id, currency_id, update_time in bind.execute(sa.text(
+                'SELECT id, currency_id, basket_version_update_time FROM region'
+                ))
+            }
+    insert = price_observation.insert()
+    rows, seen, skipped, bad_timestamps = [], set(), 0, 0
+    baskets = bind.execute(sa.text('SELECT region_id, basket FROM historical_baskets ORDER BY id'))
+    for region_id, basket in baskets:
+        if region_id not in regions:
+            continue
+        if isinstance(basket, str):
+            basket = json.loads(basket)
+        if not isinstance(basket, dict):
+            continue
+        currency_id, observed_at = regions[region_id]
+        for key in TIMESTAMP_KEYS:
+            if basket.get(key) is not None:
+                try:
+                    observed_at = datetime.fromisoformat(basket[key])
+                except (TypeError, ValueError):
+                    bad_timestamps += 1
+                break
+        for site_key, prices in basket.items():
+            if site_key in TIMESTAMP_KEYS:
+                continue
+            if not isinstance(prices, dict):
+                skipped += 1 # Eg: a flat {item: price} basket, with no site
+                continue
+            for item_name, price in prices.items():
+                try:
+                    price = Decimal(str(price))
+                except InvalidOperation:
+                    price = None
+                if site_key not in sites or item_name not in items or price is None or not price.is_finite():
+                    skipped += 1
+                    continue
+                key = (items[item_name], sites[site_key], region_id, observed_at)
+                if key in seen:
+                    continue # Several baskets of a region without timestamps
+                seen.add(key)
+                rows.append({
+                    'item_id': items[item_name],
+                    'retail_site_id': sites[site_key],
+                    'region_id': region_id,
+                    'observed_at': observed_at,
+                    'price': price,
+                    'currency_id': currency_id,
+                    })
+                if len(rows) >= batch_size:
+                    bind.execute(insert, rows)
+                    rows = []
+    if rows:
+        bind.execute(insert, rows)
+    if skipped:
+        logger.warning('Skipped %d historical basket prices without a known site and item', skipped)
+    if bad_timestamps:
+        logger.warning(
+                'Used the region basket update time for %d historical baskets with invalid timestamps',
+                bad_timestamps
+                )
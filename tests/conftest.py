@@ -1,5 +1,9 @@
 import pytest
 import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
 from pathlib import Path
 from basketbot import create_app
 from basketbot.datamodel import defaults, register_events
@@ -80,11 +84,40 @@ def _db(app):
     defaults.create(db.session)
     return db
 
+@pytest.fixture(autouse=True)
+def clear_process_caches():
+    """
+    Process wide caches are keyed by database ids, which are reused once each
+    tests transaction is rolled back, so start every test with empty caches
+    """
+    from basketbot.scrapers.rules import rule_cache
+    from basketbot.util import protocol_cache
+    from basketbot.api.catalogue import catalogue
+    rule_cache.invalidate()
+    dm.rule_index.invalidate()
+    dm.site_url_index.invalidate()
+    dm.dom_tags.invalidate()
+    catalogue.invalidate()
+    protocol_cache.clear()
+    yield
+
+def is_test_outermost(transaction):
+    """
+    Each tests transactions are savepoints within the transaction of
+    pytest-flask-sqlalchemy, so those directly within it stand in for the
+    outermost transaction
+    """
+    return transaction.parent is not None and transaction.parent.parent is None
+
 @pytest.fixture(scope='function')
 def db_with_items(db_session):
     defaults.create_test_defaults(db_session)
     # Register event listeners
-    register_events(db_session)
+    register_events(db_session, outermost=is_test_outermost)
+    # Item and site changes made by the defaults were noted by mapper events, but
+    # there were no session listeners yet to act on them
+    db_session.info.pop(dm.ALTERED_REGIONS_SESSION_KEY, None)
+    db_session.info.pop(dm.SITE_URL_INDEX_SESSION_KEY, None)
     return db_session
 
 @pytest.fixture(scope='function')
@@ -93,6 +126,80 @@ def mocked_http_urls(requests_mock):
     requests_mock.get('https://example_no_https.com', status_code=404)
     requests_mock.get('https://mail.mydomain.co.uk', status_code=200)
 
+class StubHTTPServer(ThreadingHTTPServer):
+    """
+    Local HTTP server for testing fetchers. Every GET returns a small HTML page
+    after an optional ?delay=<seconds>, and the server records the peak number
+    of concurrent requests overall and per first path segment (eg: /site_a/1),
+    along with the number of TCP connections opened. Pages are served with an
+    ETag (the version number of the path in versions) and conditional
+    requests for an unchanged page get a 304 response
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHTTPHandler)
+        self.lock = threading.Lock()
+        self.active = {}
+        self.peak = {}
+        self.requests = []
+        self.connections = 0
+        self.versions = {} # Page versions by path, served as ETags
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def track(self, keys, change):
+        with self.lock:
+            for key in keys:
+                self.active[key] = self.active.get(key, 0) + change
+                self.peak[key] = max(self.peak.get(key, 0), self.active[key])
+
+class StubHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Allow keep-alive connections
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        keys = ['*', url.path.strip('/').split('/')[0]]
+        self.server.requests.append((self.path, dict(self.headers)))
+        self.server.track(keys, 1)
+        try:
+            time.sleep(float(parse_qs(url.query).get('delay', [0])[0]))
+            etag = f'"{self.server.versions.get(url.path, 0)}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = f'<html><body><p id="path">{url.path}</p><p id="version">{etag}</p></body></html>'.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            self.server.track(keys, -1)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture(scope='function')
+def stub_http_server():
+    server = StubHTTPServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
 # Hooks
 
 def pytest_generate_tests(metafunc):
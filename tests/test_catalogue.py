@@ -0,0 +1,65 @@
+"""
+Test the cached country and region catalogue endpoints
+"""
+
+from basketbot.datamodel import model as dm
+
+def test_catalogue_etags(app, db_with_items):
+    """
+    Check that catalogue endpoints give the same payloads as the schemas,
+    304 for a current ETag, and new payloads after countries or regions change
+    """
+    from basketbot.schemas import CountryRegions, FormRegion
+    client = app.test_client()
+    response = client.get('/api/v1/country')
+    assert response.status_code == 200
+    expected = CountryRegions(many=True).dump(dm.Country.query.order_by(dm.Country.id))
+    assert response.get_json() == [dict(country, regions=sorted(country['regions'], key=lambda r: r['region_id'])) for country in expected]
+    assert client.get('/api/v1/countryregionsdict').get_json()['England']['regions'] == [
+            {'region_id': region.id, 'name': region.name}
+            for region in sorted(dm.Country.query.filter_by(name='England').one().regions, key=lambda r: r.id)
+            ]
+    assert sorted(client.get('/api/v1/region').get_json(), key=lambda r: r['region_id']) == sorted(
+            FormRegion(many=True).dump(dm.Region.query.all()), key=lambda r: r['region_id']
+            )
+    etag = response.headers['ETag']
+    assert client.get('/api/v1/country', headers={'If-None-Match': etag}).status_code == 304
+
+    # Basket updates do not change the catalogue
+    region = dm.Region.query.filter_by(name='London').one()
+    region.basket_price = 1
+    db_with_items.commit()
+    assert client.get('/api/v1/country', headers={'If-None-Match': etag}).status_code == 304
+
+    region.name = 'Greater London'
+    db_with_items.commit()
+    response = client.get('/api/v1/country', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert 'Greater London' in [r['name'] for r in client.get('/api/v1/countryregionsdict').get_json()['England']['regions']]
+
+def test_catalogue_invalidation(app, db_with_items, monkeypatch):
+    """
+    Check that payloads built across an invalidation are not kept, and that
+    changes made outside the ORM are seen once the payloads expire
+    """
+    from basketbot.api import catalogue as catalogue_module
+    catalogue = catalogue_module.catalogue
+    payload = catalogue_module.CataloguePayload
+    def invalidating_payload(data):
+        # Another thread commits a rename while the payloads are being built
+        catalogue.invalidate()
+        monkeypatch.setattr(catalogue_module, 'CataloguePayload', payload)
+        return payload(data)
+    monkeypatch.setattr(catalogue_module, 'CataloguePayload', invalidating_payload)
+    assert catalogue.get('region').data
+    assert catalogue._payloads is None
+    etag = catalogue.get('region').etag
+    assert catalogue._payloads is not None
+
+    region = dm.Region.query.filter_by(name='London').one()
+    db_with_items.execute(dm.Region.__table__.update().where(dm.Region.id == region.id).values(name='Londinium'))
+    db_with_items.commit()
+    assert catalogue.get('region').etag == etag
+    monkeypatch.setattr(catalogue, 'max_age', 0)
+    assert 'Londinium' in [region['name'] for region in catalogue.get('region').data]
@@ -0,0 +1,112 @@
+"""
+Test fetching pages for scraping
+"""
+
+import threading
+import time
+import pytest
+from basketbot.scrapers import ScrapeWithClassChain
+from basketbot.scrapers.fetch import AsyncFetcher, FetchJob
+from basketbot.scrapers.cache import PageCache
+from basketbot.scrapers.snapshots import SnapshotStore
+from basketbot import SnapshotNotFound
+
+def test_async_fetcher_concurrency_limits(stub_http_server):
+    """
+    Check that all pages are fetched whilst respecting global and per-site
+    concurrency limits
+    """
+    jobs = [FetchJob(f'{stub_http_server.url}/{site}/{n}?delay=0.05', site=site, context=n)
+            for site in ('site_a', 'site_b', 'site_c') for n in range(6)]
+    with AsyncFetcher(max_concurrency=5, site_concurrency=2, site_limits={'site_c': 1}) as fetcher:
+        results = fetcher.fetch_all(jobs)
+    assert len(results) == len(jobs)
+    assert all(result.ok for result in results)
+    assert {(r.job.site, r.job.context) for r in results} == {(j.site, j.context) for j in jobs}
+    assert b'/site_a/3' in [r for r in results if r.job.site == 'site_a' and r.job.context == 3][0].content
+    peak = stub_http_server.peak
+    assert peak['*'] <= 5
+    assert peak['site_a'] <= 2 and peak['site_b'] <= 2 and peak['site_c'] == 1
+    # Concurrency should actually have been used
+    assert peak['*'] > 1
+
+def test_async_fetcher_errors(stub_http_server):
+    """
+    Check that timeouts and connection errors are reported in results
+    rather than raised
+    """
+    jobs = [
+            FetchJob(f'{stub_http_server.url}/slow/1?delay=1', context='slow'),
+            FetchJob(f'{stub_http_server.url}/fast/1', context='fast'),
+            FetchJob('http://127.0.0.1:1/refused', context='refused'),
+            ]
+    with AsyncFetcher(timeout=0.3) as fetcher:
+        results = {r.job.context: r for r in fetcher.fetch_all(jobs)}
+    assert results['fast'].ok
+    assert not results['slow'].ok and results['slow'].error is not None
+    assert not results['refused'].ok and results['refused'].status is None
+
+def test_async_fetcher_slow_fetches_keep_site_slots():
+    """
+    Check that fetches running past the timeout still hold their site slot
+    until they actually finish
+    """
+    lock = threading.Lock()
+    active, peak = [0], [0]
+    def slow_fetch(url, timeout, cache=None):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.1)
+        with lock:
+            active[0] -= 1
+        return 200, b'<html></html>'
+    jobs = [FetchJob(f'http://slow.example/{n}', site='slow') for n in range(4)]
+    with AsyncFetcher(site_concurrency=1, timeout=0.01, fetch_fn=slow_fetch) as fetcher:
+        results = fetcher.fetch_all(jobs)
+    assert all(result.ok for result in results)
+    assert peak[0] == 1
+
+def test_conditional_get_page_cache(stub_http_server):
+    """
+    Check that cached pages are revalidated with their ETag, and that
+    extraction results are reused until the page changes
+    """
+    cache = PageCache()
+    url = f'{stub_http_server.url}/product/1'
+    scraper = ScrapeWithClassChain('version', {}, parent_elem='p')
+    assert scraper.scrape_url(url, cache=cache) == '"0"'
+    with AsyncFetcher(cache=cache) as fetcher:
+        result, = fetcher.fetch_all([url])
+    assert result.not_modified and result.ok
+    assert result.content == cache.get(url).content
+    assert stub_http_server.requests[-1][1]['If-None-Match'] == '"0"'
+    # Unchanged page reuses the stored extraction without parsing
+    cache.set_extraction(url, scraper.rule, 'stored')
+    assert scraper.scrape_url(url, cache=cache) == 'stored'
+    # Changed page is downloaded again and re-extracted
+    stub_http_server.versions['/product/1'] = 1
+    assert scraper.scrape_url(url, cache=cache) == '"1"'
+    assert cache.get(url).etag == '"1"'
+
+def test_snapshot_store(stub_http_server, tmp_path):
+    """
+    Check that fetched pages are saved once per distinct content, with a
+    metadata record per scrape, and can be scraped again from the store
+    """
+    store = SnapshotStore(tmp_path)
+    url = f'{stub_http_server.url}/product/1'
+    with AsyncFetcher(snapshots=store) as fetcher:
+        first, = fetcher.fetch_all([FetchJob(url, site=3)])
+        second, = fetcher.fetch_all([FetchJob(url, site=3)])
+    assert first.snapshot_id == second.snapshot_id
+    assert store.get(first.snapshot_id) == first.content
+    assert [m['retail_site_id'] for m in store.metadata(first.snapshot_id)] == [3, 3]
+    assert len(list(tmp_path.glob('*/*.html.gz'))) == 1
+    scraper = ScrapeWithClassChain('path', {}, parent_elem='p')
+    scraper.dom_from_snapshot(first.snapshot_id, store)
+    assert scraper.scrape() == '/product/1'
+    with pytest.raises(SnapshotNotFound):
+        store.get('0' * 64)
+    with pytest.raises(SnapshotNotFound):
+        store.get('../../etc/passwd')
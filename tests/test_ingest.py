@@ -0,0 +1,80 @@
+"""
+Test bulk ingestion of scraping rules
+"""
+
+import json
+from basketbot.datamodel import model as dm
+from basketbot.api.ingest import RuleIngester, read_rules
+
+CLASS_CHAIN = {"0": {"tree_node": {"dom_type": "DIV", "classes": ["price"]}, "siblings": []}}
+
+def rule(**kwargs):
+    data = {
+            "parent_elem": "DIV",
+            "parent_id": "product",
+            "retail_site": "http://www.superstore.com",
+            "default_rule": False,
+            "items": ["banana"],
+            "class_chain": CLASS_CHAIN,
+            }
+    data.update(kwargs)
+    return data
+
+def test_rule_ingester(db_with_items):
+    """
+    Check that valid rules are created in one go, and that invalid rules are
+    reported by position without stopping the others
+    """
+    apple = dm.Item.query.filter(dm.Item.name=="apple").scalar()
+    rules = read_rules("\n".join([
+        json.dumps(rule(parent_id="banana")),
+        json.dumps(rule(parent_id="apple", items=[apple.id])),
+        json.dumps(rule(parent_elem="OHDEAR")),
+        "{not json",
+        json.dumps(rule(retail_site="http://www.crinklefunk.com")),
+        json.dumps(rule(items=["durian"])),
+        json.dumps(rule(default_rule=True)),
+        json.dumps(rule(items=[])),
+        json.dumps(rule(parent_id="default", default_rule=True, items=[])),
+        json.dumps(rule(items=[{"name": "banana"}])),
+        json.dumps(rule(items=[True])),
+        ]))
+    result = RuleIngester(batch_size=4).ingest(rules)
+    assert [error.index for error in result.errors] == [2, 3, 4, 5, 6, 7, 9, 10]
+    assert [rule_id is not None for rule_id in result.created] == [True, True] + [False] * 6 + [True, False, False]
+    created = {sr.parent_id: sr for sr in dm.ScrapingRule.query.filter(dm.ScrapingRule.id.in_([i for i in result.created if i]))}
+    assert created["banana"].items == [dm.Item.query.filter(dm.Item.name=="banana").scalar()]
+    assert created["apple"].items == [apple]
+    assert created["default"].default_rule
+
+    # Nothing is created by an atomic ingest with errors
+    count = dm.ScrapingRule.query.count()
+    result = RuleIngester(atomic=True).ingest([rule(parent_id="atomic"), rule(items=["durian"])])
+    assert result.created == [None, None]
+    assert dm.ScrapingRule.query.count() == count
+
+def test_rule_ingester_database_errors(db_with_items):
+    """
+    Check that when the database rejects a batch, its rules are retried one
+    at a time and only the rejected rule is reported
+    """
+    db_with_items.execute("ALTER TABLE scraping_rule ADD CONSTRAINT test_rejected CHECK (parent_id <> 'rejected')")
+    rules = [rule(parent_id="first"), rule(parent_id="rejected"), rule(parent_id="last")]
+    result = RuleIngester(batch_size=3).ingest(rules)
+    assert [error.index for error in result.errors] == [1]
+    assert result.errors[0].errors == {'_rule': ['Scraping rule was rejected by the database']}
+    created = dm.ScrapingRule.query.filter(dm.ScrapingRule.id.in_([i for i in result.created if i]))
+    assert result.created[1] is None
+    assert sorted(sr.parent_id for sr in created) == ["first", "last"]
+    assert all(sr.items == [dm.Item.query.filter(dm.Item.name=="banana").scalar()] for sr in created)
+
+def test_bulk_endpoint(app, db_with_items):
+    """ Check the bulk endpoint accepts NDJSON and JSON arrays """
+    client = app.test_client()
+    body = "\n".join(json.dumps(rule(parent_id=f"rule-{n}")) for n in range(3)) + "\n"
+    response = client.post('/api/v1/scrapingrule/bulk', data=body, content_type='application/x-ndjson')
+    assert response.status_code == 200
+    assert all(response.get_json()['created'])
+    response = client.post('/api/v1/scrapingrule/bulk', json=[rule(), rule(parent_elem="OHDEAR")])
+    assert [error['index'] for error in response.get_json()['errors']] == [1]
+    assert client.post('/api/v1/scrapingrule/bulk', data='[{"parent_id": ', content_type='application/json').status_code == 400
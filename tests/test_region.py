@@ -63,6 +63,65 @@ def test_basket_version_update_on_addition(db_with_items):
     db_with_items.commit()
     check_region_basket_versions([region_2, region_3], all_regions, init_versions)
 
+def test_basket_version_bump_is_set_based(db_with_items):
+    """
+    Test that the basket versions of all affected regions are bumped with a
+    single UPDATE, without flushing Region objects
+    """
+    from sqlalchemy import event
+    regions = dm.Region.query.all()
+    init_versions = {region.name: region.basket_version for region in regions}
+    init_times = {region.name: region.basket_version_update_time for region in regions}
+    item = dm.Item(name="chocolate carrots")
+    item.regions = regions
+    db_with_items.add(item)
+    statements = []
+    record = lambda *args: statements.append(args[2])
+    engine = db_with_items.connection()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        db_with_items.commit()
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    updates = [statement for statement in statements if statement.startswith('UPDATE region')]
+    assert len(updates) == 1
+    assert 'basket_version + ' in updates[0]
+    check_region_basket_versions(regions, regions, init_versions)
+    for region in regions:
+        assert region.basket_version_update_time >= init_times[region.name]
+
+def test_item_change_tracking(db_with_items):
+    """
+    Test that only real item changes bump basket versions, and that changes
+    which are rolled back are forgotten
+    """
+    all_regions = dm.Region.query.all()
+    item = dm.Item.query.filter(dm.Item.name=="banana").scalar()
+    init_versions = {region.name: region.basket_version for region in all_regions}
+    # Unrelated changes, and setting a name to its current value
+    dm.RetailSite.query.first().basket_version = 99
+    item.name = "banana"
+    db_with_items.commit()
+    check_region_basket_versions([], all_regions, init_versions)
+    # Rolled back changes
+    item.name = "plantain"
+    db_with_items.rollback()
+    db_with_items.commit()
+    check_region_basket_versions([], all_regions, init_versions)
+    # Changes made through the other side of the relationship
+    region = [r for r in all_regions if r not in item.regions][0]
+    region.items.append(item)
+    db_with_items.commit()
+    check_region_basket_versions(item.regions, all_regions, init_versions)
+    # Changes made before an item has a session are kept with the session
+    init_versions = {region.name: region.basket_version for region in all_regions}
+    durian = dm.Item(name="durian", regions=[region], all_regions=False)
+    db_with_items.add(durian)
+    assert durian in db_with_items.info[dm.ITEM_CHANGES_SESSION_KEY]
+    db_with_items.commit()
+    check_region_basket_versions([region], all_regions, init_versions)
+    assert not db_with_items.info[dm.ITEM_CHANGES_SESSION_KEY]
+
 
 # Helper functions
 
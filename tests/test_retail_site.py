@@ -3,6 +3,8 @@ Test RetailSite model
 """
 
 import pytest
+from datetime import timedelta
+from decimal import Decimal
 from basketbot import datamodel as dm
 from basketbot import DefaultRuleNotUnique
 
@@ -36,6 +38,61 @@ def test_retail_site_get_item_rule(db_with_items):
     assert rs.get_item_rule(apple) == sr_2
     assert rs.get_item_rule(snapple) == sr_1
 
+def test_rule_index(db_with_items, monkeypatch):
+    """
+    Test that rules are resolved from the index without further queries,
+    and that the index is refreshed when rules or their items change
+    """
+    from sqlalchemy import event
+    rs = dm.RetailSite.query.filter(dm.RetailSite.name=="Superstore").scalar()
+    sr_1 = dm.ScrapingRule(default_rule=True, retail_site_id=rs.id, parent_elem_id=dm.DOMElem.query.first().id, parent_id="default", class_chain={})
+    sr_2 = dm.ScrapingRule(default_rule=False, retail_site_id=rs.id, parent_elem_id=dm.DOMElem.query.first().id, parent_id="exception", class_chain={})
+    banana = dm.Item.query.filter(dm.Item.name=="banana").scalar()
+    apple = dm.Item.query.filter(dm.Item.name=="apple").scalar()
+    sr_2.items = [banana, apple]
+    db_with_items.add_all([sr_1, sr_2])
+    db_with_items.commit()
+    items = rs.basket_items
+    assert rs.get_item_rules(items) == {item.id: rs.get_item_rule(item) for item in items}
+    statements = []
+    record = lambda *args: statements.append(args[2])
+    engine = db_with_items.connection()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        for item in items:
+            rs.get_item_rule(item.id)
+        rs.get_item_rules(items)
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert statements == []
+    sr_2.items = [banana]
+    db_with_items.commit()
+    assert rs.get_item_rule(apple) == sr_1
+    assert rs.get_item_rule(banana) == sr_2
+    with db_with_items.no_autoflush:
+        sr_1.items = [apple]
+        sr_1.default_rule = False
+    db_with_items.commit()
+    assert rs.get_item_rule(apple) == sr_1
+    with pytest.raises(DefaultRuleNotUnique):
+        rs.default_rule
+    # Changes in a savepoint are only applied once the transaction commits
+    hummus = dm.Item.query.filter(dm.Item.name=="hummus").scalar()
+    db_with_items.begin_nested()
+    sr_2.items = [banana, hummus]
+    db_with_items.commit()
+    assert hummus.id not in dm.rule_index.site(rs.id).item_rules
+    db_with_items.commit()
+    assert rs.get_item_rule(hummus) == sr_2
+    # Changes made outside the ORM (eg: by another process) are seen once the
+    # entry is older than max_age
+    snapple = dm.Item.query.filter(dm.Item.name=="snapple").scalar()
+    db_with_items.execute(dm.ScrapingRuleItem.insert().values(scraping_rule_id=sr_2.id, item_id=snapple.id))
+    db_with_items.commit()
+    assert snapple.id not in dm.rule_index.site(rs.id).item_rules
+    monkeypatch.setattr(dm.rule_index, 'max_age', 0)
+    assert dm.rule_index.rule_id(rs.id, snapple.id) == sr_2.id
+
 def test_retail_site_scraping_attributes(db_with_items):
     """
     Test that the RetailSite ORM class attributes returns correct
@@ -130,3 +187,106 @@ def test_get_site_from_url(db_with_items, url):
         assert rslt is None
 
 
+
+def test_site_url_index(db_with_items, monkeypatch):
+    """
+    Test that sites are found from the URL index without further queries,
+    that misses are remembered, and that committed URL changes are applied
+    """
+    from sqlalchemy import event
+    superstore = dm.RetailSite.get_site_from_url("http://www.superstore.com/products/1")
+    assert superstore.name == "Superstore"
+    assert dm.RetailSite.get_site_from_url("http://www.crinklefunk.com") is None
+    statements = []
+    record = lambda *args: statements.append(args[2])
+    engine = db_with_items.connection()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        assert dm.RetailSite.get_site_from_url("http://www.superstore.com") is superstore
+        assert dm.RetailSite.get_site_from_url("http://www.crinklefunk.com") is None
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert statements == []
+    # A new site is found despite the remembered miss
+    crinklefunk = dm.RetailSite(name="Crinklefunk", url_protocol="http", url_subdomain="www", url_domain="crinklefunk", url_suffix="com")
+    db_with_items.add(crinklefunk)
+    db_with_items.commit()
+    assert dm.RetailSite.get_site_from_url("http://www.crinklefunk.com") is crinklefunk
+    # A changed URL is only found at its new key
+    superstore.url_suffix = "co.uk"
+    db_with_items.commit()
+    assert dm.RetailSite.get_site_from_url("http://www.superstore.com") is None
+    assert dm.RetailSite.get_site_from_url("http://www.superstore.co.uk") is superstore
+    # Uncommitted changes are forgotten on rollback (the test transactions
+    # rollback does not undo flushed changes in the DB, so they can not be
+    # looked up afterwards)
+    superstore.url_suffix = "org"
+    db_with_items.flush()
+    assert dm.SITE_URL_INDEX_SESSION_KEY in db_with_items.info
+    db_with_items.rollback()
+    assert dm.SITE_URL_INDEX_SESSION_KEY not in db_with_items.info
+    db_with_items.delete(crinklefunk)
+    db_with_items.commit()
+    assert dm.RetailSite.get_site_from_url("http://www.crinklefunk.com") is None
+    # Rolling back a savepoint keeps the changes made before it
+    superstore.url_suffix = "biz"
+    db_with_items.flush()
+    db_with_items.begin_nested()
+    superstore.name = "Superstore 2"
+    db_with_items.flush()
+    db_with_items.rollback()
+    assert dm.SITE_URL_INDEX_SESSION_KEY in db_with_items.info
+    db_with_items.commit()
+    assert dm.RetailSite.get_site_from_url("http://www.superstore.biz") is superstore
+    # A URL changed outside the ORM is not found at its old key
+    table = dm.RetailSite.__table__
+    db_with_items.execute(table.update().where(table.c.id == superstore.id).values(url_suffix="net"))
+    db_with_items.commit()
+    assert dm.RetailSite.get_site_from_url("http://www.superstore.biz") is None
+    assert dm.RetailSite.get_site_from_url("http://www.superstore.net") is superstore
+    # Sites added outside the ORM are seen once the index is older than
+    # max_age, despite a remembered miss
+    assert dm.RetailSite.get_site_from_url("http://www.crinklefunk.com") is None
+    db_with_items.execute(table.insert().values(name="Crinklefunk", url_protocol="http", url_subdomain="www", url_domain="crinklefunk", url_suffix="com"))
+    db_with_items.commit()
+    assert dm.RetailSite.get_site_from_url("http://www.crinklefunk.com") is None
+    monkeypatch.setattr(dm.site_url_index, 'max_age', 0)
+    assert dm.RetailSite.get_site_from_url("http://www.crinklefunk.com").name == "Crinklefunk"
+
+def test_price_observation_history(db_with_items):
+    """
+    Check that the price history of an item on a site can be queried by time
+    range, and that observations go to the partition covering their time
+    """
+    rs = dm.RetailSite.query.filter(dm.RetailSite.name=="Superstore").scalar()
+    banana = dm.Item.query.filter(dm.Item.name=="banana").scalar()
+    apple = dm.Item.query.filter(dm.Item.name=="apple").scalar()
+    region = rs.regions[0]
+    start = dm.now().replace(year=2040, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    days = [start + timedelta(days=day) for day in range(0, 100, 10)]
+    db_with_items.add_all([
+        dm.PriceObservation(item=item, retail_site=rs, region=region, observed_at=day, price=Decimal(index), currency_id=region.currency_id)
+        for item in (banana, apple) for index, day in enumerate(days)
+        ])
+    db_with_items.commit()
+    history = dm.PriceObservation.history(banana, rs.id, since=days[2], until=days[5]).all()
+    assert [obs.observed_at for obs in history] == days[2:5]
+    assert [obs.price for obs in history] == [Decimal(2), Decimal(3), Decimal(4)]
+    assert dm.PriceObservation.history(banana, rs, region=region.id + 1000).count() == 0
+    partition = dm.PriceObservation.create_partition(start + timedelta(days=365), start + timedelta(days=730), db_with_items)
+    later = dm.PriceObservation(item=banana, retail_site=rs, region=region, observed_at=start + timedelta(days=400), price=1)
+    db_with_items.add(later)
+    db_with_items.commit()
+    tables = dict(db_with_items.execute(
+        'SELECT observed_at, tableoid::regclass::text FROM price_observation WHERE item_id = :item',
+        {'item': banana.id}
+        ).fetchall())
+    assert tables[later.observed_at] == partition
+    assert tables[days[0]] == 'price_observation_default'
+    # Monthly partitions are created ahead of time, except for months whose
+    # rows are already in the default partition
+    month = start.replace(year=2050)
+    created = dm.PriceObservation.create_month_partitions(months_ahead=1, now=month, session=db_with_items)
+    assert created == ['price_observation_20500101_20500201', 'price_observation_20500201_20500301']
+    assert dm.PriceObservation.create_month_partitions(months_ahead=1, now=month, session=db_with_items) == []
+    assert dm.PriceObservation.create_month_partitions(months_ahead=0, now=start, session=db_with_items) == []
@@ -0,0 +1,100 @@
+"""
+Test scheduling of scrape tasks
+"""
+
+from datetime import datetime, timedelta, timezone
+from basketbot.datamodel import model as dm
+from basketbot.scrapers.scheduler import ScrapeScheduler, ScrapeTask
+
+T0 = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+def test_scheduler_priorities():
+    """
+    Check that tasks come out most stale first, weighted by the number of
+    regions served by the site, and boosted by basket changes
+    """
+    scheduler = ScrapeScheduler()
+    stale, fresh, important, changed = [ScrapeTask(n, 1) for n in range(4)]
+    scheduler.add(stale, 'a.com', n_regions=1, now=T0)
+    scheduler.add(fresh, 'b.com', n_regions=1, now=T0)
+    scheduler.add(important, 'c.com', n_regions=5, now=T0)
+    scheduler.add(changed, 'd.com', n_regions=1, basket_versions={1: 1}, now=T0)
+    scheduler.record_success(stale, T0 - timedelta(hours=10))
+    scheduler.record_success(fresh, T0 - timedelta(hours=1))
+    scheduler.record_success(important, T0 - timedelta(hours=6))
+    scheduler.record_success(changed, T0 - timedelta(hours=1))
+    scheduler.add(changed, 'd.com', n_regions=1, basket_versions={1: 2}, now=T0)
+    scheduler.refresh(T0)
+    assert scheduler.take(10, now=T0) == [changed, important, stale, fresh]
+    assert len(scheduler) == 0
+    # Completed tasks are queued again, failures stay stale
+    scheduler.complete(stale, True, when=T0)
+    scheduler.complete(fresh, False, when=T0)
+    assert scheduler.pop(now=T0 + timedelta(minutes=1)) == fresh
+
+def test_scheduler_domain_intervals():
+    """
+    Check that tasks for a domain are not handed out more often than its
+    minimum interval, without holding up other domains
+    """
+    scheduler = ScrapeScheduler(min_interval=10, domain_intervals={'slow.com': 60})
+    tasks = [ScrapeTask(site, item) for site in (1, 2) for item in range(3)]
+    for task in tasks:
+        scheduler.add(task, 'slow.com' if task.retail_site_id == 1 else 'fast.com', now=T0)
+    taken = scheduler.take(10, now=T0)
+    assert sorted(task.retail_site_id for task in taken) == [1, 2]
+    assert scheduler.pop(now=T0 + timedelta(seconds=5)) is None
+    assert scheduler.pop(now=T0 + timedelta(seconds=10)).retail_site_id == 2
+    assert scheduler.next_ready() == T0 + timedelta(seconds=20)
+    assert scheduler.pop(now=T0 + timedelta(seconds=59)).retail_site_id == 2
+    assert scheduler.pop(now=T0 + timedelta(seconds=60)).retail_site_id == 1
+    # Grouping by site hands out all of a sites remaining tasks together
+    site_id, site_tasks = scheduler.pop_site(now=T0 + timedelta(seconds=120))
+    assert site_id == 1 and len(site_tasks) == 1 and len(scheduler) == 0
+
+def test_scheduler_busy_domains():
+    """
+    Check that tasks of domains waiting out their interval don't hold up
+    others, and that removed tasks are skipped
+    """
+    scheduler = ScrapeScheduler(min_interval=60)
+    busy = [ScrapeTask(1, item) for item in range(100)]
+    for age, task in enumerate(busy):
+        scheduler.add(task, 'busy.com', last_success=T0 - timedelta(hours=age + 1), now=T0)
+    other = ScrapeTask(2, 0)
+    scheduler.add(other, 'other.com', last_success=T0, now=T0)
+    scheduler.remove(busy[-1])
+    assert scheduler.take(10, now=T0) == [busy[-2], other]
+    assert scheduler.pop(now=T0 + timedelta(seconds=30)) is None
+    scheduler.remove(busy[-3])
+    assert scheduler.pop(now=T0 + timedelta(seconds=60)) == busy[-4]
+    assert len(scheduler) == 96
+
+def test_scheduler_load(db_with_items):
+    """
+    Check that a task is loaded for each item in the basket of each site,
+    and that a basket version change makes a task more urgent
+    """
+    scheduler = ScrapeScheduler().load()
+    for site in dm.RetailSite.query.all():
+        expected = {ScrapeTask(site.id, item.id) for item in site.basket_items}
+        assert {task for task in scheduler._tasks if task.retail_site_id == site.id} == expected
+    apple = dm.Item.query.filter(dm.Item.name=="apple").scalar()
+    site = dm.RetailSite.query.filter(dm.RetailSite.name=="Superstore").scalar()
+    task = ScrapeTask(site.id, apple.id)
+    now = datetime.now(timezone.utc)
+    scheduler.complete(task, True, when=now)
+    before = scheduler.priority(task, now)
+    site.regions[0].basket_version += 1
+    db_with_items.commit()
+    scheduler.load()
+    assert scheduler.priority(task, now) > before
+    # A restarted scheduler picks up the last success from stored prices
+    banana = dm.Item.query.filter(dm.Item.name=="banana").scalar()
+    banana_task = ScrapeTask(site.id, banana.id)
+    observed_at = now - timedelta(hours=1)
+    db_with_items.add(dm.PriceObservation(item=banana, retail_site=site, region=site.regions[0], observed_at=observed_at, price=1))
+    db_with_items.commit()
+    restarted = ScrapeScheduler().load()
+    assert restarted._tasks[banana_task].last_success == observed_at
+    assert restarted.priority(banana_task, now) < restarted.priority(task, now)
@@ -17,3 +17,71 @@ def test_scraping_rule_schema(db_with_items, scraping_rule_schema_data):
     else:
         with pytest.raises(BasketBotErrors[error].value):
             esr.load(data)
+
+def test_dom_tag_registry(db_with_items):
+    """
+    Check that DOM tags are validated from the registry without queries, and
+    that the registry sees DOMElem changes
+    """
+    from sqlalchemy import event
+    from basketbot import InvalidDOMElem
+    from basketbot.datamodel import model as dm
+    from basketbot.schemas.schemas import validate_dom_elem
+    assert dm.DOMElem.get_lookup_table()['DIV'] == 'div'
+    assert dm.DOMElem.get_lookup_table(js_first=False)['#text'] == '#text'
+    statements = []
+    record = lambda *args: statements.append(args[2])
+    engine = db_with_items.connection()
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        for _ in range(10):
+            validate_dom_elem('DIV', js=True)
+            validate_dom_elem('p')
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert statements == []
+    with pytest.raises(InvalidDOMElem):
+        validate_dom_elem('UL', js=True)
+    db_with_items.add(dm.DOMElem(bs_name='ul', js_name='UL'))
+    db_with_items.commit()
+    validate_dom_elem('UL', js=True)
+    assert dm.DOMElem.get_lookup_table(js_first=False)['ul'] == 'UL'
+
+def test_scraping_rule_bulk_dump(db_with_items):
+    """
+    Check that dumping many scraping rules takes a fixed number of queries,
+    and gives the same result as dumping them one at a time
+    """
+    from sqlalchemy import event
+    from basketbot.datamodel import model as dm
+    sites = dm.RetailSite.query.all()
+    div = dm.DOMElem.query.filter(dm.DOMElem.js_name=="DIV").first()
+    items = dm.Item.query.all()
+    for n in range(12):
+        rule = dm.ScrapingRule(default_rule=False, retail_site_id=sites[n % len(sites)].id, parent_elem_id=div.id, parent_id=f"rule-{n}", class_chain={})
+        rule.items = [items[n % len(items)]]
+        db_with_items.add(rule)
+    db_with_items.commit()
+    expected = [ExtensionScrapingRule().dump(rule) for rule in dm.ScrapingRule.query.order_by(dm.ScrapingRule.id)]
+    db_with_items.expire_all()
+    dm.dom_tags.get()
+    schema = ExtensionScrapingRule(many=True) # Shared between dumps, as by blp.response
+    for query in (dm.ScrapingRule.query.order_by(dm.ScrapingRule.id), dm.ScrapingRule.bundle_query()):
+        db_with_items.expire_all()
+        rules = query.all()
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        engine = db_with_items.connection()
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            dumped = schema.dump(rules)
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        # One query each for retail sites and items, if not already loaded
+        assert len([statement for statement in statements if statement.startswith('SELECT')]) <= 2
+        assert sorted(dumped, key=lambda rule: rule['parent_id']) == sorted(expected, key=lambda rule: rule['parent_id'])
+    # Nothing from one dump is reused by the next
+    sites[0].url_domain = 'renamed'
+    db_with_items.commit()
+    first = dm.ScrapingRule.query.filter(dm.ScrapingRule.parent_id=="rule-0").one()
+    assert schema.dump([first])[0]['retail_site'] == sites[0].get_site_url()
@@ -0,0 +1,414 @@
+"""
+Test scrapers and compiled scraping rules
+"""
+
+import asyncio
+from decimal import Decimal
+import pytest
+from basketbot import datamodel as dm
+from basketbot import InvalidClassChain
+from basketbot.scrapers import ScrapeWithClassChain
+from basketbot.scrapers.rules import CompiledRule, CompiledNode, compile_class_chain, rule_cache
+from basketbot.scrapers.parsers import PARSER_BACKENDS, get_backend
+from basketbot.scrapers.extract import MultiRuleExtractor
+from basketbot.scrapers.workers import ExtractionPool, ExtractionJob, ruleset
+from basketbot.scrapers.fetch import AsyncFetcher
+from basketbot.scrapers.cycle import run_cycle, site_price_parser
+from basketbot.scrapers.prices import PriceParser
+from basketbot.scrapers import fingerprint
+
+PAGE = """
+<html><body>
+<div id="nav"><a class="link">Home</a></div>
+<section class="layout_section" id="main-content">
+    <main class="product-detail-page layout_main">
+        <div class="product-detail">
+            <span class="price">wrong branch</span>
+        </div>
+        <div class="product-detail extra">
+            <strong aria-label="Now 1.10" class="product_price details-price">
+                £1.10
+            </strong>
+        </div>
+    </main>
+</section>
+</body></html>
+"""
+
+CLASS_CHAIN = {
+        "0": {
+            "tree_node": {"dom_type": "MAIN", "classes": ["product-detail-page", "layout_main"]},
+            "siblings": []
+            },
+        "1": {
+            "tree_node": {"dom_type": "DIV", "classes": ["product-detail"]},
+            "siblings": [{"dom_type": "DIV", "classes": ["product-detail-page_breadcrumb-container"]}]
+            },
+        "2": {
+            "tree_node": {"dom_type": "STRONG", "classes": ["product_price", "details-price"]},
+            "siblings": []
+            },
+        "3": {
+            "tree_node": {"dom_type": "#text", "classes": []},
+            "siblings": []
+            }
+        }
+
+def test_compile_class_chain():
+    """
+    Check that class chains compile to ordered levels of lower case tags and
+    class sets, with a trailing #text node dropped
+    """
+    levels = compile_class_chain(CLASS_CHAIN)
+    assert [l.tree_node.tag for l in levels] == ['main', 'div', 'strong']
+    assert levels[0].tree_node.classes == frozenset(['product-detail-page', 'layout_main'])
+    assert levels[1].siblings == (CompiledNode('div', frozenset(['product-detail-page_breadcrumb-container'])),)
+    with pytest.raises(InvalidClassChain):
+        compile_class_chain({"0": {"tree_node": {"dom_type": "#text", "classes": []}},
+            "1": {"tree_node": {"dom_type": "DIV", "classes": []}}})
+
+@pytest.mark.parametrize("backend", PARSER_BACKENDS)
+def test_compiled_rule_depth_first_match(backend):
+    """
+    Check that an ambiguous level is resolved by following the route that
+    satisfies the rest of the chain
+    """
+    rule = CompiledRule('section', 'main-content', compile_class_chain(CLASS_CHAIN))
+    dom = get_backend(backend).parse(PAGE)
+    assert rule.extract(dom, backend) == '£1.10'
+    assert CompiledRule('section', 'missing', rule.levels).extract(dom, backend) is None
+
+@pytest.mark.parametrize("backend", PARSER_BACKENDS)
+def test_scrape_with_class_chain(backend):
+    scraper = ScrapeWithClassChain('main-content', CLASS_CHAIN, parent_elem='section', backend=backend)
+    scraper.dom_from_html(PAGE)
+    assert scraper.scrape() == '£1.10'
+
+@pytest.mark.parametrize("backend", PARSER_BACKENDS)
+@pytest.mark.parametrize("html", [
+    PAGE,
+    PAGE.replace('id="main-content"', 'id="other-content"'),
+    PAGE.replace('<main', '<section id="main-content"><main').replace('</main>', '</main></section>'),
+    PAGE.replace('</section>', ''),
+    ])
+def test_partial_parse_matches_full_parse(backend, html):
+    """
+    Check that parsing only the parent elements subtree gives the same
+    result as parsing the whole document
+    """
+    full = ScrapeWithClassChain('main-content', CLASS_CHAIN, parent_elem='section', backend=backend)
+    full.dom_from_html(html)
+    partial = ScrapeWithClassChain('main-content', CLASS_CHAIN, parent_elem='section', backend=backend, partial=True)
+    partial.dom_from_html(html)
+    assert partial.scrape() == full.scrape()
+
+@pytest.mark.parametrize("html", [
+    PAGE,
+    PAGE.encode('utf-8'),
+    PAGE.replace('£1.10', '&pound;1<span class="pence">.10</span> <!-- was 1.20 -->'),
+    PAGE.replace('product_price details-price', ' details-price\n product_price  '),
+    PAGE.replace('id="main-content"', 'id="other-content"'),
+    # Malformed markup, which each parser has to repair
+    PAGE.replace('</strong>', ''),
+    PAGE.replace('£1.10', '<p>£1.10'),
+    PAGE.replace('wrong branch</span>\n        </div>', 'wrong branch</span>'),
+    PAGE.replace('<main class="product-detail-page layout_main">', '<main class="product-detail-page layout_main"></div>'),
+    PAGE.replace('<section', '</div></div><section'),
+    PAGE.replace('<strong', '<b><strong').replace('</strong>', '</b></strong>'),
+    PAGE.replace('</body></html>', ''),
+    ])
+def test_parser_backends_agree(html):
+    """
+    Check that all parser backends give identical results for the same rule,
+    including on malformed HTML
+    """
+    rule = CompiledRule('section', 'main-content', compile_class_chain(CLASS_CHAIN))
+    results = {rule.extract(backend.parse(html), backend) for backend in map(get_backend, PARSER_BACKENDS)}
+    assert len(results) == 1
+
+def test_rule_cache(db_with_items):
+    """
+    Check that compiled rules are reused until the rule is updated
+    """
+    section = dm.DOMElem(bs_name='section', js_name='SECTION')
+    sr = dm.ScrapingRule(
+            default_rule=True,
+            retail_site_id=dm.RetailSite.query.first().id,
+            parent_elem=section,
+            parent_id="main-content",
+            class_chain=CLASS_CHAIN
+            )
+    db_with_items.add_all([section, sr])
+    db_with_items.commit()
+    compiled = sr.get_rule()
+    assert sr.get_rule() is compiled
+    assert ScrapeWithClassChain.from_rule(sr).rule is compiled
+    sr.parent_id = "other-content"
+    db_with_items.add(sr)
+    db_with_items.commit()
+    assert sr.get_rule() is not compiled
+    assert sr.get_rule().parent_id == "other-content"
+    rule_cache.invalidate()
+    assert len(rule_cache) == 0
+
+LISTING = """
+<html><body>
+<ul class="products" id="listing">
+    <li class="product apple"><span class="name">Apple</span><span class="price now">0.40</span></li>
+    <li class="product banana"><span class="name">Banana</span><span class="price">0.25</span></li>
+    <li class="product"><span class="name">Snapple</span><span class="price sale">1.99</span></li>
+</ul>
+<div id="offer"><p class="deal">3 for 2</p></div>
+</body></html>
+"""
+
+def listing_rule(li_classes, span_classes, parent_tag='ul', parent_id='listing'):
+    return CompiledRule(parent_tag, parent_id, compile_class_chain({
+        "0": {"tree_node": {"dom_type": "LI", "classes": li_classes}},
+        "1": {"tree_node": {"dom_type": "SPAN", "classes": span_classes}},
+        }))
+
+@pytest.mark.parametrize("backend", PARSER_BACKENDS)
+def test_multi_rule_extractor(backend):
+    """
+    Check that extracting many rules in one pass gives the same results as
+    extracting each rule separately
+    """
+    rules = {
+            'apple': listing_rule(['apple'], ['price']),
+            'banana': listing_rule(['banana'], ['price']),
+            'first': listing_rule(['product'], ['price']),
+            'sale': listing_rule(['product'], ['price', 'sale']),
+            'same': listing_rule(['product'], ['price', 'sale']),
+            'deal': CompiledRule('div', 'offer', compile_class_chain({"0": {"tree_node": {"dom_type": "P", "classes": ["deal"]}}})),
+            'anchor': CompiledRule('div', 'offer', ()),
+            'missing': listing_rule(['cherry'], ['price']),
+            'no_anchor': listing_rule(['apple'], ['price'], parent_id='nowhere'),
+            }
+    dom = get_backend(backend).parse(LISTING)
+    results = MultiRuleExtractor(rules).extract(dom, backend)
+    assert results == {key: rule.extract(dom, backend) for key, rule in rules.items()}
+    assert results['first'] == '0.40'
+    assert results['sale'] == results['same'] == '1.99'
+    assert results['missing'] is None and results['no_anchor'] is None
+
+def test_multi_rule_extractor_from_retail_site(db_with_items):
+    """
+    Check that items are mapped to their exception rule, or the site default
+    """
+    rs = dm.RetailSite.query.filter(dm.RetailSite.name=="Superstore").scalar()
+    ul = dm.DOMElem(bs_name='ul', js_name='UL')
+    chain = lambda cls: {"0": {"tree_node": {"dom_type": "LI", "classes": [cls]}}, "1": {"tree_node": {"dom_type": "SPAN", "classes": ["price"]}}}
+    default = dm.ScrapingRule(default_rule=True, retail_site_id=rs.id, parent_elem=ul, parent_id="listing", class_chain=chain("product"))
+    banana_rule = dm.ScrapingRule(default_rule=False, retail_site_id=rs.id, parent_elem=ul, parent_id="listing", class_chain=chain("banana"))
+    banana = dm.Item.query.filter(dm.Item.name=="banana").scalar()
+    banana_rule.items = [banana]
+    db_with_items.add_all([ul, default, banana_rule])
+    db_with_items.commit()
+    extractor = MultiRuleExtractor.from_retail_site(rs)
+    assert set(extractor.rules) == {item.id for item in rs.basket_items}
+    results = extractor.extract(get_backend('bs4').parse(LISTING), 'bs4')
+    assert results[banana.id] == '0.25'
+    assert all(value == '0.40' for item_id, value in results.items() if item_id != banana.id)
+
+def test_extraction_pool():
+    """
+    Check that the process pool extracts the same values as extracting in
+    process, and that it does not pull jobs faster than it can process them
+    """
+    rules = {
+            'apple': listing_rule(['apple'], ['price']),
+            'banana': listing_rule(['banana'], ['price']),
+            'deal': CompiledRule('div', 'offer', compile_class_chain({"0": {"tree_node": {"dom_type": "P", "classes": ["deal"]}}})),
+            }
+    pages = [LISTING, LISTING.replace('0.40', '0.45'), LISTING.encode('utf-8'), '<html></html>']
+    pulled = []
+    yielded = []
+    async def jobs():
+        for n, page in enumerate(pages * 3):
+            pulled.append(n)
+            assert len(pulled) - len(yielded) <= 2
+            yield ExtractionJob(page, ruleset(rules), n)
+    async def run(pool):
+        async for result in pool.extract(jobs()):
+            yielded.append(result)
+    with ExtractionPool(max_workers=2, max_pending=2, backend='lxml') as pool:
+        asyncio.run(run(pool))
+    assert sorted(r.job.context for r in yielded) == list(range(len(pages) * 3))
+    for result in yielded:
+        assert result.error is None
+        page = pages[result.job.context % len(pages)]
+        assert result.values == MultiRuleExtractor(rules).extract(get_backend('lxml').parse(page), 'lxml')
+    assert yielded[0].values.keys() == rules.keys()
+
+def test_run_cycle(db_with_items, app):
+    """
+    Check that a scrape cycle extracts every basket item of sites with rules,
+    writes them to the sites basket, and only reports in dry run mode
+    """
+    rs = dm.RetailSite.query.filter(dm.RetailSite.name=="Superstore").scalar()
+    ul = dm.DOMElem(bs_name='ul', js_name='UL')
+    chain = lambda cls: {"0": {"tree_node": {"dom_type": "LI", "classes": [cls]}}, "1": {"tree_node": {"dom_type": "SPAN", "classes": ["price"]}}}
+    default = dm.ScrapingRule(default_rule=True, retail_site_id=rs.id, parent_elem=ul, parent_id="listing", class_chain=chain("apple"))
+    banana_rule = dm.ScrapingRule(default_rule=False, retail_site_id=rs.id, parent_elem=ul, parent_id="listing", class_chain=chain("banana"))
+    banana_rule.items = [dm.Item.query.filter(dm.Item.name=="banana").scalar()]
+    db_with_items.add_all([ul, default, banana_rule])
+    db_with_items.commit()
+    fetched = []
+    def fetch(url, timeout, cache=None):
+        fetched.append(url)
+        return 200, LISTING.encode('utf-8')
+    n_items = len(rs.basket_items)
+    seen = {}
+    with AsyncFetcher(fetch_fn=fetch) as fetcher:
+        stats = run_cycle(workers=1, dry_run=True, fetcher=fetcher, on_result=lambda site, prices: seen.update(prices))
+    assert fetched == [rs.basket_url]
+    assert stats.sites == len(dm.RetailSite.query.all()) and stats.skipped_sites == stats.sites - 1
+    assert stats.pages == 1 and stats.rules == n_items and stats.written_sites == 0
+    assert seen['banana'] == Decimal('0.25') and seen['apple'] == Decimal('0.40')
+    assert stats.success_rate == 1.0 and stats.bytes == len(LISTING.encode('utf-8'))
+    # Basket edits made whilst the cycle runs are kept
+    table = dm.RetailSite.__table__
+    edit = lambda site, prices: db_with_items.execute(table.update().where(table.c.id==site.id).values(basket={'kiwi': '9.99'}))
+    with AsyncFetcher(fetch_fn=fetch) as fetcher:
+        stats = run_cycle(sites=["Superstore"], workers=1, fetcher=fetcher, on_result=edit)
+    assert stats.written_sites == 1
+    db_with_items.refresh(rs)
+    assert rs.basket['banana'] == '0.25' and rs.basket['apple'] == '0.40'
+    assert rs.basket['kiwi'] == '9.99'
+    banana = dm.Item.query.filter(dm.Item.name=="banana").scalar()
+    observed = dm.PriceObservation.history(banana, rs).all()
+    assert {obs.region for obs in observed} == set(rs.regions)
+    # Prices are recorded in the currency they were parsed in, for every region
+    parsed_currency = dm.Currency.query.filter_by(abbreviation=site_price_parser(rs).currency).one()
+    assert all(obs.price == Decimal('0.25') and obs.currency == parsed_currency for obs in observed)
+    # Prices per weight are not item prices
+    fetch_kg = lambda url, timeout, cache=None: (200, LISTING.replace('0.25<', '0.30/kg<').encode('utf-8'))
+    with AsyncFetcher(fetch_fn=fetch_kg) as fetcher:
+        stats = run_cycle(sites=["Superstore"], workers=1, fetcher=fetcher)
+    assert stats.unit_prices == 1 and stats.unparsed_prices == 0
+    db_with_items.refresh(rs)
+    assert rs.basket['banana'] == '0.25'
+    with AsyncFetcher(fetch_fn=fetch) as fetcher:
+        assert run_cycle(regions=["London"], workers=1, fetcher=fetcher).sites == 0
+
+def test_run_cycle_fingerprints(db_with_items, app):
+    """
+    Check that unchanged prices are reused from fingerprints, and that rules
+    are flagged when the layout of their page changes
+    """
+    rs = dm.RetailSite.query.filter(dm.RetailSite.name=="Superstore").scalar()
+    ul = dm.DOMElem(bs_name='ul', js_name='UL')
+    chain = {"0": {"tree_node": {"dom_type": "LI", "classes": ["apple"]}}, "1": {"tree_node": {"dom_type": "SPAN", "classes": ["price"]}}}
+    rule = dm.ScrapingRule(default_rule=True, retail_site_id=rs.id, parent_elem=ul, parent_id="listing", class_chain=chain)
+    db_with_items.add_all([ul, rule])
+    db_with_items.commit()
+    page = [LISTING]
+    def run():
+        with AsyncFetcher(fetch_fn=lambda url, timeout, cache=None: (200, page[0].encode('utf-8'))) as fetcher:
+            return run_cycle(sites=["Superstore"], workers=1, fetcher=fetcher)
+    n_items = len(rs.basket_items)
+    assert run().cached_prices == 0
+    assert dm.RuleFingerprint.query.filter_by(scraping_rule_id=rule.id).count() == 1
+    assert run().cached_prices == n_items
+    update_time = rule.update_time
+    # Adding a tile moves the route without changing its structure
+    page[0] = LISTING.replace('<ul class="products" id="listing">', '<ul class="products" id="listing"><li class="ad">Offer</li>')
+    stats = run()
+    assert stats.possibly_broken_rules == 0 and stats.cached_prices == 0
+    assert run().cached_prices == n_items
+    db_with_items.refresh(rule)
+    assert not rule.possibly_broken
+    page[0] = page[0].replace('class="price now"', 'class="price was"')
+    stats = run()
+    assert stats.possibly_broken_rules == 1 and stats.cached_prices == 0
+    db_with_items.refresh(rule)
+    assert rule.possibly_broken and rule.update_time == update_time
+    db_with_items.refresh(rs)
+    assert rs.basket['apple'] == '0.40'
+    rule.class_chain = dict(chain)
+    db_with_items.commit()
+    assert not rule.possibly_broken and rule.update_time != update_time
+
+@pytest.mark.parametrize("backend", PARSER_BACKENDS)
+def test_fingerprint_checks(backend):
+    """
+    Check that fingerprints spot unchanged pages, changed prices and changed
+    layouts, give the same text as extraction, and that checking all rules
+    in one traversal agrees with checking each rule on its own
+    """
+    rules = {'apple': listing_rule(['apple'], ['price']), 'banana': listing_rule(['banana'], ['price'])}
+    extractor = MultiRuleExtractor(rules)
+    backend = get_backend(backend)
+    def check(html, previous):
+        dom = backend.parse(html)
+        checks = extractor.check(dom, previous, backend)
+        anchor = backend.find_anchor(dom, 'ul', 'listing')
+        assert checks == {key: fingerprint.check_rule(rule, anchor, backend, previous.get(key)) for key, rule in rules.items()}
+        return checks
+    first = check(LISTING, {})
+    assert {key: c.status for key, c in first.items()} == {'apple': fingerprint.NEW, 'banana': fingerprint.NEW}
+    assert {key: c.text for key, c in first.items()} == extractor.extract(backend.parse(LISTING), backend)
+    previous = {key: c.fingerprint._replace(value=key) for key, c in first.items()}
+    again = check(LISTING, previous)
+    assert all(c.unchanged and c.fingerprint.value == key for key, c in again.items())
+    repriced = check(LISTING.replace('0.40', '0.45'), previous)
+    assert repriced['apple'].status == fingerprint.TEXT_CHANGED and repriced['apple'].text == '0.45'
+    assert repriced['banana'].unchanged
+    moved = check(LISTING.replace('<ul class="products" id="listing">', '<ul class="products" id="listing"><li>Ad</li>'), previous)
+    assert all(c.status == fingerprint.MOVED and not c.possibly_broken for c in moved.values())
+    assert moved['apple'].text == '0.40' and moved['apple'].fingerprint.digest == previous['apple'].digest
+    restyled = check(LISTING.replace('class="price now"', 'class="price was"'), previous)
+    assert restyled['apple'].status == fingerprint.STRUCTURE_CHANGED and restyled['apple'].possibly_broken
+    assert restyled['banana'].unchanged
+    lost = check(LISTING.replace('class="product apple"', 'class="product"'), previous)
+    assert lost['apple'].status == fingerprint.LOST and lost['apple'].possibly_broken
+
+@pytest.mark.parametrize("currency,country,text,amount,quantity,unit", [
+    ("GBP", "England", "£1,234.50", "1234.50", 1, None),
+    ("GBP", "England", "Now £1.10", "1.10", 1, None),
+    ("GBP", "England", "3 for £2", "2", 3, None),
+    ("GBP", "England", "50p", "0.50", 1, None),
+    ("GBP", "England", "£1.20/kg", "1.20", 1, "kg"),
+    ("GBP", "England", "£2.75 per 100g", "2.75", 1, "100g"),
+    ("HRN", "Ukraine", "1 234,50 грн", "1234.50", 1, None),
+    ("HRN", "Ukraine", "12,99 ₴", "12.99", 1, None),
+    ("EUR", "Germany", "1.234,50 €", "1234.50", 1, None),
+    ("EUR", "Ireland", "€1,234.50", "1234.50", 1, None),
+    ("GBP", "England", "out of stock", None, None, None),
+    # Counts, sizes and old prices are not the price
+    ("GBP", "England", "Pack of 6 £3.00", "3.00", 1, None),
+    ("GBP", "England", "Save 20% £4.00", "4.00", 1, None),
+    ("GBP", "England", "Serves 4 - £3.50", "3.50", 1, None),
+    ("GBP", "England", "Was £2.00 Now £1.50", "1.50", 1, None),
+    ("GBP", "England", "£1.10 £2.20/kg", "1.10", 1, None),
+    ("EUR", "Germany", "1,5 kg 3,99 €", "3.99", 1, None),
+    ("EUR", "Germany", "2,50 € 5,00 €/kg", "2.50", 1, None),
+    ("HRN", "Ukraine", "3 для 10,00 грн", "10.00", 3, None),
+    ("GBP", "England", "Was £2.00", None, None, None),
+    # Bare numbers only without a currency symbol, and never as a multibuy
+    ("GBP", "England", "0.40", "0.40", 1, None),
+    ("GBP", "England", "Serves 4 - 3.50", "3.50", 1, None),
+    ("GBP", "England", "3 for 2", None, None, None),
+    ])
+def test_price_parser(currency, country, text, amount, quantity, unit):
+    """
+    Check that prices are parsed using the separators of their locale
+    """
+    price = PriceParser.for_currency(currency, country).parse(text)
+    if amount is None:
+        assert price is None
+    else:
+        assert (price.amount, price.quantity, price.unit) == (Decimal(amount), quantity, unit)
+        assert price.per_item == (unit is None)
+        assert PriceParser.for_currency(currency, country).parse_many([text, None, text]) == [price, None, price]
+
+def test_price_parser_for_region(db_with_items):
+    """
+    Check that a regions currency picks its parser, and unit prices are
+    rounded to the minor unit
+    """
+    region = dm.Region.query.filter(dm.Region.name=="Pripyat").scalar()
+    parser = PriceParser.for_region(region)
+    assert parser is PriceParser.for_currency("HRN", "Ukraine")
+    assert parser.parse("3 for 10,00 грн").unit_price == Decimal("3.33")
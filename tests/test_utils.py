@@ -1,6 +1,7 @@
 import pytest
+import requests
 import requests_mock
-from basketbot import util
+from basketbot import util, ProtocolProbeFailed
 from basketbot.datamodel import model as dm
 
 @pytest.mark.parametrize("url", [
@@ -66,3 +67,64 @@ class TestAddingURL:
         rs.add_site_url(url[0])
         assert [rs.url_protocol, rs.url_subdomain, rs.url_domain, rs.url_suffix] == url[1]
 
+
+def test_http_client_reuses_connections(stub_http_server):
+    """
+    Check that the shared HTTP client keeps connections to a host alive
+    """
+    client = util.HTTPClient(pool_maxsize=2)
+    for n in range(5):
+        assert client.get(f'{stub_http_server.url}/site/{n}').ok
+    assert client.session(stub_http_server.url) is client.session(f'{stub_http_server.url}/other')
+    assert stub_http_server.connections == 1
+    client.close()
+
+def test_protocol_cache(mocked_http_urls, requests_mock):
+    """
+    Check that hosts are only probed once per TTL, and that probes which
+    fail are neither cached nor taken to mean http
+    """
+    cache = util.ProtocolCache(ttl=60, negative_ttl=0)
+    assert cache.get('example_https.com') == 'https'
+    assert cache.get('EXAMPLE_HTTPS.com') == 'https'
+    assert requests_mock.call_count == 1
+    assert cache.get('example_no_https.com') == 'http'
+    assert cache.get('example_no_https.com') == 'http' # Negative entry expired
+    assert requests_mock.call_count == 3
+    assert requests_mock.last_request.timeout == cache.timeout
+
+    requests_mock.get('https://example_timeout.com', exc=requests.exceptions.ConnectTimeout)
+    requests_mock.get('https://example_bad_cert.com', exc=requests.exceptions.SSLError)
+    cache = util.ProtocolCache()
+    for n in range(2):
+        with pytest.raises(ProtocolProbeFailed):
+            cache.get('example_timeout.com')
+    assert requests_mock.call_count == 5
+    assert len(cache) == 0
+    assert util.check_for_https('example_timeout.com') is False # Not strict
+    assert cache.get('example_bad_cert.com') == 'http'
+    assert cache.get('example_bad_cert.com') == 'http'
+    assert requests_mock.call_count == 7
+    with pytest.raises(ProtocolProbeFailed):
+        util.decompose_url('example_timeout.com/products')
+
+def test_domain_extractor(tmp_path, monkeypatch):
+    """
+    Check that hostnames are split without the network, from the bundled or
+    a local suffix list, and that results are memoized per hostname
+    """
+    import requests
+    get = requests.Session.get
+    def no_network(session, url, **kwargs):
+        assert url.startswith('file://'), 'Suffix list should not be downloaded'
+        return get(session, url, **kwargs)
+    monkeypatch.setattr(requests.Session, 'get', no_network)
+    extractor = util.DomainExtractor().load()
+    assert extractor.extract('http://mail.mydomain.co.uk/a?b=c') == ('mail', 'mydomain', 'co.uk')
+    assert extractor.extract('MAIL.mydomain.co.uk') == ('mail', 'mydomain', 'co.uk')
+    assert extractor.cache_info().hits == 1
+    suffix_list = tmp_path / 'suffixes.dat'
+    suffix_list.write_text('// ===BEGIN ICANN DOMAINS===\ncom\nshop.test\n// ===END ICANN DOMAINS===\n')
+    extractor = util.DomainExtractor(suffix_list=suffix_list).load()
+    assert extractor.extract('www.example.shop.test') == ('www', 'example', 'shop.test')
+    assert extractor.extract('www.example.co.uk').suffix == '' # Not in the local list